@@ -53,6 +53,30 @@ try:
     ENABLE_QUEUE = Config.ENABLE_QUEUE
     ALLOWED_FILE_TYPES = Config.ALLOWED_FILE_TYPES
     COMPRESSION_PRESETS = Config.COMPRESSION_PRESETS
+    FFMPEG_MEMORY_LIMIT = Config.FFMPEG_MEMORY_LIMIT
+    FFMPEG_CPU_WEIGHT = Config.FFMPEG_CPU_WEIGHT
+    FFMPEG_NICE = Config.FFMPEG_NICE
+    FFMPEG_IONICE_CLASS = Config.FFMPEG_IONICE_CLASS
+    FFMPEG_IONICE_LEVEL = Config.FFMPEG_IONICE_LEVEL
+    ENABLE_CGROUPS = Config.ENABLE_CGROUPS
+    FFMPEG_THREADS = Config.FFMPEG_THREADS
+    TIMEOUT_DOWNLOAD = Config.TIMEOUT_DOWNLOAD
+    TIMEOUT_UPLOAD = Config.TIMEOUT_UPLOAD
+    TRANSFER_RETRIES = Config.TRANSFER_RETRIES
+    TRANSFER_BACKOFF_MAX = Config.TRANSFER_BACKOFF_MAX
+    TIMEOUT_ENCODE = Config.TIMEOUT_ENCODE
+    FFMPEG_STALL_TIMEOUT = Config.FFMPEG_STALL_TIMEOUT
+    FFMPEG_LOG_TAIL = Config.FFMPEG_LOG_TAIL
+    SIZE_ABORT_MARGIN = Config.SIZE_ABORT_MARGIN
+    SIZE_PROJECTION_MIN_PERCENT = Config.SIZE_PROJECTION_MIN_PERCENT
+    ENABLE_SPLIT_UPLOAD = Config.ENABLE_SPLIT_UPLOAD
+    PARALLEL_PART_UPLOADS = Config.PARALLEL_PART_UPLOADS
+    ENABLE_STREAMING_UPLOAD = Config.ENABLE_STREAMING_UPLOAD
+    PARALLEL_UPLOAD_WORKERS = Config.PARALLEL_UPLOAD_WORKERS
+    AUTO_QUALITY_PARALLEL = Config.AUTO_QUALITY_PARALLEL
+    PARALLEL_PART_ENCODES = Config.PARALLEL_PART_ENCODES
+    CHUNK_SIZE = Config.CHUNK_SIZE
+    MAX_WORKERS = Config.MAX_WORKERS
 except Exception as e:
     print(f"Configuration Error: {e}")
     print("Please check your environment variables and config.py file")
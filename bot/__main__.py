@@ -31,7 +31,8 @@ from bot.plugins.incoming_message_fn import (
     incoming_start_message_f,
     incoming_compress_message_f,  # This is now deprecated but kept for compatibility
     incoming_cancel_message_f,
-    handle_video_message  # NEW: Direct video message handler
+    handle_video_message,  # NEW: Direct video message handler
+    handle_trim_input
 )
 
 from bot.plugins.admin import (
@@ -58,6 +59,8 @@ from bot.plugins.new_join_fn import (
 # Import the enhanced callback handler
 from bot.plugins.enhanced_callback_handler import button_enhanced
 
+from bot.helper_funcs.encoders import ENCODERS
+
 class EnhancedVideoCompressBot:
     def __init__(self):
         self.app = None
@@ -71,6 +74,9 @@ class EnhancedVideoCompressBot:
             if not os.path.isdir(DOWNLOAD_LOCATION):
                 os.makedirs(DOWNLOAD_LOCATION)
 
+            # Ask ffmpeg once which encoders, muxers and filters it has
+            await asyncio.to_thread(ENCODERS.detect)
+
             # Initialize Pyrogram client
             self.app = Client(
                 SESSION_NAME,
@@ -168,6 +174,12 @@ class EnhancedVideoCompressBot:
             filters=(filters.video | filters.document) & filters.private & ~filters.command(["start", "help", "cancel", "status", "compress"])
         ))
 
+        # Trim ranges typed after pressing the Trim button
+        self.app.add_handler(MessageHandler(
+            handle_trim_input,
+            filters=filters.text & filters.private & ~filters.command(["start", "help", "cancel", "status", "compress"])
+        ))
+
         # NEW: Enhanced callback query handler for button interactions
         self.app.add_handler(CallbackQueryHandler(button_enhanced))
 
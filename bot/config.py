@@ -104,10 +104,40 @@ class Config(object):
     HTTP_PROXY = get_config("HTTP_PROXY", None)
     TIMEOUT_DOWNLOAD = int(get_config("TIMEOUT_DOWNLOAD", "3600"))  # 1 hour
     TIMEOUT_UPLOAD = int(get_config("TIMEOUT_UPLOAD", "3600"))  # 1 hour
+    TRANSFER_RETRIES = int(get_config("TRANSFER_RETRIES", "5"))  # resumed attempts per download or upload
+    TRANSFER_BACKOFF_MAX = int(get_config("TRANSFER_BACKOFF_MAX", "60"))  # longest wait between them, seconds
+    TIMEOUT_ENCODE = int(get_config("TIMEOUT_ENCODE", "21600"))  # 6 hours
+    FFMPEG_STALL_TIMEOUT = int(get_config("FFMPEG_STALL_TIMEOUT", "120"))  # seconds without progress
+    FFMPEG_LOG_TAIL = int(get_config("FFMPEG_LOG_TAIL", "65536"))  # bytes of stderr kept per job
+    SIZE_ABORT_MARGIN = float(get_config("SIZE_ABORT_MARGIN", "1.15"))  # abort when projection > limit * margin
+    SIZE_PROJECTION_MIN_PERCENT = int(get_config("SIZE_PROJECTION_MIN_PERCENT", "3"))
+    
+    # Oversize Output Splitting
+    ENABLE_SPLIT_UPLOAD = str(get_config("ENABLE_SPLIT_UPLOAD", "True")).lower() == "true"
+    PARALLEL_PART_UPLOADS = int(get_config("PARALLEL_PART_UPLOADS", "2"))
+    # Upload fragmented MP4 output while it is still being encoded
+    ENABLE_STREAMING_UPLOAD = str(get_config("ENABLE_STREAMING_UPLOAD", "False")).lower() == "true"
+    # Media connections used to upload one large file, 1 = Pyrogram's own uploader
+    PARALLEL_UPLOAD_WORKERS = int(get_config("PARALLEL_UPLOAD_WORKERS", "4"))
+    
+    # Auto Quality CRF Search
+    AUTO_QUALITY_PARALLEL = int(get_config("AUTO_QUALITY_PARALLEL", "3"))
+    
+    # Deliver in Parts
+    PARALLEL_PART_ENCODES = int(get_config("PARALLEL_PART_ENCODES", "2"))
     
     # Performance Configuration
-    CHUNK_SIZE = int(get_config("CHUNK_SIZE", str(1024 * 1024)))  # 1MB chunks
-    MAX_WORKERS = int(get_config("MAX_WORKERS", "4"))
+    CHUNK_SIZE = int(get_config("CHUNK_SIZE", str(1024 * 1024)))  # 1MB chunks, bytes per download request
+    MAX_WORKERS = int(get_config("MAX_WORKERS", "4"))  # parallel media connections per download
+    
+    # FFmpeg Resource Limits (per job)
+    FFMPEG_MEMORY_LIMIT = int(get_config("FFMPEG_MEMORY_LIMIT", "0"))  # bytes, 0 = auto share of RAM (x4 as an rlimit without cgroups)
+    FFMPEG_CPU_WEIGHT = int(get_config("FFMPEG_CPU_WEIGHT", "50"))  # cgroup cpu.weight (bot gets 100)
+    FFMPEG_NICE = int(get_config("FFMPEG_NICE", "10"))
+    FFMPEG_IONICE_CLASS = int(get_config("FFMPEG_IONICE_CLASS", "2"))  # 2 = best-effort
+    FFMPEG_IONICE_LEVEL = int(get_config("FFMPEG_IONICE_LEVEL", "7"))
+    ENABLE_CGROUPS = str(get_config("ENABLE_CGROUPS", "True")).lower() == "true"
+    FFMPEG_THREADS = int(get_config("FFMPEG_THREADS", "0"))  # encoder threads per job, 0 = encoder default
     
     # Database Configuration
     DB_POOL_SIZE = int(get_config("DB_POOL_SIZE", "10"))
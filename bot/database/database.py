@@ -21,8 +21,10 @@ class Database:
                 self.settings = None
                 self.stats = None
                 self.queue = None
+                self.failed_jobs = None
                 self._use_memory = True
                 self._memory_users = {}
+                self._memory_failed_jobs = []
                 return
                 
             self._client = motor.motor_asyncio.AsyncIOMotorClient(
@@ -36,8 +38,10 @@ class Database:
             self.settings = self.db.user_settings
             self.stats = self.db.bot_stats
             self.queue = self.db.compression_queue
+            self.failed_jobs = self.db.failed_jobs
             self._use_memory = False
             self._memory_users = {}
+            self._memory_failed_jobs = []
             LOGGER.info("Database connection established")
         except Exception as e:
             LOGGER.error(f"Database connection failed: {e}")
@@ -48,8 +52,10 @@ class Database:
             self.settings = None
             self.stats = None
             self.queue = None
+            self.failed_jobs = None
             self._use_memory = True
             self._memory_users = {}
+            self._memory_failed_jobs = []
     
     def new_user(self, id: int, username: str = None, first_name: str = None) -> Dict[str, Any]:
         """Create new user document with enhanced fields"""
@@ -266,6 +272,28 @@ class Database:
             LOGGER.error(f"Error updating compression stats {user_id}: {e}")
             return False
     
+    async def add_failed_job(self, user_id: int, reason: str, details: Dict[str, Any] = None) -> bool:
+        """Record a failed compression job with its diagnostics"""
+        try:
+            record = {
+                'user_id': user_id,
+                'reason': reason,
+                'failed_at': datetime.datetime.utcnow().isoformat(),
+                **(details or {})
+            }
+            
+            if self._use_memory:
+                self._memory_failed_jobs.append(record)
+                # Keep the in-memory history bounded
+                del self._memory_failed_jobs[:-100]
+                return True
+                
+            await self.failed_jobs.insert_one(record)
+            return True
+        except Exception as e:
+            LOGGER.error(f"Error recording failed job for {user_id}: {e}")
+            return False
+    
     async def get_all_users(self):
         """Get all users cursor"""
         try:
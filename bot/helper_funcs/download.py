@@ -1,19 +1,30 @@
 # bot/helper_funcs/download.py - Enhanced downloader
 
 import asyncio
+import errno
 import logging
 import math
 import os
+import random
 import time
 import aiofiles
 from datetime import datetime
 from typing import Optional, Callable, Any
 from pathlib import Path
 
-from pyrogram import Client
+from pyrogram import Client, raw
+from pyrogram.errors import FloodWait, BadRequest, FileReferenceExpired, FileReferenceInvalid
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session import Session, Auth
 from pyrogram.types import Message
 
-from bot import DOWNLOAD_LOCATION
+from bot import (
+    DOWNLOAD_LOCATION,
+    CHUNK_SIZE,
+    MAX_WORKERS,
+    TRANSFER_RETRIES,
+    TRANSFER_BACKOFF_MAX
+)
 from bot.helper_funcs.display_progress import (
     progress_for_pyrogram,
     ProgressTracker,
@@ -28,6 +39,69 @@ from bot.helper_funcs.utils import (
 
 LOGGER = logging.getLogger(__name__)
 
+# upload.GetFile serves at most 1 MB per request and never across a 1 MB boundary
+MAX_REQUEST_SIZE = 1024 * 1024
+# Below this, opening extra media sessions costs more than it saves
+PARALLEL_DOWNLOAD_MIN_SIZE = 20 * 1024 * 1024
+RANGE_RETRIES = 3
+# First wait of the exponential backoff between transfer retries, seconds
+TRANSFER_BACKOFF_BASE = 1.0
+
+class ParallelDownloadUnavailable(Exception):
+    """The file cannot be fetched by byte ranges; a plain download is needed"""
+
+def transfer_backoff(attempt: int) -> float:
+    """Wait before retry number attempt: about 1, 2, 4 ... seconds with jitter, capped"""
+    delay = min(TRANSFER_BACKOFF_BASE * 2 ** (attempt - 1), TRANSFER_BACKOFF_MAX)
+    return delay * random.uniform(0.5, 1.0)
+
+async def retry_transfer(operation: Callable, what: str, attempts: int = TRANSFER_RETRIES):
+    """
+    Await operation() until it succeeds. FloodWait is slept out without
+    using up an attempt, other errors wait an exponential backoff, and the
+    last error is raised. operation must pick up where the failed attempt
+    stopped, so a retry costs seconds rather than the whole transfer.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await operation()
+        except FloodWait as e:
+            LOGGER.warning(f"{what}: flood wait of {e.value}s")
+            await asyncio.sleep(e.value)
+        except Exception as e:
+            attempt += 1
+            if attempt >= max(attempts, 1):
+                raise
+            delay = transfer_backoff(attempt)
+            LOGGER.warning(f"{what} failed ({e}), attempt {attempt}/{attempts}, resuming in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+async def open_media_sessions(client: Client, dc_id: int, count: int) -> list:
+    """count media sessions to dc_id sharing one auth key, authorized once"""
+    test_mode = await client.storage.test_mode()
+    home = dc_id == await client.storage.dc_id()
+    auth_key = await client.storage.auth_key() if home else await Auth(client, dc_id, test_mode).create()
+    sessions = [Session(client, dc_id, auth_key, test_mode, is_media=True) for _ in range(count)]
+    try:
+        await asyncio.gather(*(session.start() for session in sessions))
+        if not home:
+            exported = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+            await sessions[0].invoke(raw.functions.auth.ImportAuthorization(
+                id=exported.id, bytes=exported.bytes
+            ))
+    except Exception:
+        await close_media_sessions(sessions)
+        raise
+    return sessions
+
+async def close_media_sessions(sessions: list):
+    for session in sessions:
+        try:
+            await session.stop()
+        except Exception:
+            pass
+
 class EnhancedDownloader:
     """Enhanced file downloader with advanced features"""
     
@@ -193,6 +267,203 @@ class EnhancedDownloader:
             if user_id in self.active_downloads:
                 del self.active_downloads[user_id]
     
+    async def fetch_file(
+        self,
+        client: Client,
+        message: Message,
+        file_name: str,
+        progress: Optional[Callable] = None,
+        progress_args: tuple = ()
+    ) -> Optional[str]:
+        """
+        Download the video or document of message to file_name over up to
+        MAX_WORKERS media sessions to the file's DC, CHUNK_SIZE bytes per
+        request, each range written at its offset into a preallocated file.
+        Small files, and files that cannot be fetched by ranges, are streamed
+        over one connection instead. Failed attempts are retried with
+        backoff and resume from what is already on disk.
+        """
+        media = message.video or message.document
+        file_size = getattr(media, 'file_size', 0) if media else 0
+        parallel = MAX_WORKERS > 1 and file_size >= PARALLEL_DOWNLOAD_MIN_SIZE
+        # Offsets of the ranges already written, kept across attempts
+        done = set()
+
+        async def attempt():
+            nonlocal message, media, parallel
+            try:
+                if parallel:
+                    try:
+                        return await self._download_ranges(
+                            client, media, file_size, file_name, done, progress, progress_args
+                        )
+                    except ParallelDownloadUnavailable as e:
+                        LOGGER.info(f"Parallel download not possible ({e}), using a single connection")
+                        parallel = False
+                        if os.path.exists(file_name):
+                            os.remove(file_name)
+                return await self._download_stream(
+                    client, message, file_name, file_size, progress, progress_args
+                )
+            except (FileReferenceExpired, FileReferenceInvalid):
+                # The reference went stale; the next attempt uses a freshly fetched message
+                message = await client.get_messages(message.chat.id, message.id)
+                media = message.video or message.document
+                raise
+
+        start_time = time.time()
+        try:
+            path = await retry_transfer(attempt, f"Download of {os.path.basename(file_name)}")
+        except BaseException:
+            self.download_stats['failed_downloads'] += 1
+            if os.path.exists(file_name):
+                os.remove(file_name)
+            raise
+
+        elapsed = time.time() - start_time
+        self.download_stats['total_downloads'] += 1
+        self.download_stats['total_size'] += file_size
+        LOGGER.info(
+            f"Downloaded {humanbytes(file_size)} in {TimeFormatter(int(elapsed * 1000))} "
+            f"({humanbytes(int(file_size / max(elapsed, 0.001)))}/s)"
+            f"{f' over {MAX_WORKERS} connections' if parallel else ''}"
+        )
+        return path
+
+    async def _download_ranges(self, client: Client, media, file_size: int, file_name: str, done: set,
+                               progress: Optional[Callable], progress_args: tuple) -> str:
+        file_id = FileId.decode(media.file_id)
+        if file_id.file_type in (FileType.PHOTO, FileType.CHAT_PHOTO):
+            raise ParallelDownloadUnavailable("not a document")
+        location = raw.types.InputDocumentFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+
+        request_size = self._request_size()
+        # Ranges already on disk are kept when the file is still the one preallocated
+        resume = bool(done) and os.path.exists(file_name) and os.path.getsize(file_name) == file_size
+        if not resume:
+            done.clear()
+        queue = asyncio.Queue()
+        for offset in range(0, file_size, request_size):
+            if offset not in done:
+                queue.put_nowait(offset)
+        received = sum(min(request_size, file_size - offset) for offset in done)
+        if resume:
+            LOGGER.info(f"Resuming {file_name} at {humanbytes(received)} of {humanbytes(file_size)}")
+
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        fd = os.open(file_name, os.O_RDWR | os.O_CREAT | (0 if resume else os.O_TRUNC), 0o644)
+        sessions, tasks = [], []
+        try:
+            if not resume:
+                self._preallocate(fd, file_size)
+            if not queue.empty():
+                sessions = await open_media_sessions(client, file_id.dc_id, min(MAX_WORKERS, queue.qsize()))
+
+            async def worker(session):
+                nonlocal received
+                while not queue.empty():
+                    offset = queue.get_nowait()
+                    chunk = await self._fetch_range(session, location, offset, request_size)
+                    expected = min(request_size, file_size - offset)
+                    if len(chunk) != expected:
+                        raise IOError(f"Range at {offset} returned {len(chunk)} of {expected} bytes")
+                    await asyncio.to_thread(os.pwrite, fd, chunk, offset)
+                    done.add(offset)
+                    received += len(chunk)
+                    if progress:
+                        await progress(received, file_size, *progress_args)
+
+            tasks = [asyncio.create_task(worker(session)) for session in sessions]
+            await asyncio.gather(*tasks)
+        finally:
+            # One failed range stops the others before the file and sessions close
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            os.close(fd)
+            await close_media_sessions(sessions)
+
+        actual = os.path.getsize(file_name)
+        if received != file_size or actual != file_size:
+            done.clear()
+            raise IOError(f"Downloaded {received} bytes into a {actual} byte file, expected {file_size}")
+        return file_name
+
+    @staticmethod
+    async def _download_stream(client: Client, message: Message, file_name: str, file_size: int,
+                               progress: Optional[Callable], progress_args: tuple) -> str:
+        """One connection through stream_media, resuming after the last whole MB already on disk"""
+        offset = os.path.getsize(file_name) // MAX_REQUEST_SIZE if os.path.exists(file_name) else 0
+        received = offset * MAX_REQUEST_SIZE
+        if offset:
+            LOGGER.info(f"Resuming {file_name} at {humanbytes(received)} of {humanbytes(file_size)}")
+
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True)
+        async with aiofiles.open(file_name, 'r+b' if offset else 'wb') as f:
+            await f.seek(received)
+            await f.truncate()
+            async for chunk in client.stream_media(message, offset=offset):
+                await f.write(chunk)
+                received += len(chunk)
+                if progress:
+                    await progress(received, file_size, *progress_args)
+
+        actual = os.path.getsize(file_name)
+        if file_size and actual != file_size:
+            raise IOError(f"Downloaded {actual} bytes, expected {file_size}")
+        return file_name
+
+    @staticmethod
+    def _request_size() -> int:
+        """CHUNK_SIZE as a valid GetFile limit: a multiple of 4 KB that divides 1 MB"""
+        size = min(CHUNK_SIZE, MAX_REQUEST_SIZE)
+        if size < 4096 or MAX_REQUEST_SIZE % size:
+            return MAX_REQUEST_SIZE
+        return size
+
+    @staticmethod
+    def _preallocate(fd: int, size: int):
+        """Reserve the whole file up front so a full disk fails before the transfer"""
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+        os.ftruncate(fd, size)
+
+    @staticmethod
+    async def _fetch_range(session: Session, location, offset: int, limit: int) -> bytes:
+        attempt = 0
+        while True:
+            try:
+                r = await session.invoke(
+                    raw.functions.upload.GetFile(location=location, offset=offset, limit=limit),
+                    sleep_threshold=30
+                )
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+                continue
+            except BadRequest:
+                # Not transient, e.g. an expired file reference; left to the caller
+                raise
+            except Exception as e:
+                attempt += 1
+                if attempt >= RANGE_RETRIES:
+                    raise
+                LOGGER.warning(f"Range at {offset} failed ({e}), retrying")
+                await asyncio.sleep(transfer_backoff(attempt))
+                continue
+            if isinstance(r, raw.types.upload.FileCdnRedirect):
+                raise ParallelDownloadUnavailable("file is served from a CDN")
+            return r.bytes
+
     async def _update_progress(self, message: Message, current: int, total: int, filename: str):
         """Update download progress"""
         try:
@@ -0,0 +1,266 @@
+# bot/helper_funcs/encoders.py - Video encoder backends and ffmpeg capability detection
+
+import re
+import logging
+import subprocess
+from typing import Optional, Dict, List
+
+from bot import FFMPEG_THREADS
+
+LOGGER = logging.getLogger(__name__)
+
+# Speed names offered in the menus, slowest first; every backend maps all of them
+SPEED_PRESETS = ["veryslow", "slower", "slow", "medium", "fast", "faster", "veryfast", "ultrafast"]
+
+# Output extension and muxer options per container
+CONTAINERS = {
+    'mp4': {'extension': '.mp4', 'muxer_args': ["-movflags", "+faststart"]},
+    'webm': {'extension': '.webm', 'muxer_args': []},
+}
+
+ENCODER_LINE = re.compile(r"^\s*V[A-Z.]{5}\s+(\S+)")
+MUXER_LINE = re.compile(r"^\s*D?E\s+(\S+)")
+FILTER_LINE = re.compile(r"^\s*[A-Z.|]{2,3}\s+(\S+)\s+\S+->\S+")
+
+
+class EncoderBackend:
+    """
+    How to drive one ffmpeg video encoder: presets, rate control, threads
+    and tunes. CRF values from the menus are on the x264 scale and moved by
+    crf_offset onto the encoder's own scale.
+    """
+
+    def __init__(self, encoder: str, label: str, codec: str, description: str,
+                 presets: Dict[str, list], container: str = "mp4",
+                 params_option: Optional[str] = None, tunes: Optional[Dict[str, str]] = None,
+                 two_pass: bool = False, requires_filters: tuple = (), output_args: tuple = (),
+                 crf_offset: int = 0, max_crf: int = 51, telegram_inline: bool = True,
+                 pixel_formats: tuple = ("yuv420p", "yuv444p", "yuv420p10le")):
+        self.encoder = encoder
+        self.label = label
+        self.codec = codec
+        self.description = description
+        self.presets = presets
+        self.container = container
+        self.muxer = container
+        self.extension = CONTAINERS[container]['extension']
+        self.muxer_args = list(CONTAINERS[container]['muxer_args'])
+        self.params_option = params_option
+        self.tunes = tunes or {}
+        self.two_pass = two_pass
+        self.requires_filters = requires_filters
+        self.output_args = list(output_args)
+        self.crf_offset = crf_offset
+        self.max_crf = max_crf
+        self.telegram_inline = telegram_inline
+        self.pixel_formats = pixel_formats
+
+    def preset_args(self, speed: str) -> list:
+        """Encoder options for a speed name, medium when the name is unknown"""
+        return list(self.presets.get(speed, self.presets["medium"]))
+
+    def encoder_crf(self, crf: int) -> int:
+        return max(0, min(int(crf) + self.crf_offset, self.max_crf))
+
+    def rate_args(self, crf: int) -> list:
+        return ["-crf", str(self.encoder_crf(crf))]
+
+    def pixel_format(self, requested: str) -> str:
+        """The requested pixel format, or 8-bit 4:2:0 when the encoder lacks it"""
+        return requested if requested in self.pixel_formats else "yuv420p"
+
+    def thread_args(self, threads: int) -> list:
+        return ["-threads", str(threads)] if threads else []
+
+    def tune_args(self, content: str) -> list:
+        tune = self.tunes.get(content)
+        return ["-tune", tune] if tune else []
+
+    def two_pass_args(self, pass_no: int, passlog: str) -> list:
+        return ["-pass", str(pass_no), "-passlogfile", passlog]
+
+    def video_args(self, speed: str, threads: int = None) -> list:
+        """-c:v plus the preset, thread and container options, threads from the config by default"""
+        threads = FFMPEG_THREADS if threads is None else threads
+        return (
+            ["-c:v", self.encoder] + self.preset_args(speed)
+            + self.thread_args(threads) + self.output_args
+        )
+
+    def finalize(self, cmd: list) -> list:
+        """Merge repeated private parameter options (e.g. -x265-params) into one"""
+        if not self.params_option or cmd.count(self.params_option) < 2:
+            return cmd
+        merged, values, slot = [], [], None
+        args = iter(cmd)
+        for arg in args:
+            if arg != self.params_option:
+                merged.append(arg)
+                continue
+            if slot is None:
+                merged.extend([arg, ""])
+                slot = len(merged) - 1
+            values.append(next(args, ""))
+        merged[slot] = ":".join(v for v in values if v)
+        return merged
+
+
+class X265Backend(EncoderBackend):
+    """libx265 takes threads and pass settings through -x265-params"""
+
+    def thread_args(self, threads: int) -> list:
+        return ["-x265-params", f"pools={threads}"] if threads else []
+
+    def two_pass_args(self, pass_no: int, passlog: str) -> list:
+        return ["-x265-params", f"pass={pass_no}:stats={passlog}.log"]
+
+
+class SvtAv1Backend(EncoderBackend):
+    """libsvtav1 takes threads and film grain synthesis through -svtav1-params"""
+
+    def thread_args(self, threads: int) -> list:
+        return ["-svtav1-params", f"lp={threads}"] if threads else []
+
+    def tune_args(self, content: str) -> list:
+        # Grain is synthesised by the decoder instead of being spent bits on
+        if content == "grainy":
+            return ["-svtav1-params", "film-grain=8"]
+        return []
+
+
+class Vp9Backend(EncoderBackend):
+    """libvpx-vp9 needs -b:v 0 for constant quality"""
+
+    def rate_args(self, crf: int) -> list:
+        return ["-crf", str(self.encoder_crf(crf)), "-b:v", "0"]
+
+
+class EncoderRegistry:
+    """
+    Registered encoder backends plus what the installed ffmpeg supports.
+    Capabilities are read from ffmpeg once and cached for the process.
+    """
+
+    def __init__(self):
+        self.backends: Dict[str, EncoderBackend] = {}
+        self.encoders = None
+        self.muxers = None
+        self.filters = None
+
+    def register(self, backend: EncoderBackend):
+        self.backends[backend.encoder] = backend
+
+    @staticmethod
+    def _list(flag: str, pattern) -> Optional[set]:
+        try:
+            result = subprocess.run(
+                ["ffmpeg", "-hide_banner", flag],
+                capture_output=True, text=True, timeout=30
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            LOGGER.warning(f"Could not run ffmpeg {flag}: {e}")
+            return None
+        names = set()
+        for line in result.stdout.splitlines():
+            match = pattern.match(line)
+            if match:
+                names.update(match.group(1).split(','))
+        return names
+
+    def detect(self, force: bool = False):
+        """Read encoders, muxers and filters from ffmpeg; runs once unless forced"""
+        if self.encoders is not None and not force:
+            return
+        self.encoders = self._list("-encoders", ENCODER_LINE) or set()
+        self.muxers = self._list("-muxers", MUXER_LINE) or set()
+        self.filters = self._list("-filters", FILTER_LINE) or set()
+        available = [backend.encoder for backend in self.available()]
+        LOGGER.info(f"ffmpeg video encoders available: {', '.join(available) or 'none'}")
+
+    def has_filter(self, name: str) -> bool:
+        self.detect()
+        # Nothing detected means ffmpeg could not be asked; do not block anything
+        return not self.filters or name in self.filters
+
+    def is_available(self, backend: EncoderBackend) -> bool:
+        self.detect()
+        if not self.encoders:
+            return True
+        return (
+            backend.encoder in self.encoders
+            and backend.muxer in self.muxers
+            and all(self.has_filter(name) for name in backend.requires_filters)
+        )
+
+    def available(self) -> List[EncoderBackend]:
+        """Backends the installed ffmpeg can run, in registration order"""
+        return [backend for backend in self.backends.values() if self.is_available(backend)]
+
+    def get(self, encoder: str) -> EncoderBackend:
+        """Backend for an encoder name, falling back to the first available one"""
+        backend = self.backends.get(encoder)
+        if backend and self.is_available(backend):
+            return backend
+        fallback = (self.available() or list(self.backends.values()))[0]
+        if encoder != fallback.encoder:
+            LOGGER.warning(f"Encoder {encoder} is not available, using {fallback.encoder}")
+        return fallback
+
+    def for_codec(self, codec: str) -> Optional[EncoderBackend]:
+        """Available backend producing a codec such as 'h264', None when there is none"""
+        for backend in self.available():
+            if backend.codec == codec:
+                return backend
+        return None
+
+
+ENCODERS = EncoderRegistry()
+
+ENCODERS.register(EncoderBackend(
+    "libx264", "H.264 (libx264)", "h264", "Universal compatibility",
+    presets={speed: ["-preset", speed] for speed in SPEED_PRESETS},
+    tunes={'static': 'stillimage', 'animation': 'animation', 'grainy': 'grain', 'film': 'film'},
+    two_pass=True
+))
+ENCODERS.register(X265Backend(
+    "libx265", "H.265 (libx265)", "hevc", "Better compression, newer devices",
+    presets={speed: ["-preset", speed] for speed in SPEED_PRESETS},
+    params_option="-x265-params",
+    tunes={'animation': 'animation', 'grainy': 'grain'},
+    two_pass=True,
+    # Apple and Telegram players only accept HEVC in MP4 with the hvc1 tag
+    output_args=("-tag:v", "hvc1")
+))
+ENCODERS.register(SvtAv1Backend(
+    "libsvtav1", "AV1 (SVT-AV1)", "av1", "Smallest files, sent as a file",
+    presets={
+        "veryslow": ["-preset", "4"], "slower": ["-preset", "5"], "slow": ["-preset", "6"],
+        "medium": ["-preset", "8"], "fast": ["-preset", "9"], "faster": ["-preset", "10"],
+        "veryfast": ["-preset", "11"], "ultrafast": ["-preset", "12"]
+    },
+    params_option="-svtav1-params",
+    # SVT-AV1 CRF 35 looks roughly like x264 CRF 23
+    crf_offset=12, max_crf=63,
+    telegram_inline=False,
+    pixel_formats=("yuv420p", "yuv420p10le")
+))
+ENCODERS.register(Vp9Backend(
+    "libvpx-vp9", "VP9 (libvpx)", "vp9", "WebM output, sent as a file",
+    presets={
+        "veryslow": ["-deadline", "good", "-cpu-used", "1"],
+        "slower": ["-deadline", "good", "-cpu-used", "2"],
+        "slow": ["-deadline", "good", "-cpu-used", "3"],
+        "medium": ["-deadline", "good", "-cpu-used", "4"],
+        "fast": ["-deadline", "good", "-cpu-used", "5"],
+        "faster": ["-deadline", "realtime", "-cpu-used", "6"],
+        "veryfast": ["-deadline", "realtime", "-cpu-used", "7"],
+        "ultrafast": ["-deadline", "realtime", "-cpu-used", "8"]
+    },
+    container="webm",
+    two_pass=True,
+    # Row multithreading lets libvpx use more than one core per tile column
+    output_args=("-row-mt", "1"),
+    # VP9 CRF 33 looks roughly like x264 CRF 23
+    crf_offset=10, max_crf=63,
+    telegram_inline=False
+))
@@ -11,15 +11,26 @@ import re
 import json
 import subprocess
 import math
+import glob
+from fractions import Fraction
 from typing import Optional, Dict, Any
 
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from bot.helper_funcs.display_progress import TimeFormatter
+from bot.helper_funcs.display_progress import TimeFormatter, humanbytes
+from bot.helper_funcs.resource_limits import ResourceLimiter
+from bot.helper_funcs.watchdog import StallWatchdog, terminate_process
+from bot.helper_funcs.utils import LogRingBuffer
+from bot.helper_funcs.encoders import ENCODERS, EncoderBackend, CONTAINERS
 from bot.localisation import Localisation
 from bot import (
     FINISHED_PROGRESS_STR,
     UN_FINISHED_PROGRESS_STR,
-    DOWNLOAD_LOCATION
+    DOWNLOAD_LOCATION,
+    TIMEOUT_ENCODE,
+    FFMPEG_STALL_TIMEOUT,
+    FFMPEG_LOG_TAIL,
+    SIZE_ABORT_MARGIN,
+    SIZE_PROJECTION_MIN_PERCENT
 )
 
 logging.basicConfig(
@@ -29,23 +40,27 @@ logging.basicConfig(
 
 LOGGER = logging.getLogger(__name__)
 
-# Enhanced quality presets for button system compatibility
+# Quality presets offered by the button system
 QUALITY_PRESETS = {
-    '1080p': {'resolution': '1920x1080', 'crf': 18, 'preset': 'slow'},
-    '1080p_hevc': {'resolution': '1920x1080', 'crf': 20, 'preset': 'medium', 'codec': 'libx265'},
-    '720p': {'resolution': '1280x720', 'crf': 20, 'preset': 'medium'},
-    '720p_hevc': {'resolution': '1280x720', 'crf': 22, 'preset': 'medium', 'codec': 'libx265'},
-    '480p': {'resolution': '854x480', 'crf': 23, 'preset': 'fast'},
-    '480p_hevc': {'resolution': '854x480', 'crf': 25, 'preset': 'fast', 'codec': 'libx265'},
-    'custom': {'crf': 23, 'preset': 'medium'}
+    "1080p": {"resolution": "1920x1080", "crf": 18, "preset": "slow"},
+    "1080p_hevc": {"resolution": "1920x1080", "crf": 20, "preset": "medium", "codec": "libx265"},
+    "720p": {"resolution": "1280x720", "crf": 20, "preset": "medium"},
+    "720p_hevc": {"resolution": "1280x720", "crf": 22, "preset": "medium", "codec": "libx265"},
+    "480p": {"resolution": "854x480", "crf": 23, "preset": "fast", "max_fps": 30},
+    "480p_hevc": {"resolution": "854x480", "crf": 25, "preset": "fast", "codec": "libx265", "max_fps": 30},
+    "360p": {"resolution": "640x360", "crf": 25, "preset": "fast", "max_fps": 30},
 }
 
+# Settings used when no preset is picked
+CUSTOM_QUALITY = {"crf": 23, "preset": "medium"}
+
 async def convert_video(video_file, output_directory, total_time, bot, message, target_percentage, isAuto=False, bug=None):
     """Enhanced video conversion compatible with both old and new systems"""
     try:
         # Generate output filename
         out_put_file_name = os.path.join(output_directory, f"{int(time.time())}.mp4")
-        progress = os.path.join(output_directory, "progress.txt")
+        job = FFmpegJob(getattr(message, 'id', getattr(message, 'message_id', int(time.time()))))
+        progress = os.path.join(output_directory, f"progress_{job.job_id}.txt")
         
         with open(progress, 'w') as f:
             pass
@@ -54,7 +69,8 @@ async def convert_video(video_file, output_directory, total_time, bot, message,
         file_genertor_command = [
             "ffmpeg",
             "-hide_banner", 
-            "-loglevel", "quiet",
+            "-loglevel", "warning",
+            "-nostats",
             "-progress", progress,
             "-i", video_file
         ]
@@ -71,13 +87,11 @@ async def convert_video(video_file, output_directory, total_time, bot, message,
                     LOGGER.info(f"Using custom settings for user {user_id}")
                     
                     # Use custom settings from button system
-                    file_genertor_command.extend([
-                        "-c:v", session.video_codec,
-                        "-preset", session.preset,
-                        "-crf", str(session.crf),
-                        "-pix_fmt", session.pixel_format
-                    ])
-                    
+                    backend = ENCODERS.get(session.video_codec)
+                    file_genertor_command.extend(backend.video_args(session.preset))
+                    file_genertor_command.extend(backend.rate_args(session.crf))
+                    file_genertor_command.extend(["-pix_fmt", session.pixel_format])
+
                     # Add resolution if specified
                     if session.resolution and session.resolution != "original":
                         file_genertor_command.extend(["-s", session.resolution])
@@ -92,10 +106,8 @@ async def convert_video(video_file, output_directory, total_time, bot, message,
                         ])
                     
                     # Add optimization flags
-                    file_genertor_command.extend([
-                        "-movflags", "+faststart",
-                        "-tune", "film"
-                    ])
+                    file_genertor_command.extend(["-movflags", "+faststart"])
+                    file_genertor_command.extend(backend.tune_args("film"))
                     
                     target_percentage = f"{session.quality}_CRF{session.crf}"
                     
@@ -123,117 +135,77 @@ async def convert_video(video_file, output_directory, total_time, bot, message,
         
         # Start compression
         COMPRESSION_START_TIME = time.time()
-        
-        process = await asyncio.create_subprocess_exec(
-            *file_genertor_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        
-        LOGGER.info(f"FFmpeg process started: {process.pid}")
-        
-        # Update status file
         status = os.path.join(output_directory, "status.json")
-        try:
-            with open(status, 'r') as f:
-                statusMsg = json.load(f)
-        except:
-            statusMsg = {}
         
-        statusMsg['pid'] = process.pid
-        statusMsg['message'] = getattr(message, 'id', getattr(message, 'message_id', 0))
-        
-        with open(status, 'w') as f:
-            json.dump(statusMsg, f, indent=2)
+        async def write_status(process):
+            # Update status file
+            try:
+                with open(status, 'r') as f:
+                    statusMsg = json.load(f)
+            except:
+                statusMsg = {}
+            
+            statusMsg['pid'] = process.pid
+            statusMsg['message'] = getattr(message, 'id', getattr(message, 'message_id', 0))
+            
+            with open(status, 'w') as f:
+                json.dump(statusMsg, f, indent=2)
         
-        # Monitor progress
-        isDone = False
         last_percentage = 0
         
-        while process.returncode is None:
-            await asyncio.sleep(3)
+        async def show_progress(info):
+            nonlocal last_percentage
+            percentage = info['percentage']
+            elapsed_time = info['elapsed_time']
+            
+            # Update progress only if significant change
+            if abs(percentage - last_percentage) < 2 and percentage < 100:
+                return
+            last_percentage = percentage
+            
+            # Calculate ETA
+            if info['speed'] > 0:
+                difference = math.floor((total_time - elapsed_time) / info['speed'])
+                ETA = TimeFormatter(difference * 1000) if difference > 0 else "-"
+            else:
+                ETA = "-"
+            
+            execution_time = TimeFormatter((time.time() - COMPRESSION_START_TIME) * 1000)
+            
+            # Create progress bar
+            progress_str = "📊 **Progress:** {0}%\n[{1}{2}]".format(
+                round(percentage, 2),
+                ''.join([FINISHED_PROGRESS_STR for i in range(math.floor(percentage / 10))]),
+                ''.join([UN_FINISHED_PROGRESS_STR for i in range(10 - math.floor(percentage / 10))])
+            )
+            
+            stats = (
+                f'🎬 **Compressing** {target_percentage}\n\n'
+                f'⏰ **ETA:** {ETA}\n'
+                f'⏱️ **Elapsed:** {execution_time}\n\n'
+                f'{progress_str}'
+            )
             
             try:
-                if not os.path.exists(progress):
-                    continue
-                    
-                with open(progress, 'r') as file:
-                    text = file.read()
-                
-                frame = re.findall(r"frame=(\d+)", text)
-                time_in_us = re.findall(r"out_time_ms=(\d+)", text)
-                progress_match = re.findall(r"progress=(\w+)", text)
-                speed = re.findall(r"speed=([\d.]+)", text)
-                
-                if len(progress_match) and progress_match[-1] == "end":
-                    LOGGER.info("Compression completed")
-                    isDone = True
-                    break
-                
-                if len(time_in_us) and total_time > 0:
-                    elapsed_time = int(time_in_us[-1]) / 1000000
-                    percentage = min(math.floor(elapsed_time * 100 / total_time), 100)
-                    
-                    # Update progress only if significant change
-                    if abs(percentage - last_percentage) >= 2 or percentage >= 100:
-                        last_percentage = percentage
-                        
-                        # Calculate ETA
-                        if len(speed) and float(speed[-1]) > 0:
-                            difference = math.floor((total_time - elapsed_time) / float(speed[-1]))
-                            ETA = TimeFormatter(difference * 1000) if difference > 0 else "-"
-                        else:
-                            ETA = "-"
-                        
-                        execution_time = TimeFormatter((time.time() - COMPRESSION_START_TIME) * 1000)
-                        
-                        # Create progress bar
-                        progress_str = "📊 **Progress:** {0}%\n[{1}{2}]".format(
-                            round(percentage, 2),
-                            ''.join([FINISHED_PROGRESS_STR for i in range(math.floor(percentage / 10))]),
-                            ''.join([UN_FINISHED_PROGRESS_STR for i in range(10 - math.floor(percentage / 10))])
-                        )
-                        
-                        stats = (
-                            f'🎬 **Compressing** {target_percentage}\n\n'
-                            f'⏰ **ETA:** {ETA}\n'
-                            f'⏱️ **Elapsed:** {execution_time}\n\n'
-                            f'{progress_str}'
-                        )
-                        
-                        try:
-                            await message.edit_text(
-                                text=stats,
-                                reply_markup=InlineKeyboardMarkup([[
-                                    InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
-                                ]])
-                            )
-                        except:
-                            pass
-                        
-                        if bug:
-                            try:
-                                await bug.edit_text(text=stats)
-                            except:
-                                pass
-                
-            except Exception as e:
-                LOGGER.error(f"Progress monitoring error: {e}")
-                continue
-        
-        # Wait for process completion
-        stdout, stderr = await process.communicate()
-        
-        # Log output
-        if stderr:
-            e_response = stderr.decode().strip()
-            if e_response:
-                LOGGER.info(f"FFmpeg stderr: {e_response}")
+                await message.edit_text(
+                    text=stats,
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
+                    ]])
+                )
+            except:
+                pass
+            
+            if bug:
+                try:
+                    await bug.edit_text(text=stats)
+                except:
+                    pass
         
-        if stdout:
-            t_response = stdout.decode().strip()
-            if t_response:
-                LOGGER.info(f"FFmpeg stdout: {t_response}")
+        await run_ffmpeg(
+            file_genertor_command, job, progress, total_time,
+            on_progress=show_progress, on_start=write_status
+        )
         
         # Clean up
         try:
@@ -245,7 +217,12 @@ async def convert_video(video_file, output_directory, total_time, bot, message,
             pass
         
         # Check result
-        if os.path.exists(out_put_file_name) and os.path.getsize(out_put_file_name) > 0:
+        if job.failure_reason:
+            LOGGER.error(f"FFmpeg job {job.job_id} failed: {job.failure_reason}")
+            if os.path.exists(out_put_file_name):
+                os.remove(out_put_file_name)
+            return None
+        elif os.path.exists(out_put_file_name) and os.path.getsize(out_put_file_name) > 0:
             LOGGER.info(f"Compression successful: {out_put_file_name}")
             return out_put_file_name
         else:
@@ -256,16 +233,480 @@ async def convert_video(video_file, output_directory, total_time, bot, message,
         LOGGER.error(f"Video conversion error: {e}")
         return None
 
+class FFmpegJob:
+    """Runtime state of a single ffmpeg child"""
+    
+    def __init__(self, job_id, stage="encode", deadline=None):
+        self.job_id = str(job_id)
+        self.stage = stage
+        self.deadline = TIMEOUT_ENCODE if deadline is None else deadline
+        self.limiter = ResourceLimiter(self.job_id)
+        self.process = None
+        self.returncode = None
+        self.failure_reason = None
+        self.limit_exceeded = False
+        self.aborted = False
+        self.size_limit = None
+        self.projected_size = 0
+        self.size_exceeded = False
+        self.stalled = False
+        self.stdout_log = LogRingBuffer(FFMPEG_LOG_TAIL)
+        self.stderr_log = LogRingBuffer(FFMPEG_LOG_TAIL)
+        self.stderr_tail = ""
+        self.metrics = {}
+        # Index space reserved at the front of the output, written before any media
+        self.reserved_bytes = 0
+
+    def reset(self):
+        """Clear the outcome of a run so the job can be started again"""
+        self.process = None
+        self.returncode = None
+        self.failure_reason = None
+        self.limit_exceeded = False
+        self.aborted = False
+        self.projected_size = 0
+        self.size_exceeded = False
+        self.stalled = False
+        self.stdout_log = LogRingBuffer(FFMPEG_LOG_TAIL)
+        self.stderr_log = LogRingBuffer(FFMPEG_LOG_TAIL)
+        self.stderr_tail = ""
+
+def parse_progress(text: str, total_time) -> Optional[Dict[str, Any]]:
+    """Parse the latest values from an ffmpeg -progress file"""
+    frame = re.findall(r"frame=(\d+)", text)
+    time_in_us = re.findall(r"out_time_ms=(\d+)", text)
+    progress_match = re.findall(r"progress=(\w+)", text)
+    speed = re.findall(r"speed=([\d.]+)", text)
+    total_size = re.findall(r"total_size=(\d+)", text)
+    
+    if not (frame or time_in_us or progress_match):
+        return None
+    
+    elapsed_time = int(time_in_us[-1]) / 1000000 if time_in_us else 0
+    if total_time and total_time > 0:
+        percentage = min(math.floor(elapsed_time * 100 / total_time), 100)
+    else:
+        percentage = 0
+    
+    return {
+        'frame': int(frame[-1]) if frame else 0,
+        'elapsed_time': elapsed_time,
+        'percentage': percentage,
+        'speed': float(speed[-1]) if speed else 0.0,
+        'total_size': int(total_size[-1]) if total_size else 0,
+        'done': bool(progress_match) and progress_match[-1] == "end"
+    }
+
+def project_output_size(total_size: int, out_time: float, total_time, reserved: int = 0) -> int:
+    """
+    Extrapolate the final output size from the bytes written so far. The
+    reserved index space is already in total_size from the start, so only
+    the media bytes are scaled and the reservation is counted once.
+    """
+    if not total_size or not out_time or not total_time or out_time <= 0:
+        return 0
+    reserved = min(reserved, total_size)
+    return int((total_size - reserved) * total_time / out_time + reserved)
+
+def suggest_crf(crf: int, projected_size: int, size_limit: int) -> int:
+    """
+    CRF expected to bring projected_size under size_limit. Six CRF steps
+    roughly halve the bitrate for x264/x265, plus one step of headroom.
+    """
+    if not projected_size or not size_limit or projected_size <= size_limit:
+        return min(crf + 2, 51)
+    delta = math.ceil(6 * math.log2(projected_size / size_limit)) + 1
+    return min(crf + max(2, min(delta, 12)), 51)
+
+# Codecs MP4 carries that Telegram clients play without a transcode
+MP4_VIDEO_COPY = ('h264', 'hevc')
+MP4_AUDIO_COPY = ('aac', 'mp3')
+# Text subtitles can be converted to mov_text; bitmap ones cannot
+MP4_TEXT_SUBTITLES = ('mov_text', 'subrip', 'ass', 'ssa', 'webvtt', 'text')
+
+# What an encode's output container takes: audio it can copy, the audio
+# encoder it requires (None = the user's choice) and the format text
+# subtitles are converted to; containers not listed take every stream
+CONTAINER_STREAMS = {
+    'mp4': {'label': 'MP4', 'audio_copy': MP4_AUDIO_COPY, 'audio_encoder': None, 'subtitle_codec': 'mov_text'},
+    'webm': {'label': 'WebM', 'audio_copy': ('opus', 'vorbis'), 'audio_encoder': 'libopus', 'subtitle_codec': 'webvtt'},
+}
+
+# Content analysis thresholds: share of duplicate frames for static content,
+# PSNR against a denoised copy below which a source counts as grainy, and
+# normalized luma entropy below which flat-shaded animation is assumed
+STATIC_DUP_RATIO = 0.5
+GRAIN_NOISE_PSNR = 36.0
+ANIMATION_ENTROPY = 0.6
+
+# Smallest share of the picture a crop must remove to be applied
+CROP_MIN_SAVING = 0.02
+
+# Container overhead kept in reserve when sizing for a target
+MUX_OVERHEAD = 0.03
+
+# MP4 index space reserved with -moov_size: bytes per video sample (size,
+# sync and chunk entries), plus a composition offset (ctts) per sample when
+# B-frames reorder them and a duration (stts) per sample when the frame
+# rate is variable, per audio frame, a fixed base for headers and metadata,
+# and the margin over the estimate. Above the cap the +faststart rewrite
+# is used instead.
+MOOV_VIDEO_SAMPLE_BYTES = 16
+MOOV_CTTS_BYTES = 8
+MOOV_STTS_BYTES = 8
+MOOV_AUDIO_FRAME_BYTES = 8
+MOOV_BASE_BYTES = 64 * 1024
+MOOV_MARGIN = 1.3
+MOOV_MAX_BYTES = 64 * 1024 * 1024
+MOOV_TOO_SMALL = "reserved_moov_size is too small"
+
+# How far past a part boundary a keyframe is looked for
+CHUNK_KEYFRAME_SEARCH = 30
+
+# Share of the input after which a job counts as flushing and writing its trailer
+FINALIZE_FRACTION = 0.99
+
+# Encoder profile names for the ffprobe profiles a smart cut can re-encode edges in
+EDGE_PROFILES = {
+    'h264': {
+        'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main',
+        'High': 'high', 'High 10': 'high10', 'High 4:2:2': 'high422', 'High 4:4:4 Predictive': 'high444'
+    },
+    'hevc': {'Main': 'main', 'Main 10': 'main10'},
+}
+# Stream fields a re-encoded edge must share with the copied middle
+EDGE_MATCH_FIELDS = ('profile', 'level', 'pix_fmt', 'width', 'height')
+
+def parse_bitrate(value) -> int:
+    """Convert an ffmpeg bitrate string such as '128k' or '2M' to bits per second"""
+    if value is None:
+        return 0
+    value = str(value).strip().lower()
+    multipliers = {'k': 1000, 'm': 1000000}
+    try:
+        if value and value[-1] in multipliers:
+            return int(float(value[:-1]) * multipliers[value[-1]])
+        return int(float(value))
+    except ValueError:
+        return 0
+
+def target_video_bitrate(target_size: int, duration, audio_bitrate="128k") -> int:
+    """Video bitrate in bits per second that lands the output at target_size"""
+    if not target_size or not duration or duration <= 0:
+        return 0
+    total_bps = target_size * 8 * (1 - MUX_OVERHEAD) / duration
+    video_bps = total_bps - parse_bitrate(audio_bitrate)
+    # Below this the picture falls apart; let the size check report the miss
+    return int(max(video_bps, 100000))
+
+def expected_output_size(video_bps: int, duration, audio_bitrate="128k") -> int:
+    """Size in bytes a bitrate-controlled encode is expected to produce"""
+    if not video_bps or not duration:
+        return 0
+    return int((video_bps + parse_bitrate(audio_bitrate)) * duration / 8 / (1 - MUX_OVERHEAD))
+
+def two_pass_args(codec: str, pass_no: int, passlog: str) -> list:
+    """Encoder arguments for one pass of a two-pass encode sharing passlog stats"""
+    return ENCODERS.get(codec).two_pass_args(pass_no, passlog)
+
+def pass_stats_exist(passlog: str) -> bool:
+    """Whether a first pass already left usable stats for passlog"""
+    return any(
+        os.path.exists(passlog + suffix) and os.path.getsize(passlog + suffix) > 0
+        for suffix in ("-0.log", ".log")
+    )
+
+def stream_is_vfr(stream: Dict[str, Any]) -> bool:
+    """Whether a video stream's average rate differs from its base rate"""
+    try:
+        return Fraction(stream.get('avg_frame_rate') or "0/1") != Fraction(stream.get('r_frame_rate') or "0/1")
+    except (ValueError, ZeroDivisionError):
+        return True
+
+def estimate_moov_size(probe: Optional[Dict[str, Any]], duration=None,
+                       b_frames: Optional[bool] = None, vfr: Optional[bool] = None) -> Optional[int]:
+    """
+    Bytes to reserve at the front of an MP4 for its index, from the frame
+    counts in the probe scaled to duration seconds (the whole source by
+    default). b_frames and vfr describe the output's video; left as None
+    they are read from the probe, as for a stream copy. None when the probe
+    does not say enough or the index would be too large to reserve.
+    """
+    if not probe:
+        return None
+    try:
+        source_duration = float(probe.get('format', {}).get('duration') or 0)
+    except (TypeError, ValueError):
+        return None
+    if source_duration <= 0:
+        return None
+    duration = min(float(duration or source_duration), source_duration)
+
+    size = 0
+    for stream in probe.get('streams', []):
+        kind = stream.get('codec_type')
+        if kind == 'video' and not stream.get('disposition', {}).get('attached_pic'):
+            frames = int(stream.get('nb_frames') or 0) * duration / source_duration
+            if not frames:
+                rate = source_frame_rate({'streams': [stream]})
+                if not rate:
+                    return None
+                frames = float(rate) * duration
+            reordered = int(stream.get('has_b_frames') or 0) > 0 if b_frames is None else b_frames
+            variable = stream_is_vfr(stream) if vfr is None else vfr
+            per_sample = MOOV_VIDEO_SAMPLE_BYTES
+            if reordered:
+                per_sample += MOOV_CTTS_BYTES
+            if variable:
+                per_sample += MOOV_STTS_BYTES
+            size += frames * per_sample
+        elif kind == 'audio':
+            # 1024 samples per frame is the shortest of the MP4 audio codecs
+            sample_rate = int(stream.get('sample_rate') or 48000)
+            size += sample_rate / 1024 * duration * MOOV_AUDIO_FRAME_BYTES
+
+    size = int((size + MOOV_BASE_BYTES) * MOOV_MARGIN)
+    return size if size <= MOOV_MAX_BYTES else None
+
+def mp4_index_args(probe: Optional[Dict[str, Any]], duration=None,
+                   b_frames: Optional[bool] = None, vfr: Optional[bool] = None) -> list:
+    """
+    Put the MP4 index in front: written in place into reserved space when
+    it can be estimated, otherwise moved there by the +faststart rewrite.
+    """
+    reserve = estimate_moov_size(probe, duration, b_frames, vfr)
+    if reserve:
+        return ["-moov_size", str(reserve)]
+    return ["-movflags", "+faststart"]
+
+def moov_reservation_failed(job: FFmpegJob) -> bool:
+    """Whether the run failed only because the reserved index space was too small"""
+    return bool(job.failure_reason) and not job.aborted and MOOV_TOO_SMALL in job.stderr_tail
+
+def reserved_index_bytes(cmd: list) -> int:
+    """Index space the first output of a command reserves with -moov_size, 0 for none"""
+    if "-moov_size" not in cmd:
+        return 0
+    try:
+        return int(cmd[cmd.index("-moov_size") + 1])
+    except (IndexError, ValueError):
+        return 0
+
+def faststart_fallback(cmd: list) -> list:
+    """The same command with every index reservation replaced by the +faststart rewrite"""
+    fallback = []
+    args = iter(cmd)
+    for arg in args:
+        if arg == "-moov_size":
+            next(args, None)
+            fallback.extend(["-movflags", "+faststart"])
+        else:
+            fallback.append(arg)
+    return fallback
+
+def command_outputs(cmd: list) -> list:
+    """Output paths of a command built with '-y <path>' before each output"""
+    return [cmd[i + 1] for i, arg in enumerate(cmd[:-1]) if arg == "-y"]
+
+def written_bytes(paths: list) -> int:
+    """Combined size of the outputs that exist so far"""
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+# Bytes per second the +faststart rewrite has been seen to move, averaged over jobs
+_index_rewrite_rate = None
+
+def record_index_rewrite(size: int, seconds: float):
+    """Remember how fast a +faststart rewrite of size bytes went"""
+    global _index_rewrite_rate
+    if size <= 0 or not seconds or seconds <= 0:
+        return
+    rate = size / seconds
+    _index_rewrite_rate = rate if _index_rewrite_rate is None else 0.7 * _index_rewrite_rate + 0.3 * rate
+
+def index_rewrite_estimate(size: int) -> Optional[float]:
+    """Seconds a +faststart rewrite of size bytes would take, None before one was seen"""
+    if not _index_rewrite_rate:
+        return None
+    return size / _index_rewrite_rate
+
+def record_index_metrics(cmd: list, job: FFmpegJob):
+    """Note in job.metrics how the MP4 index was placed and the rewrite time saved or spent"""
+    if job.failure_reason:
+        return
+    outputs = [path for path in command_outputs(cmd) if path.endswith(".mp4") and os.path.exists(path)]
+    if not outputs:
+        return
+    size = sum(os.path.getsize(path) for path in outputs)
+    if "-moov_size" in cmd:
+        job.metrics['index'] = "reserved"
+        job.metrics['rewrite_avoided_bytes'] = size
+        saved = index_rewrite_estimate(size)
+        if saved is not None:
+            job.metrics['rewrite_saved_seconds'] = round(saved, 1)
+    elif "+faststart" in cmd:
+        job.metrics.setdefault('index', "faststart")
+        job.metrics['rewrite_bytes'] = size
+        record_index_rewrite(size, job.metrics.get('finalize_seconds'))
+
+async def _stop_job(job: FFmpegJob, reason: str):
+    """Mark the job failed and terminate, then kill, its ffmpeg child"""
+    job.failure_reason = reason
+    job.aborted = True
+    LOGGER.warning(f"FFmpeg job {job.job_id}: {reason}, terminating pid {job.process.pid}")
+    await terminate_process(job.process)
+
+async def run_ffmpeg(cmd, job: FFmpegJob, progress_file, total_time, on_progress=None, on_start=None, poll_interval=3):
+    """
+    Run ffmpeg under the job's resource limits and follow its progress file.
+    A watchdog stops the child when out_time, frame and the output size
+    stop advancing for FFMPEG_STALL_TIMEOUT seconds or the stage deadline
+    passes. Once out_time reaches the end of the input only the deadline
+    applies, since flushing and writing the trailer report nothing. When
+    job.size_limit is set the final size is projected from total_size and
+    the encode is aborted early once it would overshoot the limit.
+    Returns the exit code; job.failure_reason is set when the run failed.
+    """
+    job.limiter.prepare()
+    process = None
+    drainers = []
+    # When out_time last moved; what follows is flushing and writing the trailer
+    last_out_time, last_advance = -1, None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *job.limiter.wrap_command(cmd),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            preexec_fn=job.limiter.preexec(),
+            env=job.limiter.child_env()
+        )
+        job.process = process
+        LOGGER.info(f"FFmpeg process started: {process.pid}")
+        
+        # Drain both pipes concurrently so ffmpeg never blocks on a full pipe
+        drainers = [
+            asyncio.create_task(job.stdout_log.drain(process.stdout)),
+            asyncio.create_task(job.stderr_log.drain(process.stderr))
+        ]
+        
+        if on_start:
+            try:
+                await on_start(process)
+            except Exception as e:
+                LOGGER.error(f"FFmpeg start hook error: {e}")
+        
+        watchdog = StallWatchdog(FFMPEG_STALL_TIMEOUT, job.deadline, job.stage)
+        outputs = command_outputs(cmd)
+        # ffmpeg's total_size is that of the first output, reservation included
+        job.reserved_bytes = reserved_index_bytes(cmd)
+        
+        # Monitor progress
+        while process.returncode is None:
+            await asyncio.sleep(poll_interval)
+            
+            try:
+                info = None
+                if os.path.exists(progress_file):
+                    with open(progress_file, 'r') as file:
+                        info = parse_progress(file.read(), total_time)
+                
+                if info is not None:
+                    watchdog.feed(info['elapsed_time'], info['frame'], written_bytes(outputs))
+                    if total_time and info['elapsed_time'] >= total_time * FINALIZE_FRACTION:
+                        watchdog.finalize()
+                    
+                    if not info['done'] and info['elapsed_time'] > last_out_time:
+                        last_out_time, last_advance = info['elapsed_time'], time.time()
+                    
+                    if info['done']:
+                        LOGGER.info("Compression completed")
+                        break
+                    
+                    info['projected_size'] = project_output_size(
+                        info['total_size'], info['elapsed_time'], total_time, job.reserved_bytes
+                    )
+                    job.projected_size = info['projected_size'] or job.projected_size
+                    
+                    if (job.size_limit and info['projected_size']
+                            and info['percentage'] >= SIZE_PROJECTION_MIN_PERCENT
+                            and info['projected_size'] > job.size_limit * SIZE_ABORT_MARGIN):
+                        job.size_exceeded = True
+                        await _stop_job(
+                            job,
+                            f"Projected output {humanbytes(info['projected_size'])} exceeds "
+                            f"the {humanbytes(job.size_limit)} limit at {info['percentage']}%"
+                        )
+                        break
+                    
+                    if on_progress and total_time and total_time > 0:
+                        await on_progress(info)
+                
+            except Exception as e:
+                LOGGER.error(f"Progress monitoring error: {e}")
+            
+            stall_reason = watchdog.check()
+            if stall_reason and process.returncode is None:
+                job.stalled = True
+                await _stop_job(job, stall_reason)
+                break
+        
+        # Wait for process completion, still bounded by the stage deadline
+        try:
+            await asyncio.wait_for(
+                process.wait(),
+                timeout=None if job.aborted else watchdog.remaining()
+            )
+        except asyncio.TimeoutError:
+            await _stop_job(job, watchdog.check() or f"{job.stage.capitalize()} deadline exceeded")
+        job.returncode = process.returncode
+        if last_advance:
+            job.metrics['finalize_seconds'] = round(time.time() - last_advance, 1)
+        
+        # Pipes close when ffmpeg exits; collect whatever is left in them
+        try:
+            await asyncio.wait_for(asyncio.gather(*drainers, return_exceptions=True), timeout=5)
+        except asyncio.TimeoutError:
+            pass
+        
+        job.stderr_tail = job.stderr_log.tail()
+        if job.returncode and job.stderr_tail:
+            LOGGER.warning(f"FFmpeg job {job.job_id} stderr tail:\n{job.stderr_log.tail(4000)}")
+        elif job.stderr_tail:
+            LOGGER.debug(f"FFmpeg job {job.job_id} stderr:\n{job.stderr_log.tail(4000)}")
+        
+        if job.aborted:
+            return process.returncode
+        
+        limit_reason = job.limiter.classify_exit(process.returncode, job.stderr_tail)
+        if limit_reason:
+            job.limit_exceeded = True
+            job.failure_reason = limit_reason
+            LOGGER.warning(f"FFmpeg job {job.job_id} stopped by resource limits: {limit_reason}")
+        elif process.returncode:
+            job.failure_reason = f"FFmpeg exited with code {process.returncode}"
+        
+        return process.returncode
+        
+    finally:
+        # Never leave an orphaned encoder holding a slot, e.g. on cancellation
+        if process is not None and process.returncode is None:
+            await terminate_process(process)
+        for task in drainers:
+            if not task.done():
+                task.cancel()
+        job.limiter.release()
+
 async def use_legacy_compression(file_genertor_command, video_file, target_percentage, total_time, isAuto, out_put_file_name):
     """Handle legacy compression for backward compatibility"""
     
     # Default legacy settings with improvements
-    file_genertor_command.extend([
-        "-c:v", "libx264",  # Fixed: was "h264" 
-        "-preset", "medium",  # Improved: was "ultrafast"
-        "-tune", "film",
-        "-c:a", "copy"
-    ])
+    file_genertor_command.extend(ENCODERS.get("libx264").video_args("medium"))
+    file_genertor_command.extend(["-tune", "film", "-c:a", "copy"])
     
     # Handle percentage-based compression (legacy mode)
     if not isAuto and isinstance(target_percentage, (int, float)):
@@ -298,6 +739,88 @@ async def use_legacy_compression(file_genertor_command, video_file, target_perce
         file_genertor_command.extend(["-crf", "23"])
         target_percentage = 'auto_CRF23'
 
+def segment_format_options(extension: str) -> list:
+    """
+    Part muxer options for the segment muxer, taken from the container's own
+    muxer arguments. Only MP4/MOV understand movflags; passing it to another
+    muxer makes the segment muxer fail.
+    """
+    if extension.lower() == ".mov":
+        extension = ".mp4"
+    container = next((c for c in CONTAINERS.values() if c['extension'] == extension.lower()), None)
+    args = container['muxer_args'] if container else []
+    options = ":".join(f"{key.lstrip('-')}={value}" for key, value in zip(args[::2], args[1::2]))
+    return ["-segment_format_options", options] if options else []
+
+def initial_segment_time(total_time: float, size: int, max_part_size: int) -> float:
+    """Segment length for a first split; parts only close on the next keyframe, so aim below the cap"""
+    return total_time * max_part_size * 0.9 / size
+
+def shorter_segment_time(segment_time: float, largest: int, max_part_size: int) -> float:
+    """Segment length for a retry after a dense stretch made the largest part overflow"""
+    return segment_time * max_part_size * 0.95 / largest
+
+async def split_video(video_file, output_directory, max_part_size, total_time, attempts=3):
+    """
+    Split video_file into playable parts no larger than max_part_size using the
+    segment muxer with stream copy, so cuts land on keyframes and nothing is
+    re-encoded. Returns the ordered part paths, or None when splitting failed.
+    """
+    size = os.path.getsize(video_file)
+    if size <= max_part_size:
+        return [video_file]
+    if not total_time or total_time <= 0:
+        return None
+
+    base = os.path.splitext(os.path.basename(video_file))[0]
+    extension = os.path.splitext(video_file)[1] or ".mp4"
+    segment_time = initial_segment_time(total_time, size, max_part_size)
+
+    for attempt in range(attempts):
+        pattern = os.path.join(output_directory, f"{base}_part%03d{extension}")
+        job = FFmpegJob(f"split_{base}_{attempt}", stage="split")
+        progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+
+        cmd = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "warning",
+            "-nostats",
+            "-progress", progress_file,
+            "-i", video_file,
+            "-map", "0",
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_time", f"{segment_time:.3f}",
+            "-reset_timestamps", "1",
+            *segment_format_options(extension),
+            "-y", pattern
+        ]
+        LOGGER.info(f"FFmpeg split command: {' '.join(cmd)}")
+
+        await run_ffmpeg(cmd, job, progress_file, total_time)
+        if os.path.exists(progress_file):
+            os.remove(progress_file)
+
+        parts = sorted(glob.glob(os.path.join(output_directory, f"{base}_part[0-9][0-9][0-9]{extension}")))
+        if job.failure_reason or not parts:
+            LOGGER.error(f"Splitting {video_file} failed: {job.failure_reason}")
+            for part in parts:
+                os.remove(part)
+            return None
+
+        largest = max(os.path.getsize(part) for part in parts)
+        if largest <= max_part_size:
+            LOGGER.info(f"Split {video_file} into {len(parts)} parts")
+            return parts
+
+        # A dense stretch overflowed one part: shorten the segments and redo
+        for part in parts:
+            os.remove(part)
+        segment_time = shorter_segment_time(segment_time, largest, max_part_size)
+
+    return None
+
 async def media_info(saved_file_path):
     """Enhanced media info with better async handling"""
     try:
@@ -333,6 +856,794 @@ async def media_info(saved_file_path):
         LOGGER.error(f"Error getting media info: {e}")
         return None, None
 
+async def probe_media(video_file) -> Optional[Dict[str, Any]]:
+    """Stream and format details from ffprobe, None when the file cannot be probed"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffprobe', '-v', 'error',
+            '-show_streams', '-show_format',
+            '-of', 'json', video_file,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+
+        if process.returncode != 0:
+            LOGGER.error(f"ffprobe failed for {video_file}: {stderr.decode(errors='replace').strip()}")
+            return None
+
+        probe = json.loads(stdout.decode(errors='replace') or "{}")
+        probe.setdefault('streams', [])
+        probe.setdefault('format', {})
+        return probe
+
+    except Exception as e:
+        LOGGER.error(f"Error probing media: {e}")
+        return None
+
+def plan_mp4_remux(probe: Dict[str, Any], audio_bitrate="128k") -> Dict[str, Any]:
+    """
+    Map every usable stream of probe into MP4: copy what MP4 and Telegram
+    clients play as-is, transcode only the streams that cannot be copied.
+    Returns the ffmpeg output arguments and a list of the transcoded streams.
+    """
+    args = []
+    transcoded = []
+    out_index = {'video': 0, 'audio': 0, 'subtitle': 0}
+
+    for stream in probe.get('streams', []):
+        kind = stream.get('codec_type')
+        codec = stream.get('codec_name', 'unknown')
+        index = stream.get('index')
+
+        if kind not in out_index:
+            continue
+        # Cover art is carried as a one-frame video stream
+        if kind == 'video' and stream.get('disposition', {}).get('attached_pic'):
+            continue
+        if kind == 'subtitle' and codec not in MP4_TEXT_SUBTITLES:
+            LOGGER.info(f"Dropping {codec} subtitle stream {index}, it cannot be stored in MP4")
+            continue
+
+        n = out_index[kind]
+        spec = f"{kind[0]}:{n}"
+        args.extend(["-map", f"0:{index}"])
+
+        if kind == 'video':
+            if codec in MP4_VIDEO_COPY:
+                args.extend([f"-c:{spec}", "copy"])
+                if codec == 'hevc':
+                    # Apple and Telegram players only accept the hvc1 tag
+                    args.extend([f"-tag:{spec}", "hvc1"])
+            else:
+                backend = ENCODERS.get("libx264")
+                args.extend(
+                    [f"-c:{spec}", backend.encoder] + backend.preset_args("veryfast")
+                    + backend.rate_args(20) + [f"-pix_fmt:{spec}", "yuv420p"]
+                )
+                transcoded.append(f"video {codec} -> {backend.codec}")
+        elif kind == 'audio':
+            if codec in MP4_AUDIO_COPY:
+                args.extend([f"-c:{spec}", "copy"])
+            else:
+                args.extend([f"-c:{spec}", "aac", f"-b:{spec}", str(audio_bitrate)])
+                transcoded.append(f"audio {codec} -> aac")
+        else:
+            if codec == 'mov_text':
+                args.extend([f"-c:{spec}", "copy"])
+            else:
+                args.extend([f"-c:{spec}", "mov_text"])
+                transcoded.append(f"subtitle {codec} -> mov_text")
+
+        out_index[kind] += 1
+
+    return {'args': args, 'transcoded': transcoded, 'has_video': out_index['video'] > 0}
+
+def stream_bitrate(stream: Dict[str, Any]) -> int:
+    """Bitrate of one probed stream; Matroska only stores it in the BPS tag"""
+    tags = stream.get('tags', {})
+    for value in (stream.get('bit_rate'), tags.get('BPS'), tags.get('BPS-eng')):
+        bitrate = parse_bitrate(value)
+        if bitrate:
+            return bitrate
+    return 0
+
+def primary_stream(probe: Dict[str, Any], kind: str) -> Optional[Dict[str, Any]]:
+    """The stream of a kind ffmpeg would pick: the default-flagged one, else the first"""
+    streams = [
+        stream for stream in probe.get('streams', [])
+        if stream.get('codec_type') == kind
+        and not stream.get('disposition', {}).get('attached_pic')
+    ]
+    for stream in streams:
+        if stream.get('disposition', {}).get('default'):
+            return stream
+    return streams[0] if streams else None
+
+def plan_stream_mapping(probe: Dict[str, Any], audio_codec="aac", audio_bitrate="128k",
+                        container="mp4") -> Dict[str, Any]:
+    """
+    Decide per stream what an encode does with everything but the video.
+
+    The primary audio stream is copied when the container carries its codec
+    and it is already at or below the target bitrate, other audio tracks
+    are left out. Subtitles and attachments are kept when the container can
+    hold them. Returns the video map, the audio/subtitle/attachment output
+    arguments and the streams copied, transcoded and dropped.
+    """
+    plan = {'video_map': [], 'args': [], 'copied': [], 'transcoded': [], 'dropped': []}
+    rules = CONTAINER_STREAMS.get(container)
+    # A container with a fixed audio format overrides the chosen encoder
+    if rules and rules['audio_encoder'] and audio_codec != "copy":
+        audio_codec = rules['audio_encoder']
+
+    video = primary_stream(probe, 'video')
+    if video is not None:
+        plan['video_map'] = ["-map", f"0:{video['index']}"]
+
+    audio = primary_stream(probe, 'audio')
+    if audio is not None:
+        codec = audio.get('codec_name', 'unknown')
+        source_bps = stream_bitrate(audio)
+        fits = rules is None or codec in rules['audio_copy']
+        plan['args'].extend(["-map", f"0:{audio['index']}"])
+        if audio_codec == "copy" and fits:
+            plan['args'].extend(["-c:a:0", "copy"])
+            plan['copied'].append(f"audio {codec}")
+        elif fits and source_bps and source_bps <= parse_bitrate(audio_bitrate):
+            plan['args'].extend(["-c:a:0", "copy"])
+            plan['copied'].append(f"audio {codec} {source_bps // 1000}k")
+        else:
+            encoder = (rules['audio_encoder'] or "aac") if audio_codec == "copy" else audio_codec
+            plan['args'].extend(["-c:a:0", encoder, "-b:a:0", str(audio_bitrate)])
+            plan['transcoded'].append(f"audio {codec} -> {encoder}")
+
+    # Only the primary track is encoded, so the size budget covers one audio stream
+    for stream in probe.get('streams', []):
+        if stream.get('codec_type') == 'audio' and stream is not audio:
+            plan['dropped'].append(f"audio {stream.get('codec_name', 'unknown')}")
+
+    subtitle_index = 0
+    for stream in probe.get('streams', []):
+        kind = stream.get('codec_type')
+        codec = stream.get('codec_name', 'unknown')
+        if kind not in ('subtitle', 'attachment'):
+            continue
+
+        if rules is None:
+            plan['args'].extend(["-map", f"0:{stream['index']}"])
+            plan['copied'].append(f"{kind} {codec}")
+            continue
+        if kind == 'attachment' or codec not in MP4_TEXT_SUBTITLES:
+            plan['dropped'].append(f"{kind} {codec}")
+            continue
+
+        spec = f"s:{subtitle_index}"
+        target = rules['subtitle_codec']
+        plan['args'].extend(["-map", f"0:{stream['index']}"])
+        if codec == target:
+            plan['args'].extend([f"-c:{spec}", "copy"])
+            plan['copied'].append(f"subtitle {codec}")
+        else:
+            plan['args'].extend([f"-c:{spec}", target])
+            plan['transcoded'].append(f"subtitle {codec} -> {target}")
+        subtitle_index += 1
+
+    if rules is None:
+        plan['args'].extend(["-c:s", "copy", "-c:t", "copy"])
+
+    return plan
+
+def preflight_stream_plan(probe: Dict[str, Any], audio_codec="aac", mode="encode",
+                          container="mp4") -> Dict[str, Any]:
+    """
+    Check the planned stream mapping against the output container before an
+    encode is started. Problems that can be corrected are fixed in the
+    returned plan and listed in 'fixes'; 'error' is set when the source
+    cannot be processed at all. The output container is never switched:
+    audio it cannot carry is transcoded, since the container follows the
+    encoder and MP4 is what Telegram plays inline.
+    """
+    result = {'audio_codec': audio_codec, 'fixes': [], 'error': None}
+
+    if primary_stream(probe, 'video') is None:
+        result['error'] = "No video stream found in the file"
+        return result
+    rules = CONTAINER_STREAMS.get(container)
+    # Remux and smart cut pick copy or transcode per stream themselves
+    if mode != "encode" or rules is None:
+        return result
+
+    audio = primary_stream(probe, 'audio')
+    if audio is not None:
+        codec = audio.get('codec_name', 'unknown')
+        encoder = rules['audio_encoder'] or "aac"
+        if audio_codec == "copy" and codec not in rules['audio_copy']:
+            result['audio_codec'] = encoder
+            result['fixes'].append(
+                f"{codec} audio cannot be copied into {rules['label']}, converting it to {encoder}"
+            )
+        elif audio_codec != "copy" and rules['audio_encoder'] and audio_codec != rules['audio_encoder']:
+            result['fixes'].append(f"{rules['label']} carries {encoder} audio, using it instead of {audio_codec}")
+
+    extra_audio = sum(1 for stream in probe.get('streams', []) if stream.get('codec_type') == 'audio') - 1
+    if extra_audio > 0:
+        result['fixes'].append(f"Only the main audio track is kept, {extra_audio} other track(s) are left out")
+
+    dropped = sorted({
+        stream.get('codec_name', 'unknown') for stream in probe.get('streams', [])
+        if stream.get('codec_type') == 'subtitle'
+        and stream.get('codec_name') not in MP4_TEXT_SUBTITLES
+    })
+    if dropped:
+        result['fixes'].append(
+            f"{', '.join(dropped)} subtitles cannot be stored in {rules['label']} and are left out"
+        )
+
+    return result
+
+async def keyframe_times(video_file, start: float, end: float) -> list:
+    """Video keyframe timestamps between start and end, read from packets without decoding"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-read_intervals', f"{start}%{end}",
+            '-show_entries', 'packet=pts_time,flags',
+            '-of', 'csv=p=0', video_file,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, _ = await process.communicate()
+    except Exception as e:
+        LOGGER.error(f"Error reading keyframes: {e}")
+        return []
+
+    times = []
+    for line in stdout.decode(errors='replace').splitlines():
+        pts, _, flags = line.partition(',')
+        if 'K' not in flags:
+            continue
+        try:
+            pts = float(pts)
+        except ValueError:
+            continue
+        if start <= pts <= end:
+            times.append(pts)
+    return sorted(set(times))
+
+async def chunk_ranges(video_file, start: float, end: float, chunk_seconds: float) -> list:
+    """
+    (start, length) ranges of about chunk_seconds covering start to end,
+    each starting on the first keyframe at or after its nominal boundary so
+    every chunk seeks straight to a keyframe. A boundary without a keyframe
+    close by stays where it is; a last chunk shorter than a quarter is
+    folded into the one before it.
+    """
+    boundaries = [start]
+    nominal = start + chunk_seconds
+    while nominal < end - chunk_seconds / 4:
+        keyframes = await keyframe_times(video_file, nominal, min(nominal + CHUNK_KEYFRAME_SEARCH, end))
+        boundary = keyframes[0] if keyframes else nominal
+        if boundary >= end - chunk_seconds / 4:
+            break
+        boundaries.append(boundary)
+        nominal += chunk_seconds
+    boundaries.append(end)
+    return [(a, b - a) for a, b in zip(boundaries, boundaries[1:])]
+
+async def smart_cut(video_file, output_directory, start: float, end: float,
+                    audio_bitrate="128k", job_id=None, on_stage=None):
+    """
+    Cut [start, end) out of video_file into MP4. The span between the first
+    and last keyframe inside the range is stream-copied, only the partial
+    GOPs at both edges are re-encoded, so the cost follows the cut edges
+    rather than the source length. Returns (output, job); output is None on
+    failure and job carries the reason.
+
+    An MP4 keeps one sample description, taken from the first segment, and
+    many hardware decoders ignore parameter sets that change in-band. Edges
+    are therefore encoded with the source's profile, level and references
+    and checked against it; when they differ the whole range is re-encoded.
+    """
+    job_id = job_id or f"cut_{int(time.time())}"
+    out_put_file_name = os.path.join(output_directory, f"{job_id}.mp4")
+    temp_files = []
+
+    probe = await probe_media(video_file)
+    video = next((st for st in (probe or {}).get('streams', []) if st.get('codec_type') == 'video'), None)
+    audio = next((st for st in (probe or {}).get('streams', []) if st.get('codec_type') == 'audio'), None)
+    if not video:
+        job = FFmpegJob(job_id, stage="cut")
+        job.failure_reason = "No video stream found to cut"
+        return None, job
+
+    codec = video.get('codec_name')
+    # Only edges encoded with the source codec can be spliced back onto copied packets
+    encoder = ENCODERS.for_codec(codec) if codec in ('h264', 'hevc') else None
+    edge_args = edge_encoder_args(encoder, video) if encoder else None
+    if encoder and edge_args is None:
+        LOGGER.info(f"Cut edges cannot reproduce the {video.get('profile')} {codec} source, re-encoding the range")
+        encoder = None
+    keyframes = await keyframe_times(video_file, start, end) if encoder else []
+    # Keyframes too close to an edge would only leave a sliver to copy
+    inner = [k for k in keyframes if k < end - 0.5]
+    first_key = inner[0] if inner else None
+    last_key = inner[-1] if inner else None
+    spliced = first_key is not None and last_key > first_key
+
+    async def step(name, cmd, duration):
+        job = FFmpegJob(f"{job_id}_{name}", stage="cut")
+        progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+        cmd = cmd[:1] + ["-hide_banner", "-loglevel", "warning", "-nostats", "-progress", progress_file] + cmd[1:]
+        LOGGER.info(f"FFmpeg cut command: {' '.join(cmd)}")
+        if on_stage:
+            await on_stage(name)
+        try:
+            await run_ffmpeg(cmd, job, progress_file, duration)
+        finally:
+            if os.path.exists(progress_file):
+                os.remove(progress_file)
+        return job
+
+    def edge_cmd(seek, duration, target):
+        return [
+            "ffmpeg", "-ss", f"{seek:.6f}", "-i", video_file, "-t", f"{duration:.6f}",
+            "-map", "0:v:0", "-an", "-sn",
+            "-c:v", encoder.encoder, *encoder.preset_args("veryfast"), *encoder.rate_args(18),
+            *edge_args, "-pix_fmt", video.get('pix_fmt') or "yuv420p",
+            "-bsf:v", f"{codec}_mp4toannexb", "-f", "mpegts", "-y", target
+        ]
+
+    async def encode_range():
+        video_part = os.path.join(output_directory, f"{job_id}_video.mp4")
+        temp_files.append(video_part)
+        job = await step("encode", [
+            "ffmpeg", "-ss", f"{start:.6f}", "-i", video_file, "-t", f"{end - start:.6f}",
+            "-map", "0:v:0", "-an", "-sn",
+            *ENCODERS.get("libx264").video_args("veryfast"), *ENCODERS.get("libx264").rate_args(18),
+            "-pix_fmt", "yuv420p",
+            "-y", video_part
+        ], end - start)
+        return [video_part], job
+
+    try:
+        if not spliced:
+            # Nothing to copy: the kept range is short or the codec cannot be spliced
+            segments, job = await encode_range()
+            if job.failure_reason:
+                return None, job
+        else:
+            segments = []
+            if first_key - start > 0.05:
+                head = os.path.join(output_directory, f"{job_id}_head.ts")
+                temp_files.append(head)
+                job = await step("head", edge_cmd(start, first_key - start, head), first_key - start)
+                if job.failure_reason:
+                    return None, job
+                segments.append(head)
+
+            middle = os.path.join(output_directory, f"{job_id}_middle.ts")
+            temp_files.append(middle)
+            # Seeking just past the keyframe still lands on it in copy mode
+            job = await step("copy", [
+                "ffmpeg", "-ss", f"{first_key + 0.001:.6f}", "-i", video_file,
+                "-t", f"{last_key - first_key:.6f}",
+                "-map", "0:v:0", "-an", "-sn", "-c:v", "copy",
+                "-bsf:v", f"{codec}_mp4toannexb", "-f", "mpegts", "-y", middle
+            ], last_key - first_key)
+            if job.failure_reason:
+                return None, job
+            segments.append(middle)
+
+            if end - last_key > 0.05:
+                tail = os.path.join(output_directory, f"{job_id}_tail.ts")
+                temp_files.append(tail)
+                job = await step("tail", edge_cmd(last_key, end - last_key, tail), end - last_key)
+                if job.failure_reason:
+                    return None, job
+                segments.append(tail)
+
+            edges = [segment for segment in segments if segment.endswith(("_head.ts", "_tail.ts"))]
+            for edge in edges:
+                if not await edge_matches_source(edge, video):
+                    spliced = False
+                    break
+            if not spliced:
+                segments, job = await encode_range()
+                if job.failure_reason:
+                    return None, job
+
+        concat_list = os.path.join(output_directory, f"{job_id}_concat.txt")
+        temp_files.append(concat_list)
+        with open(concat_list, 'w') as f:
+            for segment in segments:
+                f.write(f"file '{os.path.abspath(segment)}'\n")
+
+        # Audio is cut once from the source so the joins cannot leave gaps
+        cmd = [
+            "ffmpeg", "-f", "concat", "-safe", "0", "-i", concat_list,
+            "-ss", f"{start:.6f}", "-t", f"{end - start:.6f}", "-i", video_file,
+            "-map", "0:v:0", "-map", "1:a:0?", "-c:v", "copy"
+        ]
+        if spliced and codec == 'hevc':
+            cmd.extend(["-tag:v", "hvc1"])
+        if audio and audio.get('codec_name') in MP4_AUDIO_COPY:
+            cmd.extend(["-c:a", "copy"])
+        else:
+            cmd.extend(["-c:a", "aac", "-b:a", str(audio_bitrate)])
+        cmd.extend(["-movflags", "+faststart", "-y", out_put_file_name])
+
+        job = await step("join", cmd, end - start)
+        if job.failure_reason or not os.path.exists(out_put_file_name):
+            if os.path.exists(out_put_file_name):
+                os.remove(out_put_file_name)
+            job.failure_reason = job.failure_reason or "Cut output was not created"
+            return None, job
+
+        LOGGER.info(
+            f"Smart cut {start:.2f}-{end:.2f}s of {video_file}: "
+            f"{len(segments)} segment(s), copied from {first_key} to {last_key}"
+        )
+        return out_put_file_name, job
+
+    finally:
+        for temp_file in temp_files:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+def edge_encoder_args(encoder: EncoderBackend, video: Dict[str, Any]) -> Optional[list]:
+    """
+    Encoder options that give a cut edge the source's profile, level and
+    reference count, None when the source profile cannot be reproduced.
+    """
+    codec = video.get('codec_name')
+    profile = EDGE_PROFILES.get(codec, {}).get(video.get('profile'))
+    level = int(video.get('level') or 0)
+    if not profile or level <= 0:
+        return None
+    if codec == 'h264':
+        args = ["-profile:v", profile, "-level:v", f"{level / 10:g}"]
+        refs = int(video.get('refs') or 0)
+        if refs > 0:
+            args.extend(["-refs", str(refs)])
+        return args
+    # HEVC levels are stored as 30 times the level number
+    return ["-profile:v", profile, "-x265-params", f"level-idc={level / 30:g}"]
+
+async def edge_matches_source(edge_file, video: Dict[str, Any]) -> bool:
+    """Whether an encoded edge has the stream parameters of the source it is spliced onto"""
+    probe = await probe_media(edge_file)
+    edge = primary_stream(probe, 'video') if probe else None
+    if edge is None:
+        return False
+    fields = EDGE_MATCH_FIELDS + (('refs',) if video.get('codec_name') == 'h264' else ())
+    mismatched = [field for field in fields if edge.get(field) != video.get(field)]
+    if mismatched:
+        LOGGER.info(
+            f"Cut edge {edge_file} differs from the source in "
+            + ", ".join(f"{field} ({edge.get(field)} vs {video.get(field)})" for field in mismatched)
+        )
+    return not mismatched
+
+def parse_quality_scores(text: str) -> Optional[Dict[str, float]]:
+    """Read the summary lines the ssim and psnr filters print when they finish"""
+    ssim = re.findall(r"SSIM .*?All:\s*([\d.]+)", text)
+    psnr = re.findall(r"PSNR .*?average:\s*([\d.]+|inf)", text)
+    if not ssim:
+        return None
+    return {
+        'ssim': float(ssim[-1]),
+        'psnr': float(psnr[-1]) if psnr else 0.0
+    }
+
+async def measure_quality(distorted, reference, start: float, length: float, job_id, output_directory,
+                          reference_filters: list = None):
+    """
+    Score an encoded sample against the same window of the source with the
+    ssim and psnr filters. reference_filters (crop, frame-rate cap,
+    decimation) are applied to the source so it shows the same picture and
+    frames as the encode; it is then scaled to the sample's size, so encodes
+    with a lower resolution are compared like for like.
+    """
+    job = FFmpegJob(job_id, stage="score")
+    source = f"[1:v]{','.join(reference_filters)}[src];[src]" if reference_filters else "[1:v]"
+    progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "info",
+        "-nostats",
+        "-progress", progress_file,
+        "-i", distorted,
+        "-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", reference,
+        "-lavfi",
+        f"{source}[0:v]scale2ref=flags=bicubic[ref][enc];"
+        "[enc]split[e1][e2];[ref]split[r1][r2];"
+        "[e1][r1]ssim;[e2][r2]psnr",
+        "-f", "null", "-"
+    ]
+
+    try:
+        await run_ffmpeg(cmd, job, progress_file, length)
+    finally:
+        if os.path.exists(progress_file):
+            os.remove(progress_file)
+
+    if job.failure_reason:
+        LOGGER.error(f"Quality measurement {job.job_id} failed: {job.failure_reason}")
+        return None
+    return parse_quality_scores(job.stderr_tail)
+
+def source_frame_rate(probe: Optional[Dict[str, Any]]) -> Optional[Fraction]:
+    """
+    Frame rate of the first video stream. r_frame_rate is preferred; the
+    average rate is used when r_frame_rate is a timebase-like value from a
+    variable frame rate stream.
+    """
+    for stream in (probe or {}).get('streams', []):
+        if stream.get('codec_type') != 'video' or stream.get('disposition', {}).get('attached_pic'):
+            continue
+        for key in ('r_frame_rate', 'avg_frame_rate'):
+            try:
+                rate = Fraction(stream.get(key) or "0/0")
+            except (ValueError, ZeroDivisionError):
+                continue
+            if 0 < rate <= 240:
+                return rate
+        return None
+    return None
+
+def capped_frame_rate(source_fps: Optional[Fraction], max_fps) -> Optional[str]:
+    """
+    Output rate for a source above max_fps, None when no cap applies. The
+    source rate is divided by a whole number, so 60 becomes 30 and 50 becomes
+    25: every kept frame is an original frame at an even spacing. When that
+    would land far below the cap (30 under a 25 cap) the cap itself is used.
+    """
+    if not source_fps or not max_fps or source_fps <= max_fps:
+        return None
+    target = source_fps / math.ceil(source_fps / max_fps)
+    if target < Fraction(max_fps) * 2 / 3:
+        target = Fraction(max_fps)
+    return f"{target.numerator}/{target.denominator}"
+
+def classify_scores(dup_ratio: float, entropy: Optional[float], noise_psnr: Optional[float]) -> str:
+    """Map the content measurements to static, animation, grainy or film"""
+    if dup_ratio >= STATIC_DUP_RATIO:
+        return "static"
+    if noise_psnr is not None and noise_psnr < GRAIN_NOISE_PSNR:
+        return "grainy"
+    if entropy is not None and entropy < ANIMATION_ENTROPY:
+        return "animation"
+    return "film"
+
+async def classify_content(video_file, output_directory, start: float, length: float, job_id=None) -> Dict[str, Any]:
+    """
+    Cheap analysis of one sample window, run as two parallel passes:
+    mpdecimate counts how many frames are near-duplicates, and a second
+    pass measures picture entropy and how much a light denoise changes the
+    picture (PSNR against hqdn3d, low means heavy grain or noise).
+    """
+    job_id = job_id or f"content_{int(time.time())}"
+    # The graphs read the first video stream; their output is the only one written
+    seek = ["-ss", f"{max(start, 0):.3f}", "-t", f"{length:.3f}", "-i", video_file]
+
+    async def measure(name, filters, loglevel):
+        job = FFmpegJob(f"{job_id}_{name}", stage="content analysis")
+        progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+        cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", loglevel, "-nostats",
+            "-progress", progress_file
+        ] + seek + ["-lavfi", filters, "-f", "null", "-"]
+        try:
+            await run_ffmpeg(cmd, job, progress_file, length)
+            info = None
+            if os.path.exists(progress_file):
+                with open(progress_file, 'r') as f:
+                    info = parse_progress(f.read(), length)
+        finally:
+            if os.path.exists(progress_file):
+                os.remove(progress_file)
+        if job.failure_reason:
+            return None, ""
+        return (info or {}).get('frame', 0), job.stderr_tail
+
+    (kept, _), (total, picture_log) = await asyncio.gather(
+        measure("decimate", "[0:v:0]mpdecimate", "warning"),
+        measure(
+            "picture",
+            "[0:v:0]split[o][d];[d]hqdn3d=4:3:6:4.5[dn];[o][dn]psnr,"
+            "entropy,metadata=mode=print:key=lavfi.entropy.normalized_entropy.normal.Y",
+            "info"
+        )
+    )
+
+    dup_ratio = 1 - kept / total if kept and total else 0.0
+    entropies = [float(v) for v in re.findall(r"normalized_entropy\.normal\.Y=([\d.]+)", picture_log)]
+    entropy = sum(entropies) / len(entropies) if entropies else None
+    psnr = re.findall(r"PSNR .*?average:\s*([\d.]+|inf)", picture_log)
+    noise_psnr = float(psnr[-1]) if psnr else None
+
+    profile = {
+        'type': classify_scores(dup_ratio, entropy, noise_psnr),
+        'dup_ratio': round(dup_ratio, 3),
+        'entropy': round(entropy, 3) if entropy is not None else None,
+        'noise_psnr': round(noise_psnr, 2) if noise_psnr is not None else None
+    }
+    LOGGER.info(f"Content analysis for {video_file}: {profile}")
+    return profile
+
+def content_encode_args(profile: Optional[Dict[str, Any]], codec: str, denoise: bool = False) -> Dict[str, list]:
+    """
+    Filters, encoder tune and output options for a content profile.
+    Static content drops duplicate frames and is written with a variable
+    frame rate; grainy content is tuned for grain, or lightly denoised and
+    tuned as film when denoise is on.
+    """
+    content = (profile or {}).get('type', 'film')
+    filters, output_args = [], []
+
+    if content == "static":
+        filters.append("mpdecimate")
+        output_args.extend(["-fps_mode", "vfr"])
+    elif content == "grainy" and denoise:
+        filters.append("hqdn3d=2:1.5:3:2.25")
+        content = "film"
+
+    output_args.extend(ENCODERS.get(codec).tune_args(content))
+    return {'filters': filters, 'output_args': output_args}
+
+def video_rotation(stream: Dict[str, Any]) -> int:
+    """Rotation in degrees from the display matrix side data or the legacy rotate tag"""
+    for side_data in stream.get('side_data_list', []) or []:
+        if 'rotation' in side_data:
+            try:
+                return int(float(side_data['rotation']))
+            except (TypeError, ValueError):
+                pass
+    try:
+        return int(stream.get('tags', {}).get('rotate', 0))
+    except (TypeError, ValueError):
+        return 0
+
+def sample_aspect_ratio(stream: Dict[str, Any]) -> Fraction:
+    """Pixel aspect ratio of a stream, 1 for square or unknown pixels"""
+    try:
+        sar = Fraction(str(stream.get('sample_aspect_ratio') or '1:1').replace(':', '/'))
+    except (ValueError, ZeroDivisionError):
+        return Fraction(1)
+    return sar if sar > 0 else Fraction(1)
+
+def display_dimensions(probe: Optional[Dict[str, Any]], apply_sar: bool = True) -> Optional[tuple]:
+    """
+    Width and height of the first video stream as it is shown: swapped for
+    90/270 degree rotation (ffmpeg rotates frames before any filter runs) and,
+    unless apply_sar is off, stretched by a non-square pixel aspect ratio.
+    """
+    for stream in (probe or {}).get('streams', []):
+        if stream.get('codec_type') != 'video' or stream.get('disposition', {}).get('attached_pic'):
+            continue
+        if not (stream.get('width') and stream.get('height')):
+            return None
+        width, height = int(stream['width']), int(stream['height'])
+        if apply_sar:
+            width = int(round(width * sample_aspect_ratio(stream)))
+        if abs(video_rotation(stream)) % 180 == 90:
+            width, height = height, width
+        return width, height
+    return None
+
+def parse_resolution(resolution) -> Optional[tuple]:
+    """'1280x720' -> (1280, 720), None for 'Original' or anything unparsable"""
+    try:
+        width, height = (int(v) for v in str(resolution).lower().split('x'))
+        return width, height
+    except ValueError:
+        return None
+
+def orient_box(source_size: tuple, box: tuple) -> tuple:
+    """Turn a landscape preset box portrait when the source is portrait"""
+    if (source_size[1] > source_size[0]) != (box[1] > box[0]):
+        return box[1], box[0]
+    return box
+
+def exceeds_source(source_size: Optional[tuple], resolution) -> bool:
+    """True when a preset is larger than the source on both axes, i.e. it could only upscale"""
+    box = parse_resolution(resolution)
+    if not source_size or not box:
+        return False
+    box_w, box_h = orient_box(source_size, box)
+    return box_w > source_size[0] and box_h > source_size[1]
+
+def fit_resolution(source_size: tuple, resolution) -> Optional[tuple]:
+    """
+    Output size for a source inside a preset box: aspect ratio kept, never
+    larger than the source, both sides even. The box follows the source
+    orientation, so a portrait 1080x1920 clip under '1280x720' becomes
+    720x1280 rather than a squashed landscape frame. None when the source
+    can be encoded at its own size.
+    """
+    box = parse_resolution(resolution)
+    if not box:
+        box = source_size
+    src_w, src_h = source_size
+    box_w, box_h = orient_box(source_size, box)
+
+    scale = min(box_w / src_w, box_h / src_h, 1)
+    width = max(int(src_w * scale) // 2 * 2, 2)
+    height = max(int(src_h * scale) // 2 * 2, 2)
+    if (width, height) == (src_w, src_h):
+        return None
+    return width, height
+
+def agree_crop(rects: list, width: int, height: int) -> Optional[str]:
+    """
+    Combine the crop rectangles found in several windows into one that is
+    safe for the whole video: their union, so no window loses picture to a
+    darker scene elsewhere. Returns an ffmpeg crop filter, or None when
+    cropping would not pay off.
+    """
+    # Fades and black scenes report tiny or empty rectangles
+    rects = [r for r in rects if r[0] >= width // 4 and r[1] >= height // 4]
+    if not rects:
+        return None
+
+    left = min(r[2] for r in rects)
+    top = min(r[3] for r in rects)
+    right = max(r[2] + r[0] for r in rects)
+    bottom = max(r[3] + r[1] for r in rects)
+    crop_w = (right - left) // 2 * 2
+    crop_h = (bottom - top) // 2 * 2
+
+    if crop_w * crop_h >= width * height * (1 - CROP_MIN_SAVING):
+        return None
+    return f"crop={crop_w}:{crop_h}:{left}:{top}"
+
+async def detect_crop(video_file, output_directory, start: float, length: float,
+                      windows: int = 3, window_length: float = 2, job_id=None) -> Optional[str]:
+    """Run cropdetect over a few short windows of [start, start + length) in parallel"""
+    probe = await probe_media(video_file)
+    # cropdetect sees rotated frames but storage pixels
+    dimensions = display_dimensions(probe, apply_sar=False)
+    if not dimensions:
+        return None
+    width, height = dimensions
+    job_id = job_id or f"crop_{int(time.time())}"
+    window_length = min(window_length, length)
+
+    async def detect(index):
+        seek = start + length * (index + 1) / (windows + 1) - window_length / 2
+        job = FFmpegJob(f"{job_id}_{index}", stage="crop detection")
+        progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+        cmd = [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel", "info",
+            "-nostats",
+            "-progress", progress_file,
+            "-ss", f"{max(seek, 0):.3f}", "-t", f"{window_length:.3f}",
+            "-i", video_file,
+            "-map", "0:v:0",
+            "-vf", "cropdetect=limit=24:round=2:reset=0",
+            "-f", "null", "-"
+        ]
+        try:
+            await run_ffmpeg(cmd, job, progress_file, window_length)
+        finally:
+            if os.path.exists(progress_file):
+                os.remove(progress_file)
+        if job.failure_reason:
+            return None
+        # With reset=0 the last report covers every frame of the window
+        found = re.findall(r"crop=(\d+):(\d+):(\d+):(\d+)", job.stderr_tail)
+        return tuple(int(v) for v in found[-1]) if found else None
+
+    results = await asyncio.gather(*(detect(i) for i in range(windows)))
+    crop = agree_crop([r for r in results if r], width, height)
+    LOGGER.info(f"Crop detection for {video_file} ({width}x{height}): {results} -> {crop}")
+    return crop
+
 async def take_screen_shot(video_file, output_directory, ttl):
     """Enhanced screenshot with better quality and error handling"""
     try:
@@ -380,7 +1691,7 @@ async def take_screen_shot(video_file, output_directory, ttl):
 # Additional helper function for button system compatibility
 def get_quality_preset(quality_name: str) -> Dict[str, Any]:
     """Get quality preset configuration"""
-    return QUALITY_PRESETS.get(quality_name, QUALITY_PRESETS['custom'])
+    return QUALITY_PRESETS.get(quality_name, CUSTOM_QUALITY)
 
 async def convert_video_with_custom_settings(video_file, output_directory, total_time, bot, message, session):
     """Convert video with custom settings from button system"""
@@ -398,6 +1709,28 @@ async def convert_video_with_custom_settings(video_file, output_directory, total
 # Export main functions
 __all__ = [
     'convert_video',
+    'run_ffmpeg',
+    'FFmpegJob',
+    'project_output_size',
+    'suggest_crf',
+    'target_video_bitrate',
+    'expected_output_size',
+    'two_pass_args',
+    'split_video',
+    'probe_media',
+    'plan_mp4_remux',
+    'plan_stream_mapping',
+    'preflight_stream_plan',
+    'smart_cut',
+    'measure_quality',
+    'detect_crop',
+    'source_frame_rate',
+    'capped_frame_rate',
+    'classify_content',
+    'display_dimensions',
+    'exceeds_source',
+    'fit_resolution',
+    'content_encode_args',
     'media_info', 
     'take_screen_shot',
     'convert_video_with_custom_settings',
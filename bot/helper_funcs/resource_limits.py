@@ -0,0 +1,260 @@
+# bot/helper_funcs/resource_limits.py - Per-job resource containment for ffmpeg
+
+import os
+import shutil
+import logging
+from typing import Optional, List, Dict, Callable
+
+try:
+    import resource
+    HAS_RESOURCE = True
+except ImportError:
+    HAS_RESOURCE = False
+
+try:
+    import psutil
+    HAS_PSUTIL = True
+except ImportError:
+    HAS_PSUTIL = False
+
+from bot import (
+    MAX_CONCURRENT_PROCESSES,
+    FFMPEG_MEMORY_LIMIT,
+    FFMPEG_CPU_WEIGHT,
+    FFMPEG_NICE,
+    FFMPEG_IONICE_CLASS,
+    FFMPEG_IONICE_LEVEL,
+    ENABLE_CGROUPS
+)
+from bot.helper_funcs.display_progress import humanbytes
+
+LOGGER = logging.getLogger(__name__)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+MIN_MEMORY_LIMIT = 512 * 1024 * 1024
+
+# RLIMIT_AS caps address space, not memory in use: thread stacks and the
+# frame pools of threaded x264/x265/SVT-AV1 reserve several times what they
+# touch, so an automatic limit is scaled up and floored when it is an rlimit
+ADDRESS_SPACE_FACTOR = 4
+MIN_ADDRESS_SPACE_LIMIT = 4 * 1024 * 1024 * 1024
+
+# What ffmpeg and its encoder libraries print when an allocation fails
+ENOMEM_MARKERS = ("Cannot allocate memory", "Out of memory", "out of memory", "std::bad_alloc")
+
+
+class ResourceLimiter:
+    """Runs a single ffmpeg child under memory, CPU and IO limits"""
+
+    # Parent cgroup shared by all jobs, resolved once per bot process
+    _cgroup_parent = None
+    _cgroup_checked = False
+
+    def __init__(self, job_id: str, memory_limit: int = 0):
+        self.job_id = str(job_id)
+        self.explicit_limit = bool(memory_limit or FFMPEG_MEMORY_LIMIT > 0)
+        self.memory_limit = memory_limit or self.default_memory_limit()
+        self.cgroup_path = None
+
+    @staticmethod
+    def default_memory_limit() -> int:
+        """
+        Memory cap for one job: configured value or a fair share of RAM.
+        The share is meant for cgroups, which count memory in use; see
+        address_space_limit for what is applied as an rlimit.
+        """
+        if FFMPEG_MEMORY_LIMIT > 0:
+            return FFMPEG_MEMORY_LIMIT
+
+        try:
+            if HAS_PSUTIL:
+                total = psutil.virtual_memory().total
+            else:
+                total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        except (ValueError, OSError):
+            return 0
+
+        # Leave a quarter of RAM for the bot itself and the page cache
+        share = int(total * 0.75 / max(MAX_CONCURRENT_PROCESSES, 1))
+        return max(share, MIN_MEMORY_LIMIT)
+
+    @classmethod
+    def _resolve_cgroup_parent(cls) -> Optional[str]:
+        """
+        Find a cgroup v2 directory we may create job groups in.
+
+        The bot is moved into its own ``bot`` leaf first so the parent has no
+        member processes and can delegate the memory and cpu controllers.
+        """
+        if cls._cgroup_checked:
+            return cls._cgroup_parent
+        cls._cgroup_checked = True
+
+        if not ENABLE_CGROUPS:
+            return None
+        if not os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+            LOGGER.info("cgroup v2 not available, using rlimits for ffmpeg jobs")
+            return None
+
+        try:
+            own = None
+            with open("/proc/self/cgroup", "r") as f:
+                for line in f:
+                    if line.startswith("0::"):
+                        own = line.strip()[3:]
+                        break
+            if own is None:
+                return None
+
+            parent = os.path.join(CGROUP_ROOT, own.lstrip("/"))
+            if os.path.basename(parent) == "bot":
+                parent = os.path.dirname(parent)
+            bot_leaf = os.path.join(parent, "bot")
+
+            os.makedirs(bot_leaf, exist_ok=True)
+            cls._write(os.path.join(bot_leaf, "cgroup.procs"), str(os.getpid()))
+            cls._write(os.path.join(parent, "cgroup.subtree_control"), "+memory +cpu")
+
+            cls._cgroup_parent = parent
+            LOGGER.info(f"Using cgroup v2 containment under {parent}")
+        except OSError as e:
+            LOGGER.info(f"cgroup delegation unavailable ({e}), using rlimits for ffmpeg jobs")
+            cls._cgroup_parent = None
+
+        return cls._cgroup_parent
+
+    @staticmethod
+    def _write(path: str, value: str):
+        with open(path, "w") as f:
+            f.write(value)
+
+    def prepare(self):
+        """Create the job's cgroup if containment via cgroups is possible"""
+        parent = self._resolve_cgroup_parent()
+        if not parent:
+            return
+
+        path = os.path.join(parent, f"ffmpeg-{self.job_id}")
+        try:
+            os.makedirs(path, exist_ok=True)
+            self.cgroup_path = path
+            if self.memory_limit:
+                self._write(os.path.join(path, "memory.max"), str(self.memory_limit))
+                try:
+                    self._write(os.path.join(path, "memory.swap.max"), "0")
+                except OSError:
+                    pass
+            # Kill every process of the job together on OOM, never the bot
+            try:
+                self._write(os.path.join(path, "memory.oom.group"), "1")
+            except OSError:
+                pass
+            self._write(os.path.join(path, "cpu.weight"), str(FFMPEG_CPU_WEIGHT))
+        except OSError as e:
+            LOGGER.warning(f"Could not create cgroup for job {self.job_id}: {e}")
+            self.release()
+
+    def wrap_command(self, cmd: List[str]) -> List[str]:
+        """Prefix the command with an ionice class when the tool is installed"""
+        if FFMPEG_IONICE_CLASS and shutil.which("ionice"):
+            return [
+                "ionice",
+                "-c", str(FFMPEG_IONICE_CLASS),
+                "-n", str(FFMPEG_IONICE_LEVEL),
+            ] + list(cmd)
+        return list(cmd)
+
+    def address_space_limit(self) -> int:
+        """
+        RLIMIT_AS value used when there is no cgroup. A configured limit is
+        applied as is; the automatic RAM share is scaled, since address space
+        reserved by encoder threads is far larger than what they use.
+        """
+        if not self.memory_limit or self.explicit_limit:
+            return self.memory_limit
+        return max(self.memory_limit * ADDRESS_SPACE_FACTOR, MIN_ADDRESS_SPACE_LIMIT)
+
+    def child_env(self) -> Optional[Dict[str, str]]:
+        """Environment for the child; caps malloc arenas when RLIMIT_AS is used"""
+        if self.cgroup_path or not self.memory_limit:
+            return None
+        env = dict(os.environ)
+        # Each glibc arena reserves address space that counts against RLIMIT_AS
+        env.setdefault("MALLOC_ARENA_MAX", "2")
+        return env
+
+    def preexec(self) -> Callable[[], None]:
+        """Build the function run in the child between fork and exec"""
+        cgroup_procs = os.path.join(self.cgroup_path, "cgroup.procs") if self.cgroup_path else None
+        memory_limit = self.address_space_limit()
+        nice = FFMPEG_NICE
+
+        def _apply():
+            if nice:
+                try:
+                    os.nice(nice)
+                except OSError:
+                    pass
+
+            if cgroup_procs:
+                try:
+                    with open(cgroup_procs, "w") as f:
+                        f.write(str(os.getpid()))
+                    return
+                except OSError:
+                    pass
+
+            if memory_limit and HAS_RESOURCE:
+                try:
+                    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+                except (ValueError, OSError):
+                    pass
+
+        return _apply
+
+    def _cgroup_oom_kills(self) -> int:
+        if not self.cgroup_path:
+            return 0
+        try:
+            with open(os.path.join(self.cgroup_path, "memory.events"), "r") as f:
+                for line in f:
+                    key, _, value = line.partition(" ")
+                    if key == "oom_kill":
+                        return int(value)
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    def classify_exit(self, returncode: Optional[int], stderr_text: str = "") -> Optional[str]:
+        """
+        Return a reason when the child was stopped by its resource limits,
+        None for ordinary exits so callers can report the two apart.
+
+        Only evidence counts: the cgroup's oom_kill counter, or an allocation
+        failure in stderr under RLIMIT_AS, which makes malloc fail rather than
+        sending a signal. Crashes and external kills (e.g. a cancel) stay
+        ordinary failures.
+        """
+        if returncode is None or returncode == 0:
+            return None
+
+        if self._cgroup_oom_kills() > 0:
+            limit = humanbytes(self.memory_limit) if self.memory_limit else "unknown"
+            return f"Memory limit exceeded ({limit}), job was killed to protect other jobs"
+
+        if not self.cgroup_path and self.memory_limit:
+            if any(marker in stderr_text for marker in ENOMEM_MARKERS):
+                limit = humanbytes(self.address_space_limit())
+                return f"Address space limit exceeded ({limit}), ffmpeg could not allocate memory"
+
+        return None
+
+    def release(self):
+        """Remove the job's cgroup once the child has exited"""
+        if not self.cgroup_path:
+            return
+        try:
+            os.rmdir(self.cgroup_path)
+        except OSError as e:
+            LOGGER.warning(f"Could not remove cgroup {self.cgroup_path}: {e}")
+        self.cgroup_path = None
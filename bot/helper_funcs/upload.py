@@ -0,0 +1,267 @@
+# bot/helper_funcs/upload.py - Streamed and parallel uploads of large files
+
+import asyncio
+import logging
+import math
+import os
+import random
+from typing import Optional, Callable
+
+import aiofiles
+from pyrogram import Client, raw, types, utils
+from pyrogram.errors import FloodWait
+
+from bot import TG_MAX_FILE_SIZE, PARALLEL_UPLOAD_WORKERS
+from bot.helper_funcs.download import (
+    open_media_sessions,
+    close_media_sessions,
+    retry_transfer,
+    transfer_backoff
+)
+
+LOGGER = logging.getLogger(__name__)
+
+# Telegram requires equal 512 KB parts for big-file uploads, only the last may be shorter
+UPLOAD_PART_SIZE = 512 * 1024
+# Below this size Telegram expects a small-file upload, which cannot be streamed
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024
+PART_RETRIES = 3
+POLL_INTERVAL = 1.0
+
+
+async def save_big_file_part(invoker, file_id: int, part: int, total: int, chunk: bytes):
+    """
+    Send one big-file part through a client or media session, sleeping out
+    FloodWait and retrying other errors PART_RETRIES times.
+    """
+    for attempt in range(1, PART_RETRIES + 1):
+        try:
+            await invoker.invoke(raw.functions.upload.SaveBigFilePart(
+                file_id=file_id,
+                file_part=part,
+                file_total_parts=total,
+                bytes=chunk
+            ))
+            return
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
+        except Exception as e:
+            if attempt == PART_RETRIES:
+                raise
+            LOGGER.warning(f"Upload part {part} failed ({e}), retrying")
+            await asyncio.sleep(transfer_backoff(attempt))
+
+
+class GrowingFileUploader:
+    """
+    Upload a file while ffmpeg is still writing it. Parts are sent as soon
+    as they are complete with an unknown total (-1); the last part is held
+    back until the writer finishes and then carries the real part count.
+
+    Only safe for outputs that are never rewritten in place, such as
+    fragmented MP4 without a global index. result() is None when the
+    streamed upload had to be given up and the file should be sent the
+    normal way.
+    """
+
+    def __init__(self, client: Client, path: str, max_size: int = TG_MAX_FILE_SIZE):
+        self.client = client
+        self.path = path
+        self.max_size = max_size
+        self.file_id = random.randint(1, 2 ** 63 - 1)
+        self.parts_sent = 0
+        self.bytes_sent = 0
+        self.head = b""
+        self.task = None
+        self.finished = asyncio.Event()
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def finish(self):
+        """The writer is done; the remaining parts are sent with the real total"""
+        self.finished.set()
+
+    async def cancel(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def result(self) -> Optional["raw.types.InputFileBig"]:
+        if not self.task:
+            return None
+        try:
+            return await self.task
+        except Exception as e:
+            LOGGER.error(f"Streamed upload of {self.path} failed: {e}")
+            return None
+
+    async def _run(self):
+        while not os.path.exists(self.path):
+            if self.finished.is_set():
+                return None
+            await asyncio.sleep(POLL_INTERVAL)
+
+        async with aiofiles.open(self.path, 'rb') as f:
+            while True:
+                done = self.finished.is_set()
+                size = os.path.getsize(self.path)
+                if size > self.max_size:
+                    LOGGER.info(f"{self.path} is over {self.max_size} bytes, streamed upload stopped")
+                    return None
+                if done and size <= BIG_FILE_THRESHOLD:
+                    return None
+
+                total = math.ceil(size / UPLOAD_PART_SIZE) if done else -1
+                # While writing, a part is only sent once bytes exist past it
+                while (self.parts_sent + 1) * UPLOAD_PART_SIZE < size or (done and self.parts_sent < total):
+                    await f.seek(self.parts_sent * UPLOAD_PART_SIZE)
+                    chunk = await f.read(UPLOAD_PART_SIZE)
+                    if self.parts_sent == 0:
+                        self.head = chunk
+                    await save_big_file_part(self.client, self.file_id, self.parts_sent, total, chunk)
+                    self.parts_sent += 1
+                    self.bytes_sent += len(chunk)
+
+                if done:
+                    break
+                try:
+                    await asyncio.wait_for(self.finished.wait(), timeout=POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+            # The header is where a muxer would patch an index; refuse if it changed
+            await f.seek(0)
+            if await f.read(len(self.head)) != self.head:
+                LOGGER.warning(f"{self.path} was rewritten after streaming, falling back")
+                return None
+
+        LOGGER.info(f"Streamed {self.parts_sent} parts of {self.path} during the encode")
+        return raw.types.InputFileBig(
+            id=self.file_id, parts=self.parts_sent, name=os.path.basename(self.path)
+        )
+
+
+class ParallelUploader:
+    """
+    Upload a finished file as 512 KB big-file parts over several media
+    sessions at once. Every part is retried on its own, so one failed
+    request never restarts the file. When a part fails for good, the
+    whole upload is retried with backoff and only the parts the server
+    has not acknowledged are sent again under the same file id. Files
+    small enough for a plain upload go through client.save_file.
+    """
+
+    def __init__(self, client: Client, path: str, workers: int = PARALLEL_UPLOAD_WORKERS,
+                 progress: Optional[Callable] = None, progress_args: tuple = ()):
+        self.client = client
+        self.path = path
+        self.workers = max(workers, 1)
+        self.progress = progress
+        self.progress_args = progress_args
+        self.file_id = random.randint(1, 2 ** 63 - 1)
+        self.bytes_sent = 0
+        # Parts the server acknowledged, kept across retries of this upload
+        self.done_parts = set()
+
+    async def upload(self):
+        """InputFileBig for the uploaded parts, or save_file's result for small files"""
+        size = os.path.getsize(self.path)
+        if size <= BIG_FILE_THRESHOLD:
+            return await retry_transfer(
+                lambda: self.client.save_file(
+                    self.path, progress=self.progress, progress_args=self.progress_args
+                ),
+                f"Upload of {os.path.basename(self.path)}"
+            )
+
+        total = math.ceil(size / UPLOAD_PART_SIZE)
+        await retry_transfer(
+            lambda: self._upload_missing(size, total),
+            f"Upload of {os.path.basename(self.path)}"
+        )
+        return raw.types.InputFileBig(id=self.file_id, parts=total, name=os.path.basename(self.path))
+
+    async def _upload_missing(self, size: int, total: int):
+        queue = asyncio.Queue()
+        for part in range(total):
+            if part not in self.done_parts:
+                queue.put_nowait(part)
+        if self.done_parts:
+            LOGGER.info(f"Resuming {self.path} at part {len(self.done_parts)} of {total}")
+
+        fd = os.open(self.path, os.O_RDONLY)
+        sessions, tasks = [], []
+        try:
+            sessions = await open_media_sessions(
+                self.client, await self.client.storage.dc_id(), min(self.workers, queue.qsize())
+            )
+
+            async def worker(session):
+                while not queue.empty():
+                    part = queue.get_nowait()
+                    chunk = await asyncio.to_thread(os.pread, fd, UPLOAD_PART_SIZE, part * UPLOAD_PART_SIZE)
+                    await save_big_file_part(session, self.file_id, part, total, chunk)
+                    self.done_parts.add(part)
+                    self.bytes_sent += len(chunk)
+                    if self.progress:
+                        await self.progress(self.bytes_sent, size, *self.progress_args)
+
+            tasks = [asyncio.create_task(worker(session)) for session in sessions]
+            await asyncio.gather(*tasks)
+        finally:
+            # A part that failed for good stops the others before the sessions close
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            os.close(fd)
+            await close_media_sessions(sessions)
+
+
+async def send_uploaded_media(client: Client, chat_id: int, input_file, caption: str,
+                              duration: float, width: int = 0, height: int = 0,
+                              thumb_path: str = None, reply_to_message_id: int = None,
+                              file_name: str = None, as_video: bool = True):
+    """
+    Send an already uploaded file, as a streamable video like send_video
+    would, or as a plain file like send_document.
+    """
+    thumb = None
+    if thumb_path and os.path.exists(thumb_path):
+        thumb = await client.save_file(thumb_path)
+
+    file_name = file_name or input_file.name
+    attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+    if as_video:
+        attributes.insert(0, raw.types.DocumentAttributeVideo(
+            supports_streaming=True,
+            duration=int(duration or 0),
+            w=width,
+            h=height
+        ))
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type=client.guess_mime_type(file_name) or "video/mp4",
+        file=input_file,
+        force_file=None if as_video else True,
+        thumb=thumb,
+        attributes=attributes
+    )
+    r = await client.invoke(raw.functions.messages.SendMedia(
+        peer=await client.resolve_peer(chat_id),
+        media=media,
+        reply_to_msg_id=reply_to_message_id,
+        random_id=client.rnd_id(),
+        **await utils.parse_text_entities(client, caption, None, None)
+    ))
+
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(
+                client, update.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats}
+            )
+    return None
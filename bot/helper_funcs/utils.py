@@ -256,6 +256,32 @@ class ValidationUtils:
         ext = os.path.splitext(filename)[1].lower().lstrip('.')
         return ext in [e.lower() for e in allowed_extensions]
     
+    @staticmethod
+    def parse_timestamp(value: str) -> Optional[float]:
+        """Parse '90', '1:30' or '00:01:30.5' into seconds"""
+        try:
+            parts = value.strip().split(':')
+            if not 1 <= len(parts) <= 3:
+                return None
+            seconds = 0.0
+            for part in parts:
+                seconds = seconds * 60 + float(part)
+            return seconds if seconds >= 0 else None
+        except ValueError:
+            return None
+    
+    @staticmethod
+    def parse_time_range(text: str) -> Optional[Tuple[float, float]]:
+        """Parse 'start end' or 'start-end' into a (start, end) pair in seconds"""
+        parts = text.replace(' - ', ' ').replace('-', ' ').split()
+        if len(parts) != 2:
+            return None
+        start = ValidationUtils.parse_timestamp(parts[0])
+        end = ValidationUtils.parse_timestamp(parts[1])
+        if start is None or end is None or end <= start:
+            return None
+        return start, end
+    
     @staticmethod
     def sanitize_filename(filename: str) -> str:
         """Sanitize filename for safe usage"""
@@ -271,6 +297,43 @@ class ValidationUtils:
         
         return filename
 
+class LogRingBuffer:
+    """Keeps only the last max_bytes of a process output stream"""
+    
+    def __init__(self, max_bytes: int = 65536):
+        self.max_bytes = max_bytes
+        self._buffer = bytearray()
+        self.total_bytes = 0
+    
+    def write(self, data: bytes):
+        """Append data, dropping the oldest bytes beyond the limit"""
+        self.total_bytes += len(data)
+        self._buffer.extend(data)
+        overflow = len(self._buffer) - self.max_bytes
+        if overflow > 0:
+            del self._buffer[:overflow]
+    
+    @property
+    def truncated(self) -> bool:
+        return self.total_bytes > len(self._buffer)
+    
+    def tail(self, max_chars: Optional[int] = None) -> str:
+        """Decoded tail of the stream, optionally cut to the last max_chars"""
+        text = self._buffer.decode(errors='replace')
+        if max_chars is not None and len(text) > max_chars:
+            text = text[-max_chars:]
+        return text
+    
+    async def drain(self, stream, chunk_size: int = 4096):
+        """Read an asyncio stream until EOF so the writer never blocks on a full pipe"""
+        if stream is None:
+            return
+        while True:
+            chunk = await stream.read(chunk_size)
+            if not chunk:
+                break
+            self.write(chunk)
+
 class CleanupManager:
     """Cleanup management utilities"""
     
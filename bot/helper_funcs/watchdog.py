@@ -0,0 +1,83 @@
+# bot/helper_funcs/watchdog.py - Stall detection and stage deadlines for long-running jobs
+
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from bot.helper_funcs.display_progress import TimeFormatter
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StallWatchdog:
+    """Flags a job whose progress stops advancing or whose stage deadline passes"""
+
+    def __init__(self, stall_timeout: int = 0, deadline: int = 0, stage: str = "encode"):
+        self.stall_timeout = stall_timeout
+        self.deadline = deadline
+        self.stage = stage
+        self.started = time.monotonic()
+        self.last_advance = self.started
+        self._last_marker = None
+        self.finalizing = False
+
+    def feed(self, *markers):
+        """Record the current progress counters (e.g. out_time and frame)"""
+        if markers != self._last_marker:
+            self._last_marker = markers
+            self.last_advance = time.monotonic()
+
+    def finalize(self):
+        """
+        The input is fully read and the job is flushing or writing its
+        trailer, which reports no progress; only the deadline applies now.
+        """
+        if not self.finalizing:
+            self.finalizing = True
+            LOGGER.info(f"{self.stage.capitalize()} is finalizing, stall timer off")
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the stage deadline, None when unlimited"""
+        if not self.deadline:
+            return None
+        return max(self.deadline - (time.monotonic() - self.started), 0)
+
+    def check(self) -> Optional[str]:
+        """Return a failure reason once the job is stalled or overdue"""
+        now = time.monotonic()
+
+        if self.deadline and now - self.started > self.deadline:
+            return (
+                f"{self.stage.capitalize()} exceeded its "
+                f"{TimeFormatter(self.deadline * 1000)} deadline"
+            )
+
+        if self.stall_timeout and not self.finalizing and now - self.last_advance > self.stall_timeout:
+            return (
+                f"{self.stage.capitalize()} stalled: no progress for "
+                f"{TimeFormatter((now - self.last_advance) * 1000)}"
+            )
+
+        return None
+
+
+async def terminate_process(process, grace: float = 10) -> None:
+    """Ask a child to stop with SIGTERM, then SIGKILL it after the grace period"""
+    if process is None or process.returncode is not None:
+        return
+
+    try:
+        process.terminate()
+    except ProcessLookupError:
+        return
+
+    try:
+        await asyncio.wait_for(process.wait(), timeout=grace)
+    except asyncio.TimeoutError:
+        LOGGER.warning(f"Process {process.pid} ignored SIGTERM, killing it")
+        try:
+            process.kill()
+        except ProcessLookupError:
+            return
+        await process.wait()
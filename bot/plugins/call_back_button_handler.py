@@ -29,20 +29,44 @@ from bot import (
 from bot.plugins.incoming_message_fn import (
     USER_SESSIONS,
     CURRENT_PROCESSES,
+    cancel_user_job,
     handle_quality_selection,
     handle_encoding_setting,
     start_compression_process,
+    start_remux_process,
+    start_trim_process,
+    request_trim_range,
+    show_ladder_menu,
+    toggle_ladder_rendition,
+    start_ladder_process,
+    build_quality_keyboard,
+    resolution_button,
+    encoding_settings_keyboard,
+    encoding_settings_text,
+    generate_preview,
+    retry_with_higher_crf,
+    send_original_video,
+    discard_size_retry,
     cleanup_process,
     cleanup_files_and_process,
+    target_size_label,
+    trim_label,
     QUALITY_PRESETS,
     ENCODING_SETTINGS
 )
 
+from bot.helper_funcs.encoders import ENCODERS
 from bot.helper_funcs.display_progress import humanbytes, TimeFormatter
 from bot.helper_funcs.utils import delete_downloads
 
 LOGGER = logging.getLogger(__name__)
 
+# Settings that change what an auto quality search measured; a change drops its result
+SEARCH_AFFECTING_SETTINGS = (
+    'set_preset_', 'set_video_codec_', 'set_pixel_format_', 'set_content_',
+    'set_fps_', 'set_auto_crop_', 'set_resolution_'
+)
+
 async def button(bot: Client, callback_query: CallbackQuery):
     """Enhanced callback button handler for compression system"""
     try:
@@ -79,6 +103,39 @@ async def button(bot: Client, callback_query: CallbackQuery):
         elif cb_data == 'start_encoding':
             await start_compression_process(bot, callback_query)
 
+        elif cb_data == 'preview_encode':
+            await generate_preview(bot, callback_query)
+
+        elif cb_data.startswith('upscale_'):
+            await explain_upscale_block(bot, callback_query, cb_data.replace('upscale_', ''))
+
+        elif cb_data == 'remux_only':
+            await start_remux_process(bot, callback_query)
+
+        elif cb_data == 'trim_video':
+            await request_trim_range(bot, callback_query)
+
+        elif cb_data == 'ladder_menu':
+            await show_ladder_menu(bot, callback_query)
+
+        elif cb_data.startswith('ladder_toggle_'):
+            await toggle_ladder_rendition(bot, callback_query, cb_data.replace('ladder_toggle_', ''))
+
+        elif cb_data == 'ladder_start':
+            await start_ladder_process(bot, callback_query)
+
+        elif cb_data == 'trim_copy':
+            await start_trim_process(bot, callback_query)
+
+        elif cb_data == 'retry_higher_crf':
+            await retry_with_higher_crf(bot, callback_query)
+
+        elif cb_data == 'send_original':
+            await send_original_video(bot, callback_query)
+
+        elif cb_data == 'discard_retry':
+            await discard_size_retry(bot, callback_query)
+
         elif cb_data == 'cancel_compression':
             await handle_cancel_compression(bot, callback_query)
 
@@ -105,6 +162,17 @@ async def button(bot: Client, callback_query: CallbackQuery):
         LOGGER.error(f"Error in button handler: {e}")
         await callback_query.answer("❌ An error occurred!", show_alert=True)
 
+async def explain_upscale_block(bot: Client, callback_query: CallbackQuery, resolution: str):
+    """Tell the user why a resolution larger than the source cannot be picked"""
+    session = USER_SESSIONS.get(callback_query.from_user.id)
+    source = session.source_size if session else None
+    source_text = f"{source[0]}x{source[1]}" if source else "smaller"
+    await callback_query.answer(
+        f"🚫 {resolution} would upscale: the source is only {source_text}.\n"
+        f"Upscaling adds size without adding detail, pick Keep Original instead.",
+        show_alert=True
+    )
+
 async def handle_custom_quality_selection(bot: Client, callback_query: CallbackQuery):
     """Handle custom quality selection"""
     try:
@@ -117,19 +185,22 @@ async def handle_custom_quality_selection(bot: Client, callback_query: CallbackQ
         session = USER_SESSIONS[user_id]
         session.quality = "custom"
 
-        # Show resolution selection for custom quality
+        def option(label, resolution):
+            return resolution_button(session, label, resolution, f'set_resolution_{resolution}')
+
+        # Show resolution selection for custom quality, sizes above the source are greyed out
         resolution_keyboard = InlineKeyboardMarkup([
             [
-                InlineKeyboardButton('🔥 4K (3840x2160)', callback_data='set_resolution_3840x2160'),
-                InlineKeyboardButton('📺 1440p (2560x1440)', callback_data='set_resolution_2560x1440')
+                option('🔥 4K (3840x2160)', '3840x2160'),
+                option('📺 1440p (2560x1440)', '2560x1440')
             ],
             [
-                InlineKeyboardButton('🎬 1080p (1920x1080)', callback_data='set_resolution_1920x1080'),
-                InlineKeyboardButton('📱 720p (1280x720)', callback_data='set_resolution_1280x720')
+                option('🎬 1080p (1920x1080)', '1920x1080'),
+                option('📱 720p (1280x720)', '1280x720')
             ],
             [
-                InlineKeyboardButton('📱 480p (854x480)', callback_data='set_resolution_854x480'),
-                InlineKeyboardButton('📱 360p (640x360)', callback_data='set_resolution_640x360')
+                option('📱 480p (854x480)', '854x480'),
+                option('📱 360p (640x360)', '640x360')
             ],
             [
                 InlineKeyboardButton('🔄 Keep Original', callback_data='set_resolution_original'),
@@ -162,9 +233,16 @@ async def handle_setting_value_change(bot: Client, callback_query: CallbackQuery
         session = USER_SESSIONS[user_id]
 
         # Parse callback data
-        if cb_data.startswith('set_crf_'):
+        if cb_data.startswith('set_crf_auto_'):
+            session.auto_quality = float(cb_data.replace('set_crf_auto_', ''))
+            session.auto_quality_result = None
+            await callback_query.answer(f"✅ Auto quality, target SSIM {session.auto_quality}")
+
+        elif cb_data.startswith('set_crf_'):
             crf_value = int(cb_data.replace('set_crf_', ''))
             session.crf = crf_value
+            session.auto_quality = None
+            session.auto_quality_result = None
             await callback_query.answer(f"✅ CRF set to {crf_value}")
 
         elif cb_data.startswith('set_audio_bitrate_'):
@@ -180,6 +258,9 @@ async def handle_setting_value_change(bot: Client, callback_query: CallbackQuery
 
         elif cb_data.startswith('set_video_codec_'):
             codec = cb_data.replace('set_video_codec_', '')
+            if codec not in {backend.encoder for backend in ENCODERS.available()}:
+                await callback_query.answer(f"❌ {codec} is not available on this server.", show_alert=True)
+                return
             session.video_codec = codec
             await callback_query.answer(f"✅ Video codec set to {codec}")
 
@@ -190,9 +271,45 @@ async def handle_setting_value_change(bot: Client, callback_query: CallbackQuery
 
         elif cb_data.startswith('set_pixel_format_'):
             pixel_format = cb_data.replace('set_pixel_format_', '')
+            if pixel_format not in ENCODERS.get(session.video_codec).pixel_formats:
+                await callback_query.answer(f"❌ {pixel_format} is not supported by {session.video_codec}.", show_alert=True)
+                return
             session.pixel_format = pixel_format
             await callback_query.answer(f"✅ Pixel format set to {pixel_format}")
 
+        elif cb_data.startswith('set_content_'):
+            session.content_mode = cb_data.replace('set_content_', '')
+            await callback_query.answer(f"✅ Content tuning: {session.content_mode}")
+
+        elif cb_data.startswith('set_fps_'):
+            max_fps = int(cb_data.replace('set_fps_', ''))
+            session.max_fps = max_fps or None
+            await callback_query.answer(f"✅ Frame rate {'capped at ' + str(max_fps) if max_fps else 'kept original'}")
+
+        elif cb_data.startswith('set_auto_crop_'):
+            session.auto_crop = cb_data == 'set_auto_crop_on'
+            session.crop_filter = None
+            await callback_query.answer(f"✅ Auto crop {'on' if session.auto_crop else 'off'}")
+
+        elif cb_data.startswith('set_target_size_'):
+            target = cb_data.replace('set_target_size_', '')
+            if target == 'off':
+                session.size_limit = None
+                await callback_query.answer("✅ Target size off, using CRF")
+            else:
+                session.size_limit = int(target)
+                session.part_minutes = None
+                await callback_query.answer(f"✅ Target size set to {humanbytes(session.size_limit)}")
+
+        elif cb_data.startswith('set_parts_'):
+            minutes = int(cb_data.replace('set_parts_', ''))
+            session.part_minutes = minutes or None
+            if minutes:
+                session.size_limit = None
+                await callback_query.answer(f"✅ Delivering in parts of {minutes} min")
+            else:
+                await callback_query.answer("✅ Delivering one file")
+
         elif cb_data.startswith('set_resolution_'):
             resolution = cb_data.replace('set_resolution_', '')
             if resolution == 'original':
@@ -202,6 +319,9 @@ async def handle_setting_value_change(bot: Client, callback_query: CallbackQuery
                 session.resolution = resolution
                 await callback_query.answer(f"✅ Resolution set to {resolution}")
 
+        if cb_data.startswith(SEARCH_AFFECTING_SETTINGS):
+            session.auto_quality_result = None
+
         # Return to encoding settings after change
         await show_encoding_settings(bot, callback_query)
 
@@ -219,27 +339,11 @@ async def show_quality_selection(bot: Client, callback_query: CallbackQuery):
             return
 
         session = USER_SESSIONS[user_id]
+        session.awaiting_trim = False
         video_message = session.video_message
         video = video_message.video or video_message.document
 
-        quality_keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton('🔥 1080p', callback_data='quality_1080p'),
-                InlineKeyboardButton('🔥 1080p HEVC', callback_data='quality_1080p_hevc')
-            ],
-            [
-                InlineKeyboardButton('⭐ 720p', callback_data='quality_720p'),
-                InlineKeyboardButton('⭐ 720p HEVC', callback_data='quality_720p_hevc')
-            ],
-            [
-                InlineKeyboardButton('📱 480p', callback_data='quality_480p'),
-                InlineKeyboardButton('📱 480p HEVC', callback_data='quality_480p_hevc')
-            ],
-            [
-                InlineKeyboardButton('⚙️ Custom +', callback_data='quality_custom'),
-                InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
-            ]
-        ])
+        quality_keyboard = build_quality_keyboard(session)
 
         await callback_query.edit_message_text(
             f"🎬 **Video Received!**\n\n"
@@ -265,43 +369,9 @@ async def show_encoding_settings(bot: Client, callback_query: CallbackQuery):
 
         session = USER_SESSIONS[user_id]
 
-        # Create encoding settings keyboard
-        encoding_keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(f'CRF: {session.crf}', callback_data='setting_crf'),
-                InlineKeyboardButton(f'Audio: {session.audio_bitrate}', callback_data='setting_audio_bitrate')
-            ],
-            [
-                InlineKeyboardButton(f'Resolution: {session.resolution or "Original"}', callback_data='setting_resolution'),
-                InlineKeyboardButton(f'Preset: {session.preset}', callback_data='setting_preset')
-            ],
-            [
-                InlineKeyboardButton(f'Video Codec: {session.video_codec}', callback_data='setting_video_codec'),
-                InlineKeyboardButton(f'Audio Codec: {session.audio_codec}', callback_data='setting_audio_codec')
-            ],
-            [
-                InlineKeyboardButton(f'Pixel Format: {session.pixel_format}', callback_data='setting_pixel_format')
-            ],
-            [
-                InlineKeyboardButton('🔙 Back', callback_data='back_to_quality'),
-                InlineKeyboardButton('🚀 Start Encode', callback_data='start_encoding')
-            ]
-        ])
-
-        quality_name = session.quality.replace('_', ' ').upper() if session.quality else "CUSTOM"
-        
         await callback_query.edit_message_text(
-            f"🎯 **Quality Selected:** {quality_name}\n\n"
-            f"⚙️ **Current Encoding Settings:**\n"
-            f"🔹 **CRF:** {session.crf} (Lower = Better Quality)\n"
-            f"🔹 **Audio Bitrate:** {session.audio_bitrate}\n"
-            f"🔹 **Resolution:** {session.resolution or 'Original'}\n"
-            f"🔹 **Preset:** {session.preset} (Slower = Better Compression)\n"
-            f"🔹 **Video Codec:** {session.video_codec}\n"
-            f"🔹 **Audio Codec:** {session.audio_codec}\n"
-            f"🔹 **Pixel Format:** {session.pixel_format}\n\n"
-            f"📝 **Adjust settings or start encoding:**",
-            reply_markup=encoding_keyboard
+            encoding_settings_text(session),
+            reply_markup=encoding_settings_keyboard(session)
         )
 
     except Exception as e:
@@ -327,9 +397,10 @@ async def handle_cancel_compression(bot: Client, callback_query: CallbackQuery):
                 ])
             )
         else:
-            # Just clean up session
-            if user_id in USER_SESSIONS:
-                del USER_SESSIONS[user_id]
+            # Just clean up session, plus a source a preview already fetched
+            session = USER_SESSIONS.get(user_id)
+            if session:
+                await cleanup_files_and_process(user_id, [session.source_path, session.thumb_path])
             
             await callback_query.edit_message_text(
                 "❌ **Process Cancelled**\n\n"
@@ -345,9 +416,8 @@ async def confirm_cancel_compression(bot: Client, callback_query: CallbackQuery)
     try:
         user_id = callback_query.from_user.id
 
-        # Cancel active process
-        if user_id in CURRENT_PROCESSES:
-            del CURRENT_PROCESSES[user_id]
+        # Cancel active process, stopping every ffmpeg child it started
+        await cancel_user_job(user_id)
 
         # Clean up session
         if user_id in USER_SESSIONS:
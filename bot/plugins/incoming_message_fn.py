@@ -10,6 +10,7 @@ import time
 import re
 import asyncio
 import json
+import glob
 from typing import Optional, Dict, Any
 from pyrogram.enums import ParseMode
 from pyrogram import Client, filters
@@ -30,15 +31,61 @@ from bot import (
     DATABASE_URL,
     SESSION_NAME,
     ALLOWED_FILE_TYPES,
-    TG_MAX_FILE_SIZE
+    TG_MAX_FILE_SIZE,
+    TIMEOUT_DOWNLOAD,
+    TIMEOUT_UPLOAD,
+    ENABLE_SPLIT_UPLOAD,
+    PARALLEL_PART_UPLOADS,
+    AUTO_QUALITY_PARALLEL,
+    ENABLE_STREAMING_UPLOAD,
+    PARALLEL_UPLOAD_WORKERS,
+    PARALLEL_PART_ENCODES
 )
 
 from bot.helper_funcs.ffmpeg import (
     convert_video,
     media_info,
-    take_screen_shot
+    take_screen_shot,
+    run_ffmpeg,
+    FFmpegJob,
+    suggest_crf,
+    target_video_bitrate,
+    expected_output_size,
+    two_pass_args,
+    pass_stats_exist,
+    MUX_OVERHEAD,
+    split_video,
+    probe_media,
+    plan_mp4_remux,
+    smart_cut,
+    measure_quality,
+    detect_crop,
+    source_frame_rate,
+    capped_frame_rate,
+    classify_content,
+    content_encode_args,
+    display_dimensions,
+    exceeds_source,
+    fit_resolution,
+    plan_stream_mapping,
+    preflight_stream_plan,
+    mp4_index_args,
+    moov_reservation_failed,
+    faststart_fallback,
+    reserved_index_bytes,
+    record_index_metrics,
+    chunk_ranges,
+    QUALITY_PRESETS
 )
 
+from bot.helper_funcs.encoders import ENCODERS, SPEED_PRESETS
+from bot.helper_funcs.upload import (
+    GrowingFileUploader,
+    ParallelUploader,
+    send_uploaded_media,
+    BIG_FILE_THRESHOLD
+)
+from bot.helper_funcs.download import downloader, retry_transfer
 from bot.helper_funcs.display_progress import (
     progress_for_pyrogram,
     TimeFormatter,
@@ -60,8 +107,10 @@ if Database and DATABASE_URL:
     except Exception as e:
         LOGGER.error(f"Database initialization failed: {e}")
 
-# Track current processes and user selections
+# Track current processes and user selections; a running job's task once it is started
 CURRENT_PROCESSES = {}
+# Seconds a cancel waits for a job's ffmpeg children to be terminated
+CANCEL_GRACE = 15
 USER_SESSIONS = {}
 
 class CompressionSettings:
@@ -70,35 +119,91 @@ class CompressionSettings:
         self.user_id = user_id
         self.video_message = None
         self.quality = None
+        self.mode = "encode"
         self.resolution = None
         self.video_codec = "libx264"
         self.audio_codec = "aac"
         self.preset = "medium"
         self.crf = 23
+        self.auto_quality = None
+        self.auto_quality_result = None
         self.audio_bitrate = "128k"
         self.pixel_format = "yuv420p"
+        self.max_fps = None
+        self.source_fps = None
+        self.source_size = None
+        self.source_probe = None
+        self.preflight_fixes = []
+        self.pixel_scale = (1, 1)
+        self.content_mode = "auto"
+        self.content_profile = None
+        self.auto_crop = False
+        self.crop_filter = None
+        self.failure_reason = None
+        self.failure_log = ""
+        self.size_limit = None
+        self.size_limit_used = None
+        self.size_exceeded = False
+        self.projected_size = 0
+        self.retry_crf = None
+        self.retry_expiry = None
+        self.pass_stats = {}
+        self.remux_transcoded = []
+        self.ladder = []
+        self.part_minutes = None
+        self.stream_upload = None
+        self.trim_start = 0
+        self.trim_end = None
+        self.awaiting_trim = False
+        self.source_path = None
+        self.thumb_path = None
+        self.duration = None
+        self.source_duration = None
+        self.status_message = None
+        self.started_at = None
         self.created_at = time.time()
 
-# Quality presets mapping
-QUALITY_PRESETS = {
-    "1080p": {"resolution": "1920x1080", "crf": 18, "preset": "slow"},
-    "1080p_hevc": {"resolution": "1920x1080", "crf": 20, "preset": "medium", "codec": "libx265"},
-    "720p": {"resolution": "1280x720", "crf": 20, "preset": "medium"},
-    "720p_hevc": {"resolution": "1280x720", "crf": 22, "preset": "medium", "codec": "libx265"},
-    "480p": {"resolution": "854x480", "crf": 23, "preset": "fast"},
-    "480p_hevc": {"resolution": "854x480", "crf": 25, "preset": "fast", "codec": "libx265"},
-    "360p": {"resolution": "640x360", "crf": 25, "preset": "fast"},
-}
-
 ENCODING_SETTINGS = {
     "crf_options": [15, 18, 20, 23, 25, 28, 30],
     "audio_bitrates": ["64k", "96k", "128k", "192k", "256k"],
-    "presets": ["veryslow", "slower", "slow", "medium", "fast", "faster", "ultrafast"],
-    "video_codecs": ["libx264", "libx265"],
+    "presets": SPEED_PRESETS,
     "audio_codecs": ["aac", "libmp3lame", "copy"],
-    "pixel_formats": ["yuv420p", "yuv444p", "yuv420p10le"]
+    "target_sizes": [25, 50, 100, 250, 500, 1000],  # MB, plus the Telegram limit
+    "auto_quality_targets": [0.99, 0.98, 0.97, 0.96],  # SSIM the chosen CRF must reach
+    "fps_caps": [24, 25, 30, 50, 60],
+    "part_minutes": [10, 20, 30, 60]
 }
 
+# Shown next to each pixel format the selected encoder offers
+PIXEL_FORMAT_NOTES = {
+    "yuv420p": "Plays everywhere (Recommended)",
+    "yuv444p": "Full colour detail, limited player support",
+    "yuv420p10le": "10-bit, less banding in gradients",
+}
+
+# CRFs tried by the auto quality search and the samples each one is scored on
+AUTO_QUALITY_CRFS = [18, 20, 22, 24, 26, 28, 30, 32]
+AUTO_QUALITY_WINDOWS = 3
+AUTO_QUALITY_SAMPLE_SECONDS = 4
+
+# Second-pass attempts before a target size is given up
+TARGET_SIZE_ATTEMPTS = 2
+
+# Length of the sample encoded by the Preview button
+PREVIEW_SECONDS = 10
+
+# Encodes of one part before a parts delivery gives up
+PART_ENCODE_ATTEMPTS = 2
+
+# Seconds the source is kept after a size abort while the user decides
+SIZE_RETRY_EXPIRY = 1800
+
+# Presets a ladder can combine, largest first
+LADDER_QUALITIES = ["1080p", "720p", "480p", "360p"]
+
+# Megabytes fetched ahead of the download to check stream compatibility
+PREFLIGHT_HEAD_CHUNKS = 4
+
 async def incoming_start_message_f(bot: Client, update: Message):
     """Enhanced /start command handler"""
     try:
@@ -180,27 +285,13 @@ async def handle_video_message(bot: Client, update: Message):
         # Store video message in user session
         session = CompressionSettings(update.from_user.id)
         session.video_message = update
+        # Telegram's size is good enough for the menus, the probe refines it later
+        if getattr(video, 'width', 0) and getattr(video, 'height', 0):
+            session.source_size = (video.width, video.height)
         USER_SESSIONS[update.from_user.id] = session
 
         # Send quality selection keyboard
-        quality_keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton('🔥 1080p', callback_data='quality_1080p'),
-                InlineKeyboardButton('🔥 1080p HEVC', callback_data='quality_1080p_hevc')
-            ],
-            [
-                InlineKeyboardButton('⭐ 720p', callback_data='quality_720p'),
-                InlineKeyboardButton('⭐ 720p HEVC', callback_data='quality_720p_hevc')
-            ],
-            [
-                InlineKeyboardButton('📱 480p', callback_data='quality_480p'),
-                InlineKeyboardButton('📱 480p HEVC', callback_data='quality_480p_hevc')
-            ],
-            [
-                InlineKeyboardButton('⚙️ Custom +', callback_data='quality_custom'),
-                InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
-            ]
-        ])
+        quality_keyboard = build_quality_keyboard(session)
 
         await update.reply_text(
             f"🎬 **Video Received!**\n\n"
@@ -215,6 +306,250 @@ async def handle_video_message(bot: Client, update: Message):
         LOGGER.error(f"Error handling video message: {e}")
         await update.reply_text("❌ An error occurred while processing your video.")
 
+def resolution_button(session: CompressionSettings, label: str, resolution: str,
+                      callback_data: str) -> InlineKeyboardButton:
+    """Button for a resolution, greyed out when it is larger than the source"""
+    if exceeds_source(session.source_size, resolution):
+        return InlineKeyboardButton(f'🚫 {label}', callback_data=f'upscale_{resolution}')
+    return InlineKeyboardButton(label, callback_data=callback_data)
+
+def build_quality_keyboard(session: CompressionSettings) -> InlineKeyboardMarkup:
+    """Quality presets plus the fast paths; a trimmed session offers the plain cut instead of remux"""
+    if session.trim_end:
+        fast_row = [InlineKeyboardButton('✂️ Cut Only (Fast)', callback_data='trim_copy')]
+    else:
+        fast_row = [
+            InlineKeyboardButton('📦 Remux Only (Fast)', callback_data='remux_only'),
+            InlineKeyboardButton('✂️ Trim', callback_data='trim_video')
+        ]
+
+    available = {backend.encoder for backend in ENCODERS.available()}
+
+    def preset_button(label, quality):
+        return resolution_button(
+            session, label, QUALITY_PRESETS[quality]["resolution"], f'quality_{quality}'
+        )
+
+    def preset_row(*presets):
+        # Presets whose encoder is missing from this ffmpeg build are left out
+        return [
+            preset_button(label, quality) for label, quality in presets
+            if QUALITY_PRESETS[quality].get("codec", "libx264") in available
+        ]
+
+    rows = [
+        preset_row(('🔥 1080p', '1080p'), ('🔥 1080p HEVC', '1080p_hevc')),
+        preset_row(('⭐ 720p', '720p'), ('⭐ 720p HEVC', '720p_hevc')),
+        preset_row(('📱 480p', '480p'), ('📱 480p HEVC', '480p_hevc')),
+        fast_row,
+        [
+            InlineKeyboardButton('⚙️ Custom +', callback_data='quality_custom'),
+            InlineKeyboardButton('🪜 Ladder', callback_data='ladder_menu'),
+            InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
+        ]
+    ]
+    return InlineKeyboardMarkup([row for row in rows if row])
+
+def trim_label(session: CompressionSettings) -> str:
+    """Kept range of a trimmed session, 'Full video' otherwise"""
+    if not session.trim_end:
+        return "Full video"
+    return (
+        f"{TimeFormatter(session.trim_start * 1000)} → "
+        f"{TimeFormatter(session.trim_end * 1000)}"
+    )
+
+async def request_trim_range(bot: Client, callback_query):
+    """Ask the user for the start and end of the part to keep"""
+    user_id = callback_query.from_user.id
+
+    if user_id not in USER_SESSIONS:
+        await callback_query.answer("❌ Session expired. Please send video again.", show_alert=True)
+        return
+
+    session = USER_SESSIONS[user_id]
+    session.awaiting_trim = True
+
+    await callback_query.edit_message_text(
+        "✂️ **Trim Video**\n\n"
+        "Send the start and end of the part to keep, for example:\n"
+        "`00:01:30 00:02:45` or `90 165`\n\n"
+        "⚡ Only the cut edges are re-encoded, the rest is copied.",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton('🔙 Back', callback_data='back_to_quality')
+        ]])
+    )
+
+async def show_ladder_menu(bot: Client, callback_query):
+    """Let the user pick the renditions produced together from one decode"""
+    user_id = callback_query.from_user.id
+
+    if user_id not in USER_SESSIONS:
+        await callback_query.answer("❌ Session expired. Please send video again.", show_alert=True)
+        return
+
+    session = USER_SESSIONS[user_id]
+    toggles = [
+        resolution_button(
+            session,
+            f"{'✅' if quality in session.ladder else '⬜'} {quality}",
+            QUALITY_PRESETS[quality]["resolution"],
+            f'ladder_toggle_{quality}'
+        )
+        for quality in LADDER_QUALITIES
+    ]
+
+    await callback_query.edit_message_text(
+        f"🪜 **Rendition Ladder**\n\n"
+        f"Pick the sizes you want. The video is downloaded and decoded once and\n"
+        f"every rendition is encoded from the same pass.\n\n"
+        f"📹 **Codec:** {session.video_codec} | **Range:** {trim_label(session)}",
+        reply_markup=InlineKeyboardMarkup([
+            toggles[:2],
+            toggles[2:],
+            [InlineKeyboardButton(f'▶️ Encode {len(session.ladder)} Renditions', callback_data='ladder_start')],
+            [InlineKeyboardButton('🔙 Back', callback_data='back_to_quality')]
+        ])
+    )
+
+async def toggle_ladder_rendition(bot: Client, callback_query, quality: str):
+    """Add or remove one rendition of the ladder"""
+    session = USER_SESSIONS.get(callback_query.from_user.id)
+    if not session or quality not in LADDER_QUALITIES:
+        await callback_query.answer("❌ Session expired. Please send video again.", show_alert=True)
+        return
+
+    if quality in session.ladder:
+        session.ladder.remove(quality)
+    else:
+        session.ladder.append(quality)
+    await show_ladder_menu(bot, callback_query)
+
+async def start_ladder_process(bot: Client, callback_query):
+    """Encode every selected rendition in one ffmpeg run and upload them"""
+    user_id = callback_query.from_user.id
+
+    if user_id not in USER_SESSIONS:
+        await callback_query.answer("❌ Session expired. Please send video again.", show_alert=True)
+        return
+
+    session = USER_SESSIONS[user_id]
+    if len(session.ladder) < 2:
+        await callback_query.answer("🪜 Pick at least two renditions.", show_alert=True)
+        return
+
+    session.mode = "ladder"
+    session.quality = "ladder"
+    session.size_limit = None
+    await start_compression_process(bot, callback_query)
+
+async def handle_trim_input(bot: Client, update: Message):
+    """Read the trim range a user typed after pressing Trim"""
+    session = USER_SESSIONS.get(update.from_user.id)
+    if not session or not session.awaiting_trim:
+        return
+
+    time_range = ValidationUtils.parse_time_range(update.text or "")
+    video = session.video_message.video or session.video_message.document
+    duration = getattr(video, 'duration', 0) or 0
+
+    if not time_range or (duration and time_range[0] >= duration):
+        await update.reply_text(
+            "❌ **Invalid range.**\n\n"
+            "Send two times with the end after the start, for example `1:30 2:45`."
+        )
+        return
+
+    start, end = time_range
+    if duration:
+        end = min(end, duration)
+
+    session.awaiting_trim = False
+    session.trim_start = start
+    session.trim_end = end
+    session.auto_quality_result = None
+
+    await update.reply_text(
+        f"✂️ **Keeping:** {trim_label(session)}\n\n"
+        f"⚡ **Cut Only** copies the range without re-encoding it.\n"
+        f"🎯 A quality preset encodes just the kept part.",
+        reply_markup=build_quality_keyboard(session)
+    )
+
+async def start_trim_process(bot: Client, callback_query):
+    """Cut the chosen range with a smart cut and upload it without a full encode"""
+    user_id = callback_query.from_user.id
+    session = USER_SESSIONS.get(user_id)
+
+    if not session or not session.trim_end:
+        await callback_query.answer("❌ Session expired. Please send video again.", show_alert=True)
+        return
+
+    session.mode = "trim"
+    session.quality = "trim"
+    session.size_limit = None
+    await start_compression_process(bot, callback_query)
+
+def encoding_settings_keyboard(session: CompressionSettings) -> InlineKeyboardMarkup:
+    """Buttons of the encoding settings screen"""
+    return InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton(f'CRF: {crf_label(session)}', callback_data='setting_crf'),
+            InlineKeyboardButton(f'Audio: {session.audio_bitrate}', callback_data='setting_audio_bitrate')
+        ],
+        [
+            InlineKeyboardButton(f'Resolution: {resolution_label(session)}', callback_data='setting_resolution'),
+            InlineKeyboardButton(f'Preset: {session.preset}', callback_data='setting_preset')
+        ],
+        [
+            InlineKeyboardButton(f'Video Codec: {session.video_codec}', callback_data='setting_video_codec'),
+            InlineKeyboardButton(f'Audio Codec: {session.audio_codec}', callback_data='setting_audio_codec')
+        ],
+        [
+            InlineKeyboardButton(f'Pixel Format: {session.pixel_format}', callback_data='setting_pixel_format'),
+            InlineKeyboardButton(f'Auto Crop: {"On" if session.auto_crop else "Off"}', callback_data='setting_auto_crop')
+        ],
+        [
+            InlineKeyboardButton(f'🧠 Content: {content_label(session)}', callback_data='setting_content')
+        ],
+        [
+            InlineKeyboardButton(f'FPS: {fps_label(session)}', callback_data='setting_fps'),
+            InlineKeyboardButton(f'🎯 Target Size: {target_size_label(session)}', callback_data='setting_target_size')
+        ],
+        [
+            InlineKeyboardButton(f'🧩 Deliver in Parts: {parts_label(session)}', callback_data='setting_parts')
+        ],
+        [
+            InlineKeyboardButton(f'👁 Preview ({PREVIEW_SECONDS}s Sample)', callback_data='preview_encode')
+        ],
+        [
+            InlineKeyboardButton('🔙 Back', callback_data='back_to_quality'),
+            InlineKeyboardButton('🚀 Start Encode', callback_data='start_encoding')
+        ]
+    ])
+
+def encoding_settings_text(session: CompressionSettings) -> str:
+    """Summary of the session settings shown above the settings buttons"""
+    quality_name = session.quality.replace('_', ' ').upper() if session.quality else "CUSTOM"
+    return (
+        f"🎯 **Quality Selected:** {quality_name}\n\n"
+        f"⚙️ **Current Encoding Settings:**\n"
+        f"🔹 **CRF:** {crf_label(session)} (Lower = Better Quality)\n"
+        f"🔹 **Audio Bitrate:** {session.audio_bitrate}\n"
+        f"🔹 **Resolution:** {resolution_label(session)}\n"
+        f"🔹 **Preset:** {session.preset} (Slower = Better Compression)\n"
+        f"🔹 **Video Codec:** {session.video_codec}\n"
+        f"🔹 **Audio Codec:** {session.audio_codec}\n"
+        f"🔹 **Pixel Format:** {session.pixel_format}\n"
+        f"🔹 **Auto Crop:** {'On' if session.auto_crop else 'Off'}\n"
+        f"🔹 **Frame Rate:** {fps_label(session)}\n"
+        f"🔹 **Content Tuning:** {content_label(session)}\n"
+        f"🔹 **Target Size:** {target_size_label(session, detailed=True)}\n"
+        f"🔹 **Deliver in Parts:** {parts_label(session)}\n"
+        f"🔹 **Range:** {trim_label(session)}\n\n"
+        f"📝 **Adjust settings or start encoding:**"
+    )
+
 async def handle_quality_selection(bot: Client, callback_query, quality: str):
     """Handle quality selection from user"""
     try:
@@ -226,6 +561,7 @@ async def handle_quality_selection(bot: Client, callback_query, quality: str):
 
         session = USER_SESSIONS[user_id]
         session.quality = quality
+        session.mode = "encode"
 
         # Set preset values based on quality selection
         if quality in QUALITY_PRESETS:
@@ -233,46 +569,13 @@ async def handle_quality_selection(bot: Client, callback_query, quality: str):
             session.resolution = preset["resolution"]
             session.crf = preset["crf"]
             session.preset = preset["preset"]
-            
-            if "codec" in preset and preset["codec"] == "libx265":
-                session.video_codec = "libx265"
-
-        # Show encoding settings keyboard
-        encoding_keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton(f'CRF: {session.crf}', callback_data='setting_crf'),
-                InlineKeyboardButton(f'Audio: {session.audio_bitrate}', callback_data='setting_audio_bitrate')
-            ],
-            [
-                InlineKeyboardButton(f'Resolution: {session.resolution or "Original"}', callback_data='setting_resolution'),
-                InlineKeyboardButton(f'Preset: {session.preset}', callback_data='setting_preset')
-            ],
-            [
-                InlineKeyboardButton(f'Video Codec: {session.video_codec}', callback_data='setting_video_codec'),
-                InlineKeyboardButton(f'Audio Codec: {session.audio_codec}', callback_data='setting_audio_codec')
-            ],
-            [
-                InlineKeyboardButton(f'Pixel Format: {session.pixel_format}', callback_data='setting_pixel_format')
-            ],
-            [
-                InlineKeyboardButton('🔙 Back', callback_data='back_to_quality'),
-                InlineKeyboardButton('🚀 Start Encode', callback_data='start_encoding')
-            ]
-        ])
+            session.max_fps = preset.get("max_fps")
+            session.video_codec = ENCODERS.get(preset.get("codec", "libx264")).encoder
+            session.auto_quality_result = None
 
-        quality_name = quality.replace('_', ' ').upper()
         await callback_query.edit_message_text(
-            f"🎯 **Quality Selected:** {quality_name}\n\n"
-            f"⚙️ **Current Encoding Settings:**\n"
-            f"🔹 **CRF:** {session.crf} (Lower = Better Quality)\n"
-            f"🔹 **Audio Bitrate:** {session.audio_bitrate}\n"
-            f"🔹 **Resolution:** {session.resolution or 'Original'}\n"
-            f"🔹 **Preset:** {session.preset} (Slower = Better Compression)\n"
-            f"🔹 **Video Codec:** {session.video_codec}\n"
-            f"🔹 **Audio Codec:** {session.audio_codec}\n"
-            f"🔹 **Pixel Format:** {session.pixel_format}\n\n"
-            f"📝 **Adjust settings or start encoding:**",
-            reply_markup=encoding_keyboard
+            encoding_settings_text(session),
+            reply_markup=encoding_settings_keyboard(session)
         )
 
     except Exception as e:
@@ -306,6 +609,15 @@ async def handle_encoding_setting(bot: Client, callback_query, setting_type: str
                             InlineKeyboardButton(f'CRF {crf_val}', callback_data=f'set_crf_{crf_val}')
                         ])
             
+            # Auto quality picks the CRF from scored samples before the encode
+            keyboard.append([
+                InlineKeyboardButton(f'🤖 Auto SSIM {target}', callback_data=f'set_crf_auto_{target}')
+                for target in ENCODING_SETTINGS["auto_quality_targets"][:2]
+            ])
+            keyboard.append([
+                InlineKeyboardButton(f'🤖 Auto SSIM {target}', callback_data=f'set_crf_auto_{target}')
+                for target in ENCODING_SETTINGS["auto_quality_targets"][2:]
+            ])
             keyboard.append([InlineKeyboardButton('🔙 Back', callback_data='back_to_encoding')])
             
             await callback_query.edit_message_text(
@@ -313,8 +625,9 @@ async def handle_encoding_setting(bot: Client, callback_query, setting_type: str
                 f"🔹 **CRF 15-18:** Near Lossless (Large files)\n"
                 f"🔹 **CRF 20-23:** High Quality (Recommended)\n"
                 f"🔹 **CRF 24-28:** Good Quality (Smaller files)\n"
-                f"🔹 **CRF 28+:** Lower Quality (Very small files)\n\n"
-                f"📝 **Current:** {session.crf}",
+                f"🔹 **CRF 28+:** Lower Quality (Very small files)\n"
+                f"🤖 **Auto:** Highest CRF whose samples keep the chosen SSIM\n\n"
+                f"📝 **Current:** {crf_label(session)}",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
 
@@ -370,19 +683,147 @@ async def handle_encoding_setting(bot: Client, callback_query, setting_type: str
             )
 
         elif setting_type == "video_codec":
+            # Only encoders the installed ffmpeg can actually run are offered
+            backends = ENCODERS.available()
+            buttons = [
+                InlineKeyboardButton(backend.label, callback_data=f'set_video_codec_{backend.encoder}')
+                for backend in backends
+            ]
+            keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+            keyboard.append([InlineKeyboardButton('🔙 Back', callback_data='back_to_encoding')])
+
+            await callback_query.edit_message_text(
+                f"📹 **Select Video Codec:**\n\n"
+                + "".join(f"🔹 **{backend.label}:** {backend.description}\n" for backend in backends)
+                + f"\n📝 **Current:** {session.video_codec}",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+
+        elif setting_type == "pixel_format":
+            # Only formats the selected encoder accepts are offered
+            pixel_formats = ENCODERS.get(session.video_codec).pixel_formats
+            buttons = [
+                InlineKeyboardButton(pixel_format, callback_data=f'set_pixel_format_{pixel_format}')
+                for pixel_format in pixel_formats
+            ]
+            keyboard = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+            keyboard.append([InlineKeyboardButton('🔙 Back', callback_data='back_to_encoding')])
+
+            await callback_query.edit_message_text(
+                f"🎨 **Select Pixel Format:**\n\n"
+                + "".join(f"🔹 **{pixel_format}:** {PIXEL_FORMAT_NOTES.get(pixel_format, '')}\n"
+                          for pixel_format in pixel_formats)
+                + f"\n📝 **Current:** {session.pixel_format}",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+
+        elif setting_type == "target_size":
+            keyboard = []
+            sizes = ENCODING_SETTINGS["target_sizes"]
+            for i in range(0, len(sizes), 3):
+                keyboard.append([
+                    InlineKeyboardButton(f'{mb} MB', callback_data=f'set_target_size_{mb * 1024 * 1024}')
+                    for mb in sizes[i:i + 3]
+                ])
+            keyboard.append([
+                InlineKeyboardButton(f'Telegram Max ({humanbytes(TG_MAX_FILE_SIZE)})',
+                                     callback_data=f'set_target_size_{TG_MAX_FILE_SIZE}'),
+                InlineKeyboardButton('Off (use CRF)', callback_data='set_target_size_off')
+            ])
+            keyboard.append([InlineKeyboardButton('🔙 Back', callback_data='back_to_encoding')])
+
+            backend = ENCODERS.get(session.video_codec)
+            if backend.two_pass:
+                how = (
+                    f"🔹 Uses two-pass encoding to land just under the size\n"
+                    f"🔹 Takes longer than CRF, but the size is guaranteed\n"
+                )
+            else:
+                how = (
+                    f"🔹 {backend.label} has no two-pass mode, so it encodes at CRF {session.crf}\n"
+                    f"🔹 The encode is stopped if its projected size goes over\n"
+                )
+
+            await callback_query.edit_message_text(
+                f"🎯 **Select Target Size:**\n\n"
+                + how
+                + f"🔹 **Off:** Constant quality (CRF) encoding\n\n"
+                f"📝 **Current:** {target_size_label(session, detailed=True)}",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+
+        elif setting_type == "content":
             keyboard = InlineKeyboardMarkup([
                 [
-                    InlineKeyboardButton('H.264 (libx264)', callback_data='set_video_codec_libx264'),
-                    InlineKeyboardButton('H.265 (libx265)', callback_data='set_video_codec_libx265')
+                    InlineKeyboardButton('Auto', callback_data='set_content_auto'),
+                    InlineKeyboardButton('Auto + Denoise', callback_data='set_content_denoise')
                 ],
+                [InlineKeyboardButton('Off', callback_data='set_content_off')],
                 [InlineKeyboardButton('🔙 Back', callback_data='back_to_encoding')]
             ])
-            
+
             await callback_query.edit_message_text(
-                f"📹 **Select Video Codec:**\n\n"
-                f"🔹 **H.264 (libx264):** Universal compatibility\n"
-                f"🔹 **H.265 (libx265):** Better compression, newer devices\n\n"
-                f"📝 **Current:** {session.video_codec}",
+                f"🧠 **Content Tuning:**\n\n"
+                f"🔹 A short sample is analysed before encoding\n"
+                f"🔹 **Static / screen:** Duplicate frames dropped, variable frame rate\n"
+                f"🔹 **Animation, grain, film:** Matching encoder tune\n"
+                f"🔹 **Auto + Denoise:** Also cleans up grainy sources\n"
+                f"🔹 **Off:** Encode every frame with default tuning\n\n"
+                f"📝 **Current:** {content_label(session)}",
+                reply_markup=keyboard
+            )
+
+        elif setting_type == "fps":
+            caps = ENCODING_SETTINGS["fps_caps"]
+            keyboard = [[
+                InlineKeyboardButton(f'≤ {fps} fps', callback_data=f'set_fps_{fps}')
+                for fps in caps[i:i + 3]
+            ] for i in range(0, len(caps), 3)]
+            keyboard.append([InlineKeyboardButton('Original', callback_data='set_fps_0')])
+            keyboard.append([InlineKeyboardButton('🔙 Back', callback_data='back_to_encoding')])
+
+            await callback_query.edit_message_text(
+                f"🎞️ **Select Max Frame Rate:**\n\n"
+                f"🔹 Faster sources are reduced by dropping whole frames (60 → 30, 50 → 25)\n"
+                f"🔹 Halves encode time and size on high frame rate phone videos\n"
+                f"🔹 **Original:** Keep the source frame rate\n\n"
+                f"📝 **Current:** {fps_label(session)}",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+
+        elif setting_type == "parts":
+            keyboard = [[
+                InlineKeyboardButton(f'{minutes} min', callback_data=f'set_parts_{minutes}')
+                for minutes in ENCODING_SETTINGS["part_minutes"]
+            ]]
+            keyboard.append([InlineKeyboardButton('Off (one file)', callback_data='set_parts_0')])
+            keyboard.append([InlineKeyboardButton('🔙 Back', callback_data='back_to_encoding')])
+
+            await callback_query.edit_message_text(
+                f"🧩 **Deliver in Parts:**\n\n"
+                f"🔹 The video is cut at keyframes into parts of about this length\n"
+                f"🔹 Parts are encoded {max(PARALLEL_PART_ENCODES, 1)} at a time and sent in order as each is ready\n"
+                f"🔹 The first part arrives in minutes, a failed part is encoded again on its own\n"
+                f"🔹 Uses CRF; a target size is turned off\n\n"
+                f"📝 **Current:** {parts_label(session)}",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+
+        elif setting_type == "auto_crop":
+            keyboard = InlineKeyboardMarkup([
+                [
+                    InlineKeyboardButton('On', callback_data='set_auto_crop_on'),
+                    InlineKeyboardButton('Off', callback_data='set_auto_crop_off')
+                ],
+                [InlineKeyboardButton('🔙 Back', callback_data='back_to_encoding')]
+            ])
+
+            await callback_query.edit_message_text(
+                f"🔲 **Auto Crop Black Borders:**\n\n"
+                f"🔹 Samples a few spots of the video to find letterbox or pillarbox bars\n"
+                f"🔹 Bars are cut off before scaling, saving encode time and size\n"
+                f"🔹 Nothing is cropped unless every sample agrees on the bars\n\n"
+                f"📝 **Current:** {'On' if session.auto_crop else 'Off'}",
                 reply_markup=keyboard
             )
 
@@ -431,85 +872,365 @@ async def start_compression_process(bot: Client, callback_query):
         # Mark user as having active process
         CURRENT_PROCESSES[user_id] = True
 
+        # Check the stream plan on the file header before paying for the download
+        preflight_probe = session.source_probe
+        if not session.source_path and preflight_probe is None:
+            await callback_query.edit_message_text("🔎 **Checking streams...**")
+            preflight_probe = await probe_source_head(bot, session)
+        if preflight_probe:
+            # Settings may have changed since a preview, so always check against the current ones
+            error = apply_preflight(session, preflight_probe)
+            if error:
+                await cleanup_process(user_id, callback_query.message, None, error)
+                return
+
         # Update message to show compression started
-        await callback_query.edit_message_text(
-            f"🚀 **Encoding Started!**\n\n"
-            f"⚙️ **Settings:**\n"
-            f"🔹 **Quality:** {session.quality}\n"
-            f"🔹 **CRF:** {session.crf}\n"
-            f"🔹 **Preset:** {session.preset}\n"
-            f"🔹 **Resolution:** {session.resolution or 'Original'}\n"
-            f"🔹 **Codec:** {session.video_codec}\n\n"
-            f"📥 **Starting download...**"
-        )
-
-        # Generate file paths
-        user_file = f"{user_id}_{int(time.time())}.mkv"
-        saved_file_path = os.path.join(DOWNLOAD_LOCATION, user_file)
-
-        # Start download
-        d_start = time.time()
-        
-        try:
-            video_download = await bot.download_media(
-                message=video_message,
-                file_name=saved_file_path,
+        if session.mode == "remux":
+            await callback_query.edit_message_text(
+                f"🚀 **Remux Started!**\n\n"
+                f"📦 Compatible streams are copied into MP4, only the rest is converted.\n\n"
+                f"📥 **Starting download...**"
+            )
+        elif session.mode == "ladder":
+            await callback_query.edit_message_text(
+                f"🚀 **Ladder Started!**\n\n"
+                f"🪜 **Renditions:** {', '.join(q for q in LADDER_QUALITIES if q in session.ladder)}\n"
+                f"🔹 **Codec:** {session.video_codec}\n"
+                f"🔹 **Range:** {trim_label(session)}\n\n"
+                f"📥 **Starting download...**"
+            )
+        elif session.mode == "trim":
+            await callback_query.edit_message_text(
+                f"🚀 **Cut Started!**\n\n"
+                f"✂️ **Keeping:** {trim_label(session)}\n\n"
+                f"📥 **Starting download...**"
+            )
+        else:
+            await callback_query.edit_message_text(
+                f"🚀 **Encoding Started!**\n\n"
+                f"⚙️ **Settings:**\n"
+                f"🔹 **Quality:** {session.quality}\n"
+                f"🔹 **CRF:** {session.crf}\n"
+                f"🔹 **Preset:** {session.preset}\n"
+                f"🔹 **Resolution:** {resolution_label(session)}\n"
+                f"🔹 **Codec:** {session.video_codec}\n"
+                f"🔹 **Range:** {trim_label(session)}\n\n"
+                f"{preflight_lines(session)}"
+                f"📥 **Starting download...**"
+            )
+
+        session.status_message = callback_query.message
+        session.started_at = time.time()
+
+        async def download_and_compress():
+            # A preview may already have fetched the source
+            if not await download_source(bot, session, callback_query.message):
+                return
+
+            if not apply_trim_bounds(session):
+                await cleanup_process(user_id, callback_query.message, None, "Trim range is outside the video")
+                await cleanup_files_and_process(user_id, [session.source_path, session.thumb_path])
+                return
+
+            await compress_and_upload(bot, session)
+
+        await run_user_job(user_id, download_and_compress())
+
+    except Exception as e:
+        LOGGER.error(f"Error in compression process: {e}")
+        if user_id in CURRENT_PROCESSES:
+            del CURRENT_PROCESSES[user_id]
+        await callback_query.message.edit_text("❌ An error occurred during compression.")
+
+async def download_source(bot: Client, session: CompressionSettings, message) -> bool:
+    """Download the video once per session; previews, encodes and retries all reuse it"""
+    user_id = session.user_id
+    if session.source_path and os.path.exists(session.source_path):
+        return True
+
+    # Generate file paths
+    user_file = f"{user_id}_{int(time.time())}.mkv"
+    saved_file_path = os.path.join(DOWNLOAD_LOCATION, user_file)
+
+    # Start download
+    d_start = time.time()
+
+    try:
+        video_download = await asyncio.wait_for(
+            downloader.fetch_file(
+                bot,
+                session.video_message,
+                saved_file_path,
                 progress=progress_for_pyrogram,
                 progress_args=(
                     "Downloading",
-                    callback_query.message,
+                    message,
                     d_start,
                     bot
                 )
-            )
+            ),
+            timeout=TIMEOUT_DOWNLOAD or None
+        )
 
-            if not video_download or not os.path.exists(video_download):
-                await cleanup_process(user_id, callback_query.message, None, "Download failed")
-                return
+        if not video_download or not os.path.exists(video_download):
+            await cleanup_process(user_id, message, None, "Download failed")
+            return False
 
-        except Exception as e:
-            LOGGER.error(f"Download error: {e}")
-            await cleanup_process(user_id, callback_query.message, None, f"Download failed: {e}")
+    except asyncio.TimeoutError:
+        LOGGER.error(f"Download timed out for user {user_id}")
+        await cleanup_process(
+            user_id, message, None,
+            f"Download exceeded its {TimeFormatter(TIMEOUT_DOWNLOAD * 1000)} deadline"
+        )
+        return False
+
+    except Exception as e:
+        LOGGER.error(f"Download error: {e}")
+        await cleanup_process(user_id, message, None, f"Download failed: {e}")
+        return False
+
+    # Get media info
+    duration, bitrate = await media_info(saved_file_path)
+    if duration is None:
+        await cleanup_process(user_id, message, None, "Invalid video file")
+        return False
+
+    # The header check may have been inconclusive, so validate the full probe too
+    probe = await probe_media(saved_file_path)
+    if probe:
+        session.source_probe = probe
+        error = apply_preflight(session, probe)
+        if error:
+            await cleanup_process(user_id, message, None, error)
+            return False
+
+    # Generate thumbnail from the middle of the part that will be kept
+    middle = (session.trim_start + min(session.trim_end, duration)) / 2 if session.trim_end else duration / 2
+    thumb_image_path = await take_screen_shot(
+        saved_file_path,
+        os.path.dirname(saved_file_path),
+        middle
+    )
+
+    # Keep the source around so the encode can be retried without a new download
+    session.source_path = saved_file_path
+    session.source_duration = duration
+    session.thumb_path = thumb_image_path
+    return True
+
+async def probe_source_head(bot: Client, session: CompressionSettings) -> Optional[Dict[str, Any]]:
+    """
+    Probe the first few megabytes of the source. Matroska and faststart MP4
+    keep their stream headers there; None when the header is not enough.
+    """
+    head_path = os.path.join(DOWNLOAD_LOCATION, f"{session.user_id}_{int(time.time())}_head.mkv")
+    try:
+        with open(head_path, 'wb') as f:
+            async for chunk in bot.stream_media(session.video_message, limit=PREFLIGHT_HEAD_CHUNKS):
+                f.write(chunk)
+        probe = await probe_media(head_path)
+        return probe if probe and probe['streams'] else None
+    except Exception as e:
+        LOGGER.warning(f"Header probe failed for user {session.user_id}: {e}")
+        return None
+    finally:
+        if os.path.exists(head_path):
+            os.remove(head_path)
+
+def apply_preflight(session: CompressionSettings, probe: Dict[str, Any]) -> Optional[str]:
+    """Correct the session's stream plan for the output container, returning a fatal reason if any"""
+    result = preflight_stream_plan(
+        probe, session.audio_codec, session.mode, ENCODERS.get(session.video_codec).container
+    )
+    if result['error']:
+        return result['error']
+    session.audio_codec = result['audio_codec']
+    for fix in result['fixes']:
+        if fix not in session.preflight_fixes:
+            LOGGER.info(f"Preflight for user {session.user_id}: {fix}")
+            session.preflight_fixes.append(fix)
+    return None
+
+def preflight_lines(session: CompressionSettings) -> str:
+    """Message lines listing what the preflight changed, empty when nothing"""
+    if not session.preflight_fixes:
+        return ""
+    return "🛠 **Auto-fixed:**\n" + "".join(f"🔹 {fix}\n" for fix in session.preflight_fixes) + "\n"
+
+def apply_trim_bounds(session: CompressionSettings) -> bool:
+    """Clamp the trim range to the source and set the duration that gets processed"""
+    duration = session.source_duration
+    if session.trim_end:
+        session.trim_end = min(session.trim_end, duration)
+        if session.trim_start >= session.trim_end:
+            return False
+        # Only the kept range is processed, so progress and uploads use its length
+        duration = session.trim_end - session.trim_start
+    session.duration = duration
+    return True
+
+async def generate_preview(bot: Client, callback_query):
+    """Encode a short sample from the middle with the current settings and send it back"""
+    user_id = callback_query.from_user.id
+    session = USER_SESSIONS.get(user_id)
+
+    if not session:
+        await callback_query.answer("❌ Session expired. Please send video again.", show_alert=True)
+        return
+
+    if user_id in CURRENT_PROCESSES:
+        await callback_query.answer("❌ You already have an active compression!", show_alert=True)
+        return
+
+    CURRENT_PROCESSES[user_id] = True
+    await run_user_job(user_id, preview_job(bot, callback_query, session))
+
+async def preview_job(bot: Client, callback_query, session: CompressionSettings):
+    """Fetch the source if needed, then encode, send and project the preview sample"""
+    user_id = session.user_id
+    message = callback_query.message
+    preview_file = os.path.join(
+        DOWNLOAD_LOCATION,
+        f"preview_{user_id}_{int(time.time())}{ENCODERS.get(session.video_codec).extension}"
+    )
+
+    try:
+        await callback_query.edit_message_text(
+            f"👁 **Preparing Preview...**\n\n"
+            f"📥 **Fetching the video, it is kept for the full encode.**"
+        )
+
+        if not await download_source(bot, session, message):
             return
 
-        # Get media info
-        duration, bitrate = await media_info(saved_file_path)
-        if duration is None:
-            await cleanup_process(user_id, callback_query.message, None, "Invalid video file")
+        if not apply_trim_bounds(session):
+            await message.edit_text(
+                "❌ **Trim range is outside the video.**",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton('🔙 Back', callback_data='back_to_quality')
+                ]])
+            )
             return
 
-        # Generate thumbnail
-        thumb_image_path = await take_screen_shot(
-            saved_file_path,
-            os.path.dirname(saved_file_path),
-            duration / 2
+        await prepare_video_filters(session.source_path, DOWNLOAD_LOCATION, message, session)
+
+        total_time = session.duration
+        sample_length = min(PREVIEW_SECONDS, total_time)
+        # Input seek to the middle of the kept range keeps the sample fast to produce
+        sample_start = (session.trim_start if session.trim_end else 0) + (total_time - sample_length) / 2
+
+        rate_args = None
+        if session.size_limit:
+            # One pass at the target's bitrate is close enough for a look at quality
+            kbps = max(target_video_bitrate(session.size_limit, total_time, session.audio_bitrate) // 1000, 1)
+            rate_args = ["-b:v", f"{kbps}k", "-maxrate", f"{kbps * 2}k", "-bufsize", f"{kbps * 2}k"]
+
+        job = FFmpegJob(f"{user_id}_{int(time.time())}_preview", stage="preview")
+        progress_file = os.path.join(DOWNLOAD_LOCATION, f"progress_{job.job_id}.txt")
+        cmd = build_encode_command(
+            session, session.source_path, progress_file, preview_file,
+            rate_args=rate_args, sample=(sample_start, sample_length)
+        )
+        await run_encode(cmd, job, progress_file, sample_length, message, session, label="Preview")
+
+        if job.failure_reason or not os.path.exists(preview_file):
+            await message.edit_text(
+                f"❌ **Preview failed**\n\n🔍 **Reason:** {job.failure_reason or 'No output'}",
+                reply_markup=encoding_settings_keyboard(session)
+            )
+            return
+
+        sample_size = os.path.getsize(preview_file)
+        # Scale the media bytes only; the full encode reserves its own index space
+        media_size = max(sample_size - job.reserved_bytes, 0)
+        full_reserve = reserved_index_bytes(output_muxer_args(session, ENCODERS.get(session.video_codec), total_time))
+        projected_size = int(media_size * total_time / max(sample_length, 1)) + full_reserve
+
+        await send_output_file(
+            bot, session, message.chat.id, preview_file,
+            caption=(
+                f"👁 **Preview** ({int(sample_length)}s from the middle)\n\n"
+                f"🔹 **CRF:** {session.crf} | **Preset:** {session.preset}\n"
+                f"🔹 **Resolution:** {resolution_label(session)} | **Codec:** {session.video_codec}\n"
+                f"🔹 **Sample Size:** {humanbytes(sample_size)}\n"
+                f"📦 **Projected Full Size:** ~{humanbytes(projected_size)}\n"
+                f"📏 **Original:** {humanbytes(os.path.getsize(session.source_path))}"
+            ),
+            duration=sample_length,
+            reply_to_message_id=session.video_message.id
         )
 
+        await message.edit_text(
+            encoding_settings_text(session),
+            reply_markup=encoding_settings_keyboard(session)
+        )
+
+    except Exception as e:
+        LOGGER.error(f"Error generating preview: {e}")
+        await callback_query.answer("❌ Could not create the preview.", show_alert=True)
+
+    finally:
+        CURRENT_PROCESSES.pop(user_id, None)
+        if os.path.exists(preview_file):
+            os.remove(preview_file)
+
+async def compress_and_upload(bot: Client, session: CompressionSettings):
+    """Encode the downloaded source with the session settings and upload the result"""
+    if session.mode == "ladder":
+        return await ladder_and_upload(bot, session)
+    if session.mode == "encode" and session.part_minutes:
+        return await parts_and_upload(bot, session)
+
+    user_id = session.user_id
+    status_message = session.status_message
+    video_message = session.video_message
+    saved_file_path = session.source_path
+    thumb_image_path = session.thumb_path
+    duration = session.duration
+    compressed_file = None
+    # Only a size abort keeps the source, for a retry at a higher CRF
+    keep_source = False
+
+    try:
         # Start compression with custom settings
-        await callback_query.message.edit_text(
+        await status_message.edit_text(
             f"🎬 **Compressing Video...**\n\n"
             f"⚙️ **Using your custom settings**\n"
             f"⏳ **Please wait...**"
         )
 
         c_start = time.time()
-        
+        session.failure_reason = None
+        session.size_exceeded = False
+
         # Use custom compression function with user settings
         compressed_file = await convert_video_with_custom_settings(
             saved_file_path,
             DOWNLOAD_LOCATION,
             duration,
             bot,
-            callback_query.message,
+            status_message,
             session
         )
 
+        if session.size_exceeded:
+            keep_source = True
+            await offer_size_retry(session)
+            return
+
         if not compressed_file or not os.path.exists(compressed_file):
-            await cleanup_process(user_id, callback_query.message, None, "Compression failed")
+            await report_failed_job(
+                bot, user_id, session,
+                session.failure_reason or "Compression failed"
+            )
+            await cleanup_process(
+                user_id, status_message, None,
+                session.failure_reason or "Compression failed"
+            )
             return
 
         # Upload compressed file
-        await callback_query.message.edit_text(
+        await status_message.edit_text(
             f"📤 **Uploading compressed video...**\n"
             f"⏳ **Please wait...**"
         )
@@ -521,34 +1242,49 @@ async def start_compression_process(bot: Client, callback_query):
         compressed_size = os.path.getsize(compressed_file)
         compression_ratio = ((original_size - compressed_size) / original_size) * 100
 
+        if session.mode == "trim":
+            settings_lines = (
+                f"🔹 **Mode:** Smart cut\n"
+                f"🔹 **Range:** {trim_label(session)}\n\n"
+            )
+        elif session.mode == "remux":
+            settings_lines = (
+                f"🔹 **Mode:** Remux to MP4\n"
+                f"🔹 **Converted:** {', '.join(session.remux_transcoded) or 'Nothing, all streams copied'}\n\n"
+            )
+        else:
+            crf_line = str(session.crf)
+            if session.auto_quality_result:
+                crf_line += f" (auto, SSIM {session.auto_quality_result['ssim']:.3f})"
+            settings_lines = (
+                f"🔹 **Quality:** {session.quality}\n"
+                f"🔹 **CRF:** {crf_line}\n"
+                f"🔹 **Codec:** {session.video_codec}\n\n"
+                f"{preflight_lines(session)}"
+            )
+
         caption = (
             f"✅ **Compression Completed!**\n\n"
             f"📊 **Statistics:**\n"
             f"🔹 **Original:** {humanbytes(original_size)}\n"
             f"🔹 **Compressed:** {humanbytes(compressed_size)}\n"
             f"🔹 **Saved:** {compression_ratio:.1f}%\n"
-            f"🔹 **Quality:** {session.quality}\n"
-            f"🔹 **CRF:** {session.crf}\n"
-            f"🔹 **Codec:** {session.video_codec}\n\n"
-            f"⏱️ **Processing Time:** {TimeFormatter((time.time() - d_start) * 1000)}"
+            f"{settings_lines}"
+            f"⏱️ **Processing Time:** {TimeFormatter((time.time() - session.started_at) * 1000)}"
         )
 
-        upload = await bot.send_video(
-            chat_id=callback_query.message.chat.id,
-            video=compressed_file,
-            caption=caption,
-            supports_streaming=True,
-            duration=int(duration),
-            thumb=thumb_image_path,
-            reply_to_message_id=video_message.id,
-            progress=progress_for_pyrogram,
-            progress_args=(
-                "Uploading",
-                callback_query.message,
-                u_start,
-                bot
+        try:
+            upload = await asyncio.wait_for(
+                upload_output(bot, session, compressed_file, caption, u_start),
+                timeout=TIMEOUT_UPLOAD or None
             )
-        )
+        except asyncio.TimeoutError:
+            LOGGER.error(f"Upload timed out for user {user_id}")
+            await cleanup_process(
+                user_id, status_message, None,
+                f"Upload exceeded its {TimeFormatter(TIMEOUT_UPLOAD * 1000)} deadline"
+            )
+            return
 
         if upload:
             # Update database stats
@@ -559,127 +1295,870 @@ async def start_compression_process(bot: Client, callback_query):
                     pass
 
             # Delete progress message
-            await callback_query.message.delete()
+            await status_message.delete()
             
             # Log success
             LOGGER.info(f"Compression completed successfully for user {user_id}")
 
-        # Cleanup
-        await cleanup_files_and_process(user_id, [saved_file_path, compressed_file, thumb_image_path])
-
     except Exception as e:
         LOGGER.error(f"Error in compression process: {e}")
         if user_id in CURRENT_PROCESSES:
             del CURRENT_PROCESSES[user_id]
-        await callback_query.message.edit_text("❌ An error occurred during compression.")
+        await status_message.edit_text("❌ An error occurred during compression.")
+    finally:
+        # Also runs on cancel, so a multi-GB source never waits for the download sweep
+        if keep_source:
+            session.retry_expiry = asyncio.create_task(expire_size_retry(session))
+        else:
+            await cleanup_files_and_process(user_id, [saved_file_path, compressed_file, thumb_image_path])
+
+async def send_output_file(bot: Client, session: CompressionSettings, chat_id: int, path: str,
+                           caption: str, duration: float, **kwargs):
+    """
+    Send an encode as a streamable video when Telegram clients play its
+    codec, as a file otherwise. Large files are uploaded in parallel parts
+    and a failed send resumes without uploading those parts again.
+    """
+    backend = ENCODERS.get(session.video_codec)
+    inline = session.mode != "encode" or backend.telegram_inline
+    if not inline:
+        caption = f"{caption}\n\n📎 Sent as a file: not every Telegram client plays {backend.codec.upper()} inline."
+
+    if PARALLEL_UPLOAD_WORKERS > 1 and os.path.getsize(path) > BIG_FILE_THRESHOLD:
+        input_file = await ParallelUploader(
+            bot, path,
+            progress=kwargs.get('progress'),
+            progress_args=kwargs.get('progress_args', ())
+        ).upload()
+        return await retry_transfer(
+            lambda: send_uploaded_media(
+                bot, chat_id, input_file,
+                caption=caption,
+                duration=duration,
+                thumb_path=kwargs.get('thumb'),
+                reply_to_message_id=kwargs.get('reply_to_message_id'),
+                as_video=inline
+            ),
+            f"Sending {os.path.basename(path)}"
+        )
 
-async def convert_video_with_custom_settings(video_file, output_directory, total_time, bot, message, session):
-    """Convert video with custom user settings"""
-    try:
-        out_put_file_name = os.path.join(output_directory, f"{int(time.time())}.mp4")
-        progress_file = os.path.join(output_directory, "progress.txt")
-        
-        with open(progress_file, 'w') as f:
-            pass
+    # Single-connection sends start over on a retry; they are the small or opted-out files
+    if inline:
+        return await retry_transfer(
+            lambda: bot.send_video(
+                chat_id=chat_id, video=path, caption=caption,
+                supports_streaming=True, duration=int(duration), **kwargs
+            ),
+            f"Sending {os.path.basename(path)}"
+        )
+    return await retry_transfer(
+        lambda: bot.send_document(chat_id=chat_id, document=path, caption=caption, **kwargs),
+        f"Sending {os.path.basename(path)}"
+    )
 
-        # Build FFmpeg command with user settings
-        cmd = [
-            "ffmpeg",
-            "-hide_banner",
-            "-loglevel", "quiet",
-            "-progress", progress_file,
-            "-i", video_file,
-            "-c:v", session.video_codec,
-            "-preset", session.preset,
-            "-crf", str(session.crf),
-            "-pix_fmt", session.pixel_format
-        ]
+async def ladder_and_upload(bot: Client, session: CompressionSettings):
+    """
+    Encode all ladder renditions from one decode and upload them concurrently.
+    The renditions are outputs of a single ffmpeg run, which writes every
+    output's trailer when the input ends, so none can be sent earlier.
+    """
+    user_id = session.user_id
+    status_message = session.status_message
+    outputs = []
 
-        # Add resolution if specified
-        if session.resolution and session.resolution != "Original":
-            cmd.extend(["-s", session.resolution])
+    try:
+        session.failure_reason = None
+        outputs = await encode_ladder(
+            session.source_path, DOWNLOAD_LOCATION, session.duration, status_message, session
+        )
+        if not outputs:
+            reason = session.failure_reason or "Ladder encode failed"
+            await report_failed_job(bot, user_id, session, reason)
+            await cleanup_process(user_id, status_message, None, reason)
+            return
 
-        # Add audio settings
-        if session.audio_codec == "copy":
-            cmd.extend(["-c:a", "copy"])
-        else:
-            cmd.extend(["-c:a", session.audio_codec, "-b:a", session.audio_bitrate])
+        await status_message.edit_text(
+            f"📤 **Uploading {len(outputs)} renditions...**\n"
+            f"⏳ **Please wait...**"
+        )
 
-        # Add output optimizations
-        cmd.extend(["-movflags", "+faststart", "-y", out_put_file_name])
+        original_size = os.path.getsize(session.source_path)
+        processing_time = TimeFormatter((time.time() - session.started_at) * 1000)
+
+        async def send_rendition(quality, output_file):
+            size = os.path.getsize(output_file)
+            caption = (
+                f"✅ **{quality} Rendition**\n\n"
+                f"🔹 **Original:** {humanbytes(original_size)}\n"
+                f"🔹 **This rendition:** {humanbytes(size)}\n"
+                f"🔹 **Codec:** {session.video_codec}\n\n"
+                f"⏱️ **Processing Time:** {processing_time}"
+            )
+            return await upload_output(bot, session, output_file, caption, time.time())
 
-        LOGGER.info(f"FFmpeg command: {' '.join(cmd)}")
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*(send_rendition(quality, path) for quality, path in outputs)),
+                timeout=TIMEOUT_UPLOAD or None
+            )
+        except asyncio.TimeoutError:
+            await cleanup_process(
+                user_id, status_message, None,
+                f"Upload exceeded its {TimeFormatter(TIMEOUT_UPLOAD * 1000)} deadline"
+            )
+            return
 
-        # Start process
-        start_time = time.time()
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        if all(results):
+            if db:
+                try:
+                    await db.increment_user_compression(user_id, original_size)
+                except:
+                    pass
+            await status_message.delete()
+            LOGGER.info(f"Ladder of {len(outputs)} renditions completed for user {user_id}")
+
+    except Exception as e:
+        LOGGER.error(f"Error in ladder process: {e}")
+        if user_id in CURRENT_PROCESSES:
+            del CURRENT_PROCESSES[user_id]
+        await status_message.edit_text("❌ An error occurred during compression.")
+    finally:
+        await cleanup_files_and_process(
+            user_id, [session.source_path, session.thumb_path] + [path for _, path in outputs]
         )
 
-        LOGGER.info(f"Compression process started: {process.pid}")
+async def parts_and_upload(bot: Client, session: CompressionSettings):
+    """
+    Cut the source at keyframes into parts of session.part_minutes, encode
+    them PARALLEL_PART_ENCODES at a time and send each one as soon as it and
+    every part before it are ready. A failed part is encoded again on its own.
+    """
+    start = session.trim_start if session.trim_end else 0
+    end = session.trim_end or session.duration
+    if not end or end - start <= session.part_minutes * 60 * 1.25:
+        # Not long enough to be worth cutting: one file as usual
+        session.part_minutes = None
+        return await compress_and_upload(bot, session)
+
+    user_id = session.user_id
+    status_message = session.status_message
+    video_file = session.source_path
+    tasks, outputs = [], []
 
-        # Monitor progress
-        while process.returncode is None:
-            await asyncio.sleep(3)
-            
+    try:
+        session.failure_reason = None
+        await prepare_video_filters(video_file, DOWNLOAD_LOCATION, status_message, session)
+
+        if session.auto_quality and not session.auto_quality_result:
+            crf = await find_auto_crf(video_file, DOWNLOAD_LOCATION, end - start, status_message, session)
+            if crf is not None:
+                session.crf = crf
+
+        ranges = await chunk_ranges(video_file, start, end, session.part_minutes * 60)
+        total = len(ranges)
+        backend = ENCODERS.get(session.video_codec)
+        stamp = int(time.time())
+        semaphore = asyncio.Semaphore(max(PARALLEL_PART_ENCODES, 1))
+        encoded, sent = [], []
+
+        async def show_parts():
             try:
-                if not os.path.exists(progress_file):
-                    continue
-                    
-                with open(progress_file, 'r') as file:
-                    text = file.read()
-
-                # Parse progress
-                time_match = re.findall(r"out_time_ms=(\d+)", text)
-                progress_match = re.findall(r"progress=(\w+)", text)
-                speed_match = re.findall(r"speed=([\d.]+)", text)
-
-                if progress_match and progress_match[-1] == "end":
-                    LOGGER.info("Compression completed")
-                    break
-
-                if time_match and total_time > 0:
-                    elapsed_time = int(time_match[-1]) / 1000000
-                    percentage = min(int(elapsed_time * 100 / total_time), 100)
-
-                    # Calculate ETA
-                    if speed_match and float(speed_match[-1]) > 0:
-                        remaining_time = (total_time - elapsed_time) / float(speed_match[-1])
-                        eta = TimeFormatter(int(remaining_time * 1000)) if remaining_time > 0 else "-"
-                    else:
-                        eta = "-"
-
-                    # Update progress
-                    execution_time = TimeFormatter((time.time() - start_time) * 1000)
-                    stats = (
-                        f"🎬 **Compressing Video** ({session.quality})\n\n"
-                        f"📊 **Progress:** {percentage}%\n"
-                        f"⏰ **ETA:** {eta}\n"
-                        f"⏱️ **Elapsed:** {execution_time}\n"
-                        f"🎯 **CRF:** {session.crf}\n"
-                        f"⚙️ **Preset:** {session.preset}\n"
-                        f"📹 **Codec:** {session.video_codec}"
+                await status_message.edit_text(
+                    f"🧩 **Delivering in Parts** ({session.quality})\n\n"
+                    f"🎬 **Encoded:** {len(encoded)}/{total}\n"
+                    f"📤 **Sent:** {len(sent)}/{total}\n"
+                    f"🎯 **CRF:** {session.crf}\n"
+                    f"⚙️ **Preset:** {session.preset}\n"
+                    f"📹 **Codec:** {session.video_codec}",
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
+                    ]])
+                )
+            except:
+                pass
+
+        async def encode_part(index, part_start, length):
+            output = os.path.join(DOWNLOAD_LOCATION, f"{stamp}_part{index}{backend.extension}")
+            outputs.append(output)
+            async with semaphore:
+                for attempt in range(1, PART_ENCODE_ATTEMPTS + 1):
+                    job = FFmpegJob(f"{user_id}_{stamp}_part{index}")
+                    progress_file = os.path.join(DOWNLOAD_LOCATION, f"progress_{job.job_id}.txt")
+                    cmd = build_encode_command(
+                        session, video_file, progress_file, output, sample=(part_start, length)
                     )
-
                     try:
-                        await message.edit_text(
-                            text=stats,
-                            reply_markup=InlineKeyboardMarkup([[
-                                InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
-                            ]])
-                        )
-                    except:
-                        pass
+                        await run_with_index_fallback(cmd, job, progress_file, length)
+                    finally:
+                        if os.path.exists(progress_file):
+                            os.remove(progress_file)
+                    if _finish_output(output, job):
+                        encoded.append(index)
+                        await show_parts()
+                        return output
+                    LOGGER.warning(f"Part {index}/{total} attempt {attempt} failed: {job.failure_reason}")
+                    session.failure_reason = f"Part {index} of {total}: {job.failure_reason}"
+                    session.failure_log = job.stderr_tail
+            return None
+
+        await show_parts()
+        tasks = [
+            asyncio.create_task(encode_part(index, part_start, length))
+            for index, (part_start, length) in enumerate(ranges, start=1)
+        ]
+
+        # Parts go out in order; later parts keep encoding while one uploads
+        for index, task in enumerate(tasks, start=1):
+            output = await task
+            if user_id not in CURRENT_PROCESSES:
+                LOGGER.info(f"Parts delivery cancelled by user {user_id} after {len(sent)}/{total}")
+                return
+            if not output:
+                reason = session.failure_reason or f"Part {index} of {total} failed"
+                await report_failed_job(bot, user_id, session, reason)
+                await cleanup_process(
+                    user_id, status_message, None,
+                    f"{reason}. {len(sent)} of {total} parts were delivered"
+                )
+                return
+
+            part_start, length = ranges[index - 1]
+            caption = (
+                f"🧩 **Part {index}/{total}**\n\n"
+                f"🔹 **Range:** {TimeFormatter(part_start * 1000)} → {TimeFormatter((part_start + length) * 1000)}\n"
+                f"🔹 **Size:** {humanbytes(os.path.getsize(output))}\n"
+                f"🔹 **Quality:** {session.quality}\n"
+                f"🔹 **CRF:** {session.crf}\n"
+                f"🔹 **Codec:** {session.video_codec}"
+            )
+            try:
+                if os.path.getsize(output) > TG_MAX_FILE_SIZE:
+                    upload = await asyncio.wait_for(
+                        upload_output(bot, session, output, caption, time.time(), duration=length),
+                        timeout=TIMEOUT_UPLOAD or None
+                    )
+                else:
+                    upload = await asyncio.wait_for(
+                        send_output_file(
+                            bot, session, status_message.chat.id, output,
+                            caption=caption,
+                            duration=length,
+                            thumb=session.thumb_path,
+                            reply_to_message_id=session.video_message.id
+                        ),
+                        timeout=TIMEOUT_UPLOAD or None
+                    )
+            except asyncio.TimeoutError:
+                upload = None
+            if not upload:
+                await cleanup_process(
+                    user_id, status_message, None,
+                    f"Upload of part {index} of {total} failed. {len(sent)} of {total} parts were delivered"
+                )
+                return
+            os.remove(output)
+            sent.append(index)
+            await show_parts()
 
+        if db:
+            try:
+                await db.increment_user_compression(user_id, os.path.getsize(video_file))
+            except:
+                pass
+        await status_message.delete()
+        LOGGER.info(f"Delivered {total} parts for user {user_id}")
+
+    except Exception as e:
+        LOGGER.error(f"Error in parts delivery: {e}")
+        if user_id in CURRENT_PROCESSES:
+            del CURRENT_PROCESSES[user_id]
+        await status_message.edit_text("❌ An error occurred during compression.")
+    finally:
+        # Stops encodes still running after a failure or cancel
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await cleanup_files_and_process(
+            user_id, [session.source_path, session.thumb_path] + outputs
+        )
+
+async def upload_output(bot: Client, session: CompressionSettings, output_file: str,
+                        caption: str, u_start: float, duration: float = None) -> bool:
+    """
+    Send the encode, split into Telegram-sized parts when it is over the cap.
+    duration is the output's length, the session's kept range by default.
+    """
+    status_message = session.status_message
+    video_message = session.video_message
+    duration = duration or session.duration
+
+    # Most of the file already went up during the encode; only the tail is left
+    stream, session.stream_upload = session.stream_upload, None
+    if stream and stream.path == output_file:
+        input_file = await stream.result()
+        if input_file:
+            size = planned_size(session) or (0, 0)
+            try:
+                upload = await retry_transfer(
+                    lambda: send_uploaded_media(
+                        bot, status_message.chat.id, input_file,
+                        caption=caption,
+                        duration=duration,
+                        width=size[0],
+                        height=size[1],
+                        thumb_path=session.thumb_path,
+                        reply_to_message_id=video_message.id
+                    ),
+                    f"Sending {os.path.basename(output_file)}"
+                )
             except Exception as e:
-                LOGGER.error(f"Progress monitoring error: {e}")
-                continue
+                LOGGER.error(f"Sending streamed upload failed: {e}")
+                upload = None
+            if upload:
+                return True
+        LOGGER.info(f"Streamed upload of {output_file} not usable, uploading it again")
+
+    if not ENABLE_SPLIT_UPLOAD or os.path.getsize(output_file) <= TG_MAX_FILE_SIZE:
+        upload = await send_output_file(
+            bot, session, status_message.chat.id, output_file,
+            caption=caption,
+            duration=duration,
+            thumb=session.thumb_path,
+            reply_to_message_id=video_message.id,
+            progress=progress_for_pyrogram,
+            progress_args=(
+                "Uploading",
+                status_message,
+                u_start,
+                bot
+            )
+        )
+        return bool(upload)
+
+    await status_message.edit_text(
+        f"✂️ **Splitting output into parts...**\n\n"
+        f"📦 **Size:** {humanbytes(os.path.getsize(output_file))}\n"
+        f"🔢 **Telegram limit:** {humanbytes(TG_MAX_FILE_SIZE)}"
+    )
+
+    parts = await split_video(output_file, DOWNLOAD_LOCATION, TG_MAX_FILE_SIZE, duration)
+    if not parts:
+        await status_message.edit_text("❌ **Could not split the output into uploadable parts.**")
+        return False
+
+    total = len(parts)
+    done = []
+    semaphore = asyncio.Semaphore(max(PARALLEL_PART_UPLOADS, 1))
+
+    async def send_part(index: int, part: str):
+        async with semaphore:
+            part_duration, _ = await media_info(part)
+            upload = await send_output_file(
+                bot, session, status_message.chat.id, part,
+                caption=f"📦 **Part {index}/{total}**\n\n{caption}",
+                duration=part_duration or 0,
+                thumb=session.thumb_path,
+                reply_to_message_id=video_message.id
+            )
+            done.append(index)
+            try:
+                await status_message.edit_text(
+                    f"📤 **Uploading {total} parts...**\n\n"
+                    f"✅ **Sent:** {len(done)}/{total}"
+                )
+            except Exception:
+                pass
+            return upload
+
+    try:
+        results = await asyncio.gather(
+            *(send_part(index, part) for index, part in enumerate(parts, start=1))
+        )
+    finally:
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+
+    return all(results)
+
+async def offer_size_retry(session: CompressionSettings):
+    """Encode was aborted for size: free the slot and let the user pick what to do"""
+    if session.user_id in CURRENT_PROCESSES:
+        del CURRENT_PROCESSES[session.user_id]
+
+    session.retry_crf = suggest_crf(session.crf, session.projected_size, session.size_limit_used)
+
+    await session.status_message.edit_text(
+        f"⚠️ **Encode stopped early**\n\n"
+        f"📈 **Projected size:** {humanbytes(session.projected_size)}\n"
+        f"🔢 **Limit:** {humanbytes(session.size_limit_used)}\n"
+        f"🎯 **CRF used:** {session.crf}\n\n"
+        f"💡 The output would not have been smaller, so the rest of the encode was skipped.",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(f'🔁 Retry with CRF {session.retry_crf}', callback_data='retry_higher_crf')],
+            [InlineKeyboardButton('📤 Send Original', callback_data='send_original')],
+            [InlineKeyboardButton('❌ Cancel', callback_data='discard_retry')]
+        ])
+    )
+
+async def expire_size_retry(session: CompressionSettings):
+    """Drop the kept source when the size retry choice is not made in time"""
+    await asyncio.sleep(SIZE_RETRY_EXPIRY)
+    if USER_SESSIONS.get(session.user_id) is not session or session.user_id in CURRENT_PROCESSES:
+        return
+    LOGGER.info(f"Size retry of user {session.user_id} expired, removing the source")
+    session.retry_expiry = None
+    await cleanup_files_and_process(session.user_id, [session.source_path, session.thumb_path])
+    try:
+        await session.status_message.edit_text(
+            "⌛ **Retry expired**\n\n"
+            "🔄 You can send the video again to start over."
+        )
+    except:
+        pass
+
+def stop_size_retry_expiry(session: CompressionSettings):
+    """The user answered the size retry offer; the source is handled by their choice"""
+    if session and session.retry_expiry and not session.retry_expiry.done():
+        session.retry_expiry.cancel()
+    if session:
+        session.retry_expiry = None
+
+async def retry_with_higher_crf(bot: Client, callback_query):
+    """Re-run the encode on the already downloaded source with the suggested CRF"""
+    user_id = callback_query.from_user.id
+    session = USER_SESSIONS.get(user_id)
+
+    if not session or not session.source_path or not os.path.exists(session.source_path):
+        await callback_query.answer("❌ Session expired. Please send video again.", show_alert=True)
+        return
+
+    if user_id in CURRENT_PROCESSES:
+        await callback_query.answer("❌ You already have an active compression!", show_alert=True)
+        return
+
+    stop_size_retry_expiry(session)
+    CURRENT_PROCESSES[user_id] = True
+    session.crf = session.retry_crf or min(session.crf + 4, 51)
+    session.status_message = callback_query.message
+    await run_user_job(user_id, compress_and_upload(bot, session))
+
+async def send_original_video(bot: Client, callback_query):
+    """Forward the untouched source instead of a larger encode"""
+    user_id = callback_query.from_user.id
+    session = USER_SESSIONS.get(user_id)
+
+    if not session:
+        await callback_query.answer("❌ Session expired. Please send video again.", show_alert=True)
+        return
+
+    stop_size_retry_expiry(session)
+    try:
+        await session.video_message.copy(
+            chat_id=callback_query.message.chat.id,
+            caption="📤 **Original video** (compression would not reduce its size)",
+            reply_to_message_id=session.video_message.id
+        )
+        await callback_query.message.delete()
+    except Exception as e:
+        LOGGER.error(f"Error sending original video: {e}")
+        await callback_query.answer("❌ Could not send the original.", show_alert=True)
+
+    await cleanup_files_and_process(user_id, [session.source_path, session.thumb_path])
+
+async def discard_size_retry(bot: Client, callback_query):
+    """Drop the kept source after an aborted encode"""
+    user_id = callback_query.from_user.id
+    session = USER_SESSIONS.get(user_id)
+    files = [session.source_path, session.thumb_path] if session else []
+    stop_size_retry_expiry(session)
+
+    await cleanup_files_and_process(user_id, files)
+    await callback_query.edit_message_text(
+        "❌ **Process Cancelled**\n\n"
+        "🔄 You can send a new video anytime to start again."
+    )
+
+def planned_size(session: CompressionSettings, resolution: str = None) -> Optional[tuple]:
+    """
+    Output size the planner picks for the session: the cropped or full
+    source fitted into resolution (the session's by default) without
+    upscaling, None when the source size is unknown.
+    """
+    if not session.source_size:
+        return None
+    base = session.source_size
+    if session.crop_filter:
+        crop_w, crop_h = (int(v) for v in session.crop_filter[len("crop="):].split(':')[:2])
+        base = (
+            int(round(crop_w * session.pixel_scale[0])),
+            int(round(crop_h * session.pixel_scale[1]))
+        )
+    resolution = resolution or session.resolution
+    target = resolution if resolution and resolution != "Original" else None
+    return fit_resolution(base, target) or base
+
+def resolution_label(session: CompressionSettings) -> str:
+    """Chosen resolution, with the size actually produced when the planner changes it"""
+    label = session.resolution or "Original"
+    planned = planned_size(session)
+    if planned and f"{planned[0]}x{planned[1]}" != label:
+        label += f" → {planned[0]}x{planned[1]}"
+    return label
+
+def output_scale_filters(session: CompressionSettings, resolution: str = None) -> list:
+    """Filters that bring the picture to its planned size, only ever scaling down"""
+    resolution = resolution or session.resolution
+    target = resolution if resolution and resolution != "Original" else None
+    planned = planned_size(session, resolution)
+
+    if planned:
+        untouched = (
+            planned == session.source_size
+            and not session.crop_filter
+            and session.pixel_scale == (1, 1)
+        )
+        if untouched:
+            return []
+        scale = [f"scale={planned[0]}:{planned[1]}"]
+        if session.pixel_scale != (1, 1):
+            scale.append("setsar=1")
+        return scale
+
+    if not target:
+        return []
+    # Size unknown: let the scaler keep the aspect ratio and refuse to upscale
+    box_w, box_h = target.split('x')
+    return [
+        f"scale=w='min({box_w},iw)':h='min({box_h},ih)'"
+        f":force_original_aspect_ratio=decrease:force_divisible_by=2"
+    ]
+
+def parts_label(session: CompressionSettings) -> str:
+    return f"{session.part_minutes} min" if session.part_minutes else "Off"
+
+def content_label(session: CompressionSettings) -> str:
+    """Content tuning mode, with the detected content once the sample was analysed"""
+    label = {"auto": "Auto", "denoise": "Auto + Denoise", "off": "Off"}.get(session.content_mode, "Auto")
+    if session.content_mode != "off" and session.content_profile:
+        label += f" ({session.content_profile['type']})"
+    return label
+
+def fps_label(session: CompressionSettings) -> str:
+    """Frame rate cap as shown in menus"""
+    return f"≤ {session.max_fps}" if session.max_fps else "Original"
+
+def crf_label(session: CompressionSettings) -> str:
+    """CRF as shown in menus, or the auto quality target when the search is on"""
+    if session.auto_quality:
+        return f"Auto (SSIM {session.auto_quality})"
+    return str(session.crf)
+
+def target_size_label(session: CompressionSettings, detailed: bool = False) -> str:
+    """Target size with the expected output size and video bitrate it implies"""
+    if not session.size_limit:
+        return "Off"
+
+    # The encode sizes for the kept range; before the download it comes from the message
+    duration = session.duration
+    if not duration:
+        video = session.video_message.video or session.video_message.document
+        duration = getattr(video, 'duration', 0) or 0
+        if session.trim_end and duration:
+            duration = max(min(session.trim_end, duration) - session.trim_start, 0)
+    video_bps = target_video_bitrate(session.size_limit, duration, session.audio_bitrate)
+    expected = expected_output_size(video_bps, duration, session.audio_bitrate)
+
+    label = humanbytes(session.size_limit)
+    if expected:
+        label += f" (~{humanbytes(expected)})"
+    if not detailed:
+        return label
+    if ENCODERS.get(session.video_codec).two_pass:
+        if video_bps:
+            label += f", video {video_bps // 1000} kbps, two-pass"
+    else:
+        # Encoders without two-pass run at the CRF and are stopped once the projection is over
+        label += f", CRF {session.crf}, stopped if projected over"
+    return label
+
+def output_size_limit(session: CompressionSettings, input_size: int) -> int:
+    """Largest acceptable output: the input itself, Telegram's cap or the user's target"""
+    # Outputs over Telegram's cap are split into parts when splitting is enabled
+    limits = [] if ENABLE_SPLIT_UPLOAD else [TG_MAX_FILE_SIZE]
+    if input_size:
+        limits.append(input_size)
+    if session.size_limit:
+        limits.append(session.size_limit)
+    return min(limits) if limits else 0
+
+def session_content_args(session: CompressionSettings) -> Dict[str, list]:
+    """Content filters and encoder options for the session, none when tuning is off"""
+    if session.content_mode == "off" or not session.content_profile:
+        return {'filters': [], 'output_args': []}
+    return content_encode_args(
+        session.content_profile, session.video_codec,
+        denoise=session.content_mode == "denoise"
+    )
+
+def source_filters(session: CompressionSettings, content_args: Dict[str, list]) -> list:
+    """Decimation, crop and denoise: the filters that do not depend on the output size"""
+    # Duplicate-frame decimation goes before crop, denoising after it
+    chain = [f for f in content_args['filters'] if f == "mpdecimate"]
+    if session.crop_filter:
+        chain.append(session.crop_filter)
+    chain.extend(f for f in content_args['filters'] if f != "mpdecimate")
+    return chain
+
+def reference_filters(session: CompressionSettings) -> list:
+    """
+    The frame-rate cap, decimation and crop of an encode, without denoise or
+    scaling: the source as the encode should look, for quality scoring
+    """
+    chain = []
+    output_fps = capped_frame_rate(session.source_fps, session.max_fps)
+    if output_fps:
+        chain.append(f"fps={output_fps}")
+    if "mpdecimate" in session_content_args(session)['filters']:
+        chain.append("mpdecimate")
+    if session.crop_filter:
+        chain.append(session.crop_filter)
+    return chain
+
+def output_muxer_args(session: CompressionSettings, backend, duration=None) -> list:
+    """Container options for an output; MP4 reserves its index space instead of rewriting the file"""
+    if backend.container == "mp4":
+        # x264 and x265 reorder frames; decimation makes the frame rate variable
+        return mp4_index_args(
+            session.source_probe, duration,
+            b_frames=backend.codec in ('h264', 'hevc'),
+            vfr="mpdecimate" in session_content_args(session)['filters']
+        )
+    return list(backend.muxer_args)
+
+def build_encode_command(session: CompressionSettings, video_file: str, progress_file: str,
+                         out_put_file_name: str, rate_args: list = None, pass_args: list = None,
+                         analysis_only: bool = False, sample: tuple = None,
+                         fragmented: bool = False) -> list:
+    """
+    Build the ffmpeg command for the session; CRF unless rate_args are given.
+    sample is a (start, length) window that replaces the trim range.
+    fragmented writes MP4 that is only ever appended to, for streamed uploads.
+    """
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "warning",
+        "-nostats",
+        "-progress", progress_file
+    ]
+    # Seek on the input so only the kept range is decoded and encoded
+    if sample:
+        cmd.extend(["-ss", f"{sample[0]:.3f}", "-t", f"{sample[1]:.3f}"])
+    elif session.trim_end:
+        cmd.extend([
+            "-ss", f"{session.trim_start:.3f}",
+            "-t", f"{session.trim_end - session.trim_start:.3f}"
+        ])
+    backend = ENCODERS.get(session.video_codec)
+    streams = None
+    if session.source_probe:
+        streams = plan_stream_mapping(
+            session.source_probe, session.audio_codec, session.audio_bitrate, backend.container
+        )
+    cmd.extend(["-i", video_file])
+    if streams:
+        cmd.extend(streams['video_map'])
+    cmd.extend(backend.video_args(session.preset))
+    cmd.extend(rate_args or backend.rate_args(session.crf))
+    cmd.extend(["-pix_fmt", backend.pixel_format(session.pixel_format)])
+
+    video_filters = []
+    # Drop frames first so the later filters and the encoder see fewer of them
+    output_fps = capped_frame_rate(session.source_fps, session.max_fps)
+    if output_fps:
+        video_filters.append(f"fps={output_fps}")
+    content_args = session_content_args(session)
+    video_filters.extend(source_filters(session, content_args))
+    # Scale last: never above the source, aspect ratio kept, portrait stays portrait
+    video_filters.extend(output_scale_filters(session))
+    if video_filters:
+        cmd.extend(["-vf", ",".join(video_filters)])
+    cmd.extend(content_args['output_args'])
+
+    if pass_args:
+        cmd.extend(pass_args)
+
+    # First pass only gathers statistics, nothing is written
+    if analysis_only:
+        cmd.extend(["-an", "-f", "null", "-y", os.devnull])
+        return backend.finalize(cmd)
+
+    # Audio, subtitles and attachments: copied where possible, transcoded where needed
+    if streams:
+        cmd.extend(streams['args'])
+    elif session.audio_codec == "copy":
+        cmd.extend(["-c:a", "copy"])
+    else:
+        audio_codec = "libopus" if backend.container == "webm" else session.audio_codec
+        cmd.extend(["-c:a", audio_codec, "-b:a", session.audio_bitrate])
+
+    # Add output optimizations
+    if fragmented:
+        # No faststart rewrite and no global index: bytes are final once written
+        cmd.extend(["-movflags", "+frag_keyframe+empty_moov+default_base_moof"])
+    elif sample:
+        cmd.extend(output_muxer_args(session, backend, sample[1]))
+    else:
+        cmd.extend(output_muxer_args(session, backend, session.trim_end and session.trim_end - session.trim_start))
+    cmd.extend(["-y", out_put_file_name])
+    return backend.finalize(cmd)
+
+def build_ladder_command(session: CompressionSettings, video_file: str, progress_file: str,
+                         renditions: list) -> list:
+    """
+    One decode, split once after the size-independent filters, then a
+    frame-rate cap, scaler and encoder per rendition.
+    """
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "warning",
+        "-nostats",
+        "-progress", progress_file
+    ]
+    if session.trim_end:
+        cmd.extend([
+            "-ss", f"{session.trim_start:.3f}",
+            "-t", f"{session.trim_end - session.trim_start:.3f}"
+        ])
+    cmd.extend(["-i", video_file])
+
+    backend = ENCODERS.get(session.video_codec)
+    streams = None
+    video_input = "0:v:0"
+    if session.source_probe:
+        streams = plan_stream_mapping(
+            session.source_probe, session.audio_codec, session.audio_bitrate, backend.container
+        )
+        if streams['video_map']:
+            video_input = streams['video_map'][1]
+
+    content_args = session_content_args(session)
+    branches = "".join(f"[v{i}]" for i in range(len(renditions)))
+    graph = [f"[{video_input}]" + ",".join(source_filters(session, content_args) + [f"split={len(renditions)}"]) + branches]
+    for i, rendition in enumerate(renditions):
+        chain = []
+        output_fps = capped_frame_rate(session.source_fps, rendition['max_fps'])
+        if output_fps:
+            chain.append(f"fps={output_fps}")
+        chain.extend(output_scale_filters(session, rendition['resolution']))
+        graph.append(f"[v{i}]{','.join(chain) or 'null'}[out{i}]")
+    cmd.extend(["-filter_complex", ";".join(graph)])
+
+    for i, rendition in enumerate(renditions):
+        output = ["-map", f"[out{i}]"]
+        output.extend(backend.video_args(rendition['preset']))
+        output.extend(backend.rate_args(rendition['crf']))
+        output.extend(["-pix_fmt", backend.pixel_format(session.pixel_format)])
+        output.extend(content_args['output_args'])
+        if streams:
+            output.extend(streams['args'])
+        else:
+            audio_codec = "libopus" if backend.container == "webm" else session.audio_codec
+            output.extend(["-map", "0:a:0?", "-c:a", audio_codec, "-b:a", session.audio_bitrate])
+        output.extend(output_muxer_args(
+            session, backend, session.trim_end and session.trim_end - session.trim_start
+        ))
+        output.extend(["-y", rendition['output']])
+        # Private parameter options are merged per output, never across them
+        cmd.extend(backend.finalize(output))
+    return cmd
+
+async def run_with_index_fallback(cmd: list, job: FFmpegJob, progress_file: str, total_time,
+                                  on_progress=None) -> list:
+    """
+    run_ffmpeg, run again with +faststart when the reserved MP4 index space
+    turned out too small. ffmpeg writes the index over the start of the
+    media data in that case, so the output cannot be repaired by a remux;
+    the reservation is sized for ctts and stts to keep this path rare.
+    Returns the command that produced the output.
+    """
+    await run_ffmpeg(cmd, job, progress_file, total_time, on_progress=on_progress)
+    if moov_reservation_failed(job):
+        # Estimate was short: the trailer could not be written, so run again with the rewrite
+        LOGGER.warning(f"FFmpeg job {job.job_id}: reserved index space too small, retrying with +faststart")
+        job.reset()
+        job.metrics['index'] = "faststart (reservation too small)"
+        cmd = faststart_fallback(cmd)
+        with open(progress_file, 'w') as f:
+            pass
+        await run_ffmpeg(cmd, job, progress_file, total_time, on_progress=on_progress)
+
+    record_index_metrics(cmd, job)
+    if job.metrics:
+        LOGGER.info(f"FFmpeg job {job.job_id} metrics: {job.metrics}")
+    return cmd
+
+async def run_encode(cmd: list, job: FFmpegJob, progress_file: str, total_time, message,
+                     session: CompressionSettings, label: str = None):
+    """Run one ffmpeg pass for the session, reporting progress on message"""
+    LOGGER.info(f"FFmpeg command: {' '.join(cmd)}")
+
+    with open(progress_file, 'w') as f:
+        pass
+
+    # Start process
+    start_time = time.time()
+    if session.mode == "remux":
+        rate_line = "📦 **Mode:** Remux (stream copy)\n"
+    elif session.mode == "trim":
+        rate_line = f"✂️ **Range:** {trim_label(session)}\n"
+    elif session.mode == "ladder":
+        rate_line = f"🪜 **Renditions:** {', '.join(q for q in LADDER_QUALITIES if q in session.ladder)}\n"
+    elif session.size_limit:
+        rate_line = f"🎯 **Target:** {humanbytes(session.size_limit)}\n"
+    else:
+        rate_line = f"🎯 **CRF:** {session.crf}\n"
+
+    async def show_progress(info):
+        percentage = info['percentage']
+        elapsed_time = info['elapsed_time']
+
+        # Calculate ETA
+        if info['speed'] > 0:
+            remaining_time = (total_time - elapsed_time) / info['speed']
+            eta = TimeFormatter(int(remaining_time * 1000)) if remaining_time > 0 else "-"
+        else:
+            eta = "-"
+
+        # Update progress
+        execution_time = TimeFormatter((time.time() - start_time) * 1000)
+        stats = (
+            f"🎬 **Compressing Video** ({session.quality}){f' - {label}' if label else ''}\n\n"
+            f"📊 **Progress:** {percentage}%\n"
+            f"⏰ **ETA:** {eta}\n"
+            f"⏱️ **Elapsed:** {execution_time}\n"
+            f"📦 **Projected Size:** {humanbytes(info['projected_size']) if info['projected_size'] else '-'}\n"
+            f"{rate_line}"
+            f"⚙️ **Preset:** {session.preset}\n"
+            f"📹 **Codec:** {session.video_codec}"
+        )
 
-        # Wait for completion
-        stdout, stderr = await process.communicate()
+        try:
+            await message.edit_text(
+                text=stats,
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
+                ]])
+            )
+        except:
+            pass
 
+    try:
+        await run_with_index_fallback(cmd, job, progress_file, total_time, on_progress=show_progress)
+    finally:
         # Cleanup
         try:
             if os.path.exists(progress_file):
@@ -687,18 +2166,433 @@ async def convert_video_with_custom_settings(video_file, output_directory, total
         except:
             pass
 
-        # Check result
-        if os.path.exists(out_put_file_name) and os.path.getsize(out_put_file_name) > 0:
-            LOGGER.info(f"Compression successful: {out_put_file_name}")
-            return out_put_file_name
-        else:
-            LOGGER.error("Output file not created or empty")
-            return None
+    session.projected_size = job.projected_size
+    if job.failure_reason:
+        session.failure_reason = job.failure_reason
+        session.failure_log = job.stderr_tail
+        LOGGER.error(f"FFmpeg job {job.job_id} failed: {job.failure_reason}")
+
+def _finish_output(out_put_file_name: str, job: FFmpegJob):
+    """Return the output path when the job succeeded, removing partial files otherwise"""
+    if job.failure_reason:
+        if os.path.exists(out_put_file_name):
+            os.remove(out_put_file_name)
+        return None
+
+    # Check result
+    if os.path.exists(out_put_file_name) and os.path.getsize(out_put_file_name) > 0:
+        LOGGER.info(f"Compression successful: {out_put_file_name}")
+        return out_put_file_name
+
+    LOGGER.error("Output file not created or empty")
+    return None
+
+async def convert_video_with_custom_settings(video_file, output_directory, total_time, bot, message, session):
+    """Convert video with custom user settings"""
+    try:
+        if session.mode == "remux":
+            return await remux_video(video_file, output_directory, total_time, message, session)
+
+        if session.mode == "trim":
+            return await trim_video(video_file, output_directory, message, session)
+
+        await prepare_video_filters(video_file, output_directory, message, session)
+
+        if session.size_limit and ENCODERS.get(session.video_codec).two_pass:
+            return await convert_video_to_target_size(
+                video_file, output_directory, total_time, message, session
+            )
+
+        if session.auto_quality and not session.auto_quality_result:
+            crf = await find_auto_crf(video_file, output_directory, total_time, message, session)
+            if crf is not None:
+                session.crf = crf
+
+        out_put_file_name = os.path.join(
+            output_directory, f"{int(time.time())}{ENCODERS.get(session.video_codec).extension}"
+        )
+        job = FFmpegJob(f"{session.user_id}_{int(time.time())}")
+        job.size_limit = output_size_limit(session, os.path.getsize(video_file))
+        session.size_limit_used = job.size_limit
+        progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+
+        stream = None
+        if streaming_upload_allowed(session):
+            stream = GrowingFileUploader(bot, out_put_file_name)
+            stream.start()
+
+        cmd = build_encode_command(
+            session, video_file, progress_file, out_put_file_name, fragmented=stream is not None
+        )
+        try:
+            await run_encode(cmd, job, progress_file, total_time, message, session)
+        except asyncio.CancelledError:
+            if stream:
+                await stream.cancel()
+            raise
+        finally:
+            if stream:
+                stream.finish()
+        session.size_exceeded = job.size_exceeded
+
+        result = _finish_output(out_put_file_name, job)
+        if stream and result:
+            session.stream_upload = stream
+        elif stream:
+            await stream.cancel()
+        return result
 
     except Exception as e:
         LOGGER.error(f"Custom video conversion error: {e}")
         return None
 
+def streaming_upload_allowed(session: CompressionSettings) -> bool:
+    """Single-pass CRF encodes to inline MP4 can be uploaded while they are written"""
+    backend = ENCODERS.get(session.video_codec)
+    return (
+        ENABLE_STREAMING_UPLOAD
+        and session.mode == "encode"
+        and not session.size_limit
+        and backend.container == "mp4"
+        and backend.telegram_inline
+    )
+
+async def remux_video(video_file, output_directory, total_time, message, session):
+    """Copy the source into MP4 with the index in front, transcoding only incompatible streams"""
+    probe = await probe_media(video_file)
+    if not probe:
+        session.failure_reason = "Could not read the streams of the video"
+        return None
+
+    plan = plan_mp4_remux(probe, session.audio_bitrate)
+    if not plan['has_video']:
+        session.failure_reason = "No video stream found to remux"
+        return None
+    session.remux_transcoded = plan['transcoded']
+
+    out_put_file_name = os.path.join(output_directory, f"{int(time.time())}.mp4")
+    job = FFmpegJob(f"{session.user_id}_{int(time.time())}", stage="remux")
+    progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "warning",
+        "-nostats",
+        "-progress", progress_file,
+        "-i", video_file
+    ]
+    cmd.extend(plan['args'])
+    cmd.extend(mp4_index_args(probe))
+    cmd.extend(["-y", out_put_file_name])
+
+    label = "Converting " + ", ".join(plan['transcoded']) if plan['transcoded'] else "Stream copy"
+    await run_encode(cmd, job, progress_file, total_time, message, session, label=label)
+    return _finish_output(out_put_file_name, job)
+
+async def trim_video(video_file, output_directory, message, session):
+    """Smart cut of the session's range: edges re-encoded, everything between copied"""
+    stage_names = {
+        "head": "Re-encoding the start edge",
+        "copy": "Copying the kept range",
+        "tail": "Re-encoding the end edge",
+        "encode": "Encoding the short range",
+        "join": "Joining the parts"
+    }
+
+    async def show_stage(name):
+        try:
+            await message.edit_text(
+                f"✂️ **Cutting Video**\n\n"
+                f"🔹 **Range:** {trim_label(session)}\n"
+                f"⏳ **{stage_names.get(name, name)}...**",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
+                ]])
+            )
+        except:
+            pass
+
+    output, job = await smart_cut(
+        video_file, output_directory,
+        session.trim_start, session.trim_end,
+        audio_bitrate=session.audio_bitrate,
+        job_id=f"{session.user_id}_{int(time.time())}",
+        on_stage=show_stage
+    )
+    if not output:
+        session.failure_reason = job.failure_reason
+        session.failure_log = job.stderr_tail
+    return output
+
+async def encode_ladder(video_file, output_directory, total_time, message, session) -> list:
+    """
+    Encode the selected ladder renditions in a single ffmpeg run.
+    Returns (quality, path) pairs, empty when the encode failed.
+    """
+    await prepare_video_filters(video_file, output_directory, message, session)
+
+    backend = ENCODERS.get(session.video_codec)
+    stamp = int(time.time())
+    renditions, sizes = [], set()
+    for quality in LADDER_QUALITIES:
+        if quality not in session.ladder:
+            continue
+        preset = QUALITY_PRESETS[quality]
+        # A small source fits several boxes at the same size; encode it once
+        size = planned_size(session, preset["resolution"])
+        if size and size in sizes:
+            continue
+        sizes.add(size)
+        renditions.append({
+            'quality': quality,
+            'resolution': preset["resolution"],
+            'crf': preset["crf"],
+            'preset': preset["preset"],
+            'max_fps': preset.get("max_fps"),
+            'output': os.path.join(output_directory, f"{stamp}_{quality}{backend.extension}")
+        })
+
+    job = FFmpegJob(f"{session.user_id}_{stamp}_ladder")
+    progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+    cmd = build_ladder_command(session, video_file, progress_file, renditions)
+    await run_encode(
+        cmd, job, progress_file, total_time, message, session,
+        label=f"{len(renditions)} renditions"
+    )
+
+    if job.failure_reason:
+        for rendition in renditions:
+            if os.path.exists(rendition['output']):
+                os.remove(rendition['output'])
+        return []
+    return [
+        (rendition['quality'], rendition['output']) for rendition in renditions
+        if os.path.exists(rendition['output'])
+    ]
+
+async def start_remux_process(bot: Client, callback_query):
+    """Skip the encoder: download, copy the streams into MP4 and upload"""
+    user_id = callback_query.from_user.id
+
+    if user_id not in USER_SESSIONS:
+        await callback_query.answer("❌ Session expired. Please send video again.", show_alert=True)
+        return
+
+    session = USER_SESSIONS[user_id]
+    session.mode = "remux"
+    session.quality = "remux"
+    session.size_limit = None
+    session.trim_end = None
+    await start_compression_process(bot, callback_query)
+
+async def prepare_video_filters(video_file, output_directory, message, session):
+    """Run the analyses the session's filters need, once per source"""
+    if session.source_fps is None:
+        probe = session.source_probe or await probe_media(video_file)
+        session.source_probe = probe
+        session.source_fps = source_frame_rate(probe) or 0
+        shown = display_dimensions(probe)
+        storage = display_dimensions(probe, apply_sar=False)
+        if shown and storage:
+            session.source_size = shown
+            session.pixel_scale = (shown[0] / storage[0], shown[1] / storage[1])
+        if probe:
+            plan = plan_stream_mapping(probe, session.audio_codec, session.audio_bitrate)
+            LOGGER.info(
+                f"Stream plan for {video_file}: copy {plan['copied'] or '-'}, "
+                f"transcode {plan['transcoded'] or '-'}, drop {plan['dropped'] or '-'}"
+            )
+
+    if session.content_mode != "off" and session.content_profile is None:
+        try:
+            await message.edit_text("🧠 **Analysing content...**")
+        except:
+            pass
+        length = min(8, session.duration)
+        offset = session.trim_start if session.trim_end else 0
+        session.content_profile = await classify_content(
+            video_file, output_directory,
+            offset + (session.duration - length) / 2, length,
+            job_id=f"{session.user_id}_{int(time.time())}_content"
+        )
+
+    if session.auto_crop and session.crop_filter is None:
+        try:
+            await message.edit_text(
+                "🔲 **Detecting black borders...**",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
+                ]])
+            )
+        except:
+            pass
+        crop = await detect_crop(
+            video_file, output_directory,
+            session.trim_start if session.trim_end else 0, session.duration,
+            job_id=f"{session.user_id}_{int(time.time())}_crop"
+        )
+        # An empty string remembers that the video has no bars to remove
+        session.crop_filter = crop or ""
+
+async def find_auto_crf(video_file, output_directory, total_time, message, session):
+    """
+    Encode a few short windows at every candidate CRF in parallel, score them
+    against the source with SSIM and return the highest CRF whose worst
+    window still reaches session.auto_quality.
+    """
+    target = session.auto_quality
+    offset = session.trim_start if session.trim_end else 0
+    length = min(AUTO_QUALITY_SAMPLE_SECONDS, total_time)
+    count = AUTO_QUALITY_WINDOWS if total_time >= length * AUTO_QUALITY_WINDOWS * 2 else 1
+    windows = [
+        (offset + total_time * (i + 1) / (count + 1) - length / 2, length)
+        for i in range(count)
+    ]
+    job_id = f"{session.user_id}_{int(time.time())}_auto"
+    backend = ENCODERS.get(session.video_codec)
+    semaphore = asyncio.Semaphore(max(AUTO_QUALITY_PARALLEL, 1))
+    finished = []
+
+    async def show_search():
+        try:
+            await message.edit_text(
+                f"🤖 **Auto Quality Search**\n\n"
+                f"🎯 **Target:** SSIM {target}\n"
+                f"🔬 **Tested:** {len(finished)}/{len(AUTO_QUALITY_CRFS)} CRF values\n"
+                f"🎞️ **Samples:** {count} x {int(length)}s",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton('❌ Cancel', callback_data='cancel_compression')
+                ]])
+            )
+        except:
+            pass
+
+    async def score_crf(crf):
+        async with semaphore:
+            scores = []
+            for index, (start, window_length) in enumerate(windows):
+                sample_file = os.path.join(output_directory, f"{job_id}_{crf}_{index}{backend.extension}")
+                job = FFmpegJob(f"{job_id}_{crf}_{index}", stage="auto quality")
+                progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+                cmd = build_encode_command(
+                    session, video_file, progress_file, sample_file,
+                    rate_args=backend.rate_args(crf), sample=(start, window_length)
+                )
+                try:
+                    await run_ffmpeg(cmd, job, progress_file, window_length)
+                    score = None
+                    if not job.failure_reason:
+                        score = await measure_quality(
+                            sample_file, video_file, start, window_length,
+                            f"{job.job_id}_score", output_directory,
+                            reference_filters=reference_filters(session)
+                        )
+                finally:
+                    for path in (sample_file, progress_file):
+                        if os.path.exists(path):
+                            os.remove(path)
+                if not score:
+                    return crf, None
+                scores.append(score)
+
+        finished.append(crf)
+        await show_search()
+        return crf, {
+            'ssim': min(score['ssim'] for score in scores),
+            'psnr': min(score['psnr'] for score in scores)
+        }
+
+    await show_search()
+    results = dict(await asyncio.gather(*(score_crf(crf) for crf in AUTO_QUALITY_CRFS)))
+    scored = {crf: score for crf, score in results.items() if score}
+
+    if not scored:
+        LOGGER.warning(f"Auto quality search failed for user {session.user_id}, keeping CRF {session.crf}")
+        return None
+
+    passing = [crf for crf, score in scored.items() if score['ssim'] >= target]
+    chosen = max(passing) if passing else min(scored)
+    session.auto_quality_result = scored[chosen]
+    LOGGER.info(
+        f"Auto quality for user {session.user_id}: CRF {chosen} "
+        f"(SSIM {scored[chosen]['ssim']:.4f}, PSNR {scored[chosen]['psnr']:.2f} dB, target {target})"
+    )
+    return chosen
+
+async def convert_video_to_target_size(video_file, output_directory, total_time, message, session):
+    """
+    Two-pass encode aimed at session.size_limit. First-pass stats are cached on
+    the session, so a bitrate retry after a miss only re-runs the second pass.
+    """
+    target_size = session.size_limit
+    out_put_file_name = os.path.join(
+        output_directory, f"{int(time.time())}{ENCODERS.get(session.video_codec).extension}"
+    )
+    job_id = f"{session.user_id}_{int(time.time())}"
+
+    # Stats depend on the picture being analysed, not on the bitrate
+    stats_key = (
+        video_file, session.video_codec, session.resolution, session.pixel_format,
+        session.trim_start, session.trim_end, session.crop_filter,
+        session.max_fps, session.content_mode
+    )
+    passlog = session.pass_stats.get(stats_key)
+
+    if not passlog or not pass_stats_exist(passlog):
+        passlog = os.path.join(output_directory, f"passlog_{job_id}")
+        job = FFmpegJob(f"{job_id}_p1")
+        progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+        cmd = build_encode_command(
+            session, video_file, progress_file, out_put_file_name,
+            rate_args=["-b:v", f"{target_video_bitrate(target_size, total_time, session.audio_bitrate) // 1000}k"],
+            pass_args=two_pass_args(session.video_codec, 1, passlog),
+            analysis_only=True
+        )
+        await run_encode(cmd, job, progress_file, total_time, message, session, label="Pass 1/2")
+        if job.failure_reason:
+            return None
+        session.pass_stats[stats_key] = passlog
+    else:
+        LOGGER.info(f"Reusing first-pass stats {passlog}")
+
+    video_bps = target_video_bitrate(target_size, total_time, session.audio_bitrate)
+
+    for attempt in range(TARGET_SIZE_ATTEMPTS):
+        job = FFmpegJob(f"{job_id}_p2_{attempt}")
+        job.size_limit = target_size
+        session.size_limit_used = target_size
+        progress_file = os.path.join(output_directory, f"progress_{job.job_id}.txt")
+        kbps = max(video_bps // 1000, 1)
+        cmd = build_encode_command(
+            session, video_file, progress_file, out_put_file_name,
+            rate_args=["-b:v", f"{kbps}k", "-maxrate", f"{kbps * 2}k", "-bufsize", f"{kbps * 2}k"],
+            pass_args=two_pass_args(session.video_codec, 2, passlog)
+        )
+        await run_encode(cmd, job, progress_file, total_time, message, session, label="Pass 2/2")
+
+        if job.size_exceeded:
+            actual_size = job.projected_size
+        elif job.failure_reason:
+            return _finish_output(out_put_file_name, job)
+        else:
+            actual_size = os.path.getsize(out_put_file_name) if os.path.exists(out_put_file_name) else 0
+            if actual_size <= target_size:
+                return _finish_output(out_put_file_name, job)
+
+        # Missed the target: scale the bitrate down and re-run pass 2 on the same stats
+        LOGGER.info(
+            f"Target {humanbytes(target_size)} missed with {humanbytes(actual_size)} "
+            f"at {kbps}k, retrying second pass"
+        )
+        if os.path.exists(out_put_file_name):
+            os.remove(out_put_file_name)
+        video_bps = int(video_bps * target_size / max(actual_size, 1) * (1 - MUX_OVERHEAD))
+        session.failure_reason = None
+
+    session.failure_reason = f"Could not reach the {humanbytes(target_size)} target size"
+    return None
+
 # Keep existing helper functions...
 async def check_subscription(bot: Client, update: Message) -> bool:
     """Check if user is subscribed to updates channel"""
@@ -748,6 +2642,41 @@ async def validate_video_file(video, update: Message) -> bool:
 
     return True
 
+async def run_user_job(user_id: int, coro):
+    """
+    Run a user's job in its own task and register it in CURRENT_PROCESSES,
+    so cancel_user_job can stop it together with every ffmpeg child it
+    started. A job cancelled before it got here is not started.
+    """
+    if user_id not in CURRENT_PROCESSES:
+        coro.close()
+        return None
+    task = asyncio.create_task(coro)
+    CURRENT_PROCESSES[user_id] = task
+    try:
+        return await task
+    except asyncio.CancelledError:
+        # Still registered means the handler itself is being cancelled, not the job
+        if CURRENT_PROCESSES.get(user_id) is task:
+            raise
+        LOGGER.info(f"Job of user {user_id} cancelled")
+        return None
+
+async def cancel_user_job(user_id: int):
+    """
+    Unregister a user's job and cancel its task. run_ffmpeg terminates its
+    child on cancellation, so parallel part encodes, ladders, auto-quality
+    samples, previews and two-pass runs all stop; waits for that so their
+    files can be removed afterwards.
+    """
+    task = CURRENT_PROCESSES.pop(user_id, None)
+    if not isinstance(task, asyncio.Task) or task.done():
+        return
+    task.cancel()
+    done, _ = await asyncio.wait({task}, timeout=CANCEL_GRACE)
+    if not done:
+        LOGGER.warning(f"Job of user {user_id} still stopping after {CANCEL_GRACE}s")
+
 async def cleanup_process(user_id: int, sent_message, log_message, reason: str):
     """Cleanup failed process"""
     try:
@@ -763,14 +2692,51 @@ async def cleanup_process(user_id: int, sent_message, log_message, reason: str):
     except Exception as e:
         LOGGER.error(f"Cleanup error: {e}")
 
+async def report_failed_job(bot: Client, user_id: int, session: CompressionSettings, reason: str):
+    """Record a failed job and send its ffmpeg log tail to the log channel"""
+    log_tail = session.failure_log or ""
+
+    if db:
+        try:
+            await db.add_failed_job(user_id, reason, {
+                'quality': session.quality,
+                'crf': session.crf,
+                'preset': session.preset,
+                'video_codec': session.video_codec,
+                'stderr_tail': log_tail
+            })
+        except Exception as e:
+            LOGGER.error(f"Failed job record error: {e}")
+
+    if not LOG_CHANNEL:
+        return
+
+    try:
+        report = (
+            f"❌ Compression failed\n\n"
+            f"👤 User: {user_id}\n"
+            f"🎯 Quality: {session.quality} | CRF {session.crf} | {session.preset} | {session.video_codec}\n"
+            f"🔍 Reason: {reason}"
+        )
+        if log_tail:
+            # Keep within Telegram's message limit, the full tail is in the record
+            report += f"\n\n📜 FFmpeg log tail:\n{log_tail[-3000:]}"
+
+        await bot.send_message(LOG_CHANNEL, report, parse_mode=ParseMode.DISABLED)
+    except Exception as e:
+        LOGGER.error(f"Could not send failure report to log channel: {e}")
+
 async def cleanup_files_and_process(user_id: int, files: list):
     """Cleanup files and process"""
     try:
         if user_id in CURRENT_PROCESSES:
             del CURRENT_PROCESSES[user_id]
-        
-        if user_id in USER_SESSIONS:
-            del USER_SESSIONS[user_id]
+
+        session = USER_SESSIONS.pop(user_id, None)
+        if session:
+            # Two-pass statistics are only useful while the session lives
+            for passlog in session.pass_stats.values():
+                files.extend(glob.glob(f"{passlog}*"))
 
         for file_path in files:
             if file_path and os.path.exists(file_path):
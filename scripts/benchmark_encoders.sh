@@ -0,0 +1,59 @@
+# scripts/benchmark_encoders.sh - Size, CPU time and SSIM of each encoder backend
+# Encoder benchmark for Enhanced VideoCompress Bot v2.0
+
+if [ $# -eq 0 ]; then
+    echo "Usage: $0 <sample_video> [seconds] [height]"
+    echo "Example: $0 ./sample.mkv 60 720"
+    exit 1
+fi
+
+INPUT="$1"
+SECONDS_TO_ENCODE="${2:-60}"
+HEIGHT="${3:-720}"
+WORK_DIR="$(mktemp -d)"
+trap 'rm -rf "$WORK_DIR"' EXIT
+
+if [ ! -f "$INPUT" ]; then
+    echo "❌ Sample not found: $INPUT"
+    exit 1
+fi
+
+# Same scale and window for every run, audio left out so only video is compared
+COMMON=(-hide_banner -loglevel error -y -t "$SECONDS_TO_ENCODE" -i "$INPUT" -an -sn
+        -vf "scale=-2:$HEIGHT" -pix_fmt yuv420p)
+
+# name|extension|encoder options; CRFs match what the bot sends for menu CRF 23
+RUNS=(
+    "x264 medium crf23|mp4|-c:v libx264 -preset medium -crf 23"
+    "x265 medium crf23|mp4|-c:v libx265 -preset medium -crf 23 -tag:v hvc1"
+    "svt-av1 p8 crf35|mp4|-c:v libsvtav1 -preset 8 -crf 35"
+    "svt-av1 p6 crf35|mp4|-c:v libsvtav1 -preset 6 -crf 35"
+    "vp9 good4 crf33|webm|-c:v libvpx-vp9 -deadline good -cpu-used 4 -crf 33 -b:v 0 -row-mt 1"
+)
+
+ffmpeg -hide_banner -loglevel error -y -t "$SECONDS_TO_ENCODE" -i "$INPUT" -an -sn \
+    -vf "scale=-2:$HEIGHT" -pix_fmt yuv420p -c:v ffv1 "$WORK_DIR/reference.mkv" || exit 1
+
+printf "%-20s %10s %10s %10s %8s\n" "encoder" "size" "wall s" "cpu s" "ssim"
+for run in "${RUNS[@]}"; do
+    IFS='|' read -r name ext options <<< "$run"
+    output="$WORK_DIR/out.$ext"
+
+    start=$(date +%s.%N)
+    cpu_before=$(awk '{print $14 + $15 + $16 + $17}' /proc/$$/stat)
+    # shellcheck disable=SC2086
+    if ! ffmpeg "${COMMON[@]}" $options "$output"; then
+        printf "%-20s %10s\n" "$name" "unavailable"
+        continue
+    fi
+    cpu_after=$(awk '{print $14 + $15 + $16 + $17}' /proc/$$/stat)
+    end=$(date +%s.%N)
+
+    size=$(du -h "$output" | cut -f1)
+    wall=$(echo "$end - $start" | bc)
+    cpu=$(echo "scale=1; ($cpu_after - $cpu_before) / $(getconf CLK_TCK)" | bc)
+    ssim=$(ffmpeg -hide_banner -i "$output" -i "$WORK_DIR/reference.mkv" \
+        -lavfi ssim -f null - 2>&1 | sed -n 's/.*All:\([0-9.]*\).*/\1/p' | tail -1)
+
+    printf "%-20s %10s %10.1f %10s %8s\n" "$name" "$size" "$wall" "$cpu" "$ssim"
+done
@@ -0,0 +1,59 @@
+# scripts/benchmark_upload.sh - Upload time of Pyrogram's uploader against the parallel one
+# Upload benchmark for Enhanced VideoCompress Bot v2.0
+
+if [ $# -eq 0 ]; then
+    echo "Usage: $0 <file> [workers...]"
+    echo "Example: $0 ./output.mp4 2 4 8"
+    exit 1
+fi
+
+INPUT="$1"
+shift
+WORKERS="${*:-2 4 8}"
+
+if [ ! -f "$INPUT" ]; then
+    echo "❌ File not found: $INPUT"
+    exit 1
+fi
+
+# Load environment variables
+if [ -f ".env" ]; then
+    export $(cat .env | grep -v '^#' | xargs)
+fi
+
+# Parts are only uploaded, never sent, so nothing shows up in any chat
+# shellcheck disable=SC2086
+python3 - "$INPUT" $WORKERS <<'PYTHON'
+import asyncio
+import os
+import sys
+import time
+
+from pyrogram import Client
+
+from bot import APP_ID, API_HASH, TG_BOT_TOKEN, SESSION_NAME
+from bot.helper_funcs.upload import ParallelUploader
+from bot.helper_funcs.display_progress import humanbytes
+
+
+async def main(path, worker_counts):
+    size = os.path.getsize(path)
+    print(f"📦 {os.path.basename(path)}: {humanbytes(size)}")
+    print(f"{'uploader':<24} {'seconds':>8} {'speed':>12}")
+
+    async with Client(f"{SESSION_NAME}_benchmark", api_id=APP_ID, api_hash=API_HASH,
+                      bot_token=TG_BOT_TOKEN, in_memory=True) as client:
+        runs = [("pyrogram save_file", lambda: client.save_file(path))]
+        runs += [
+            (f"parallel x{count}", lambda count=count: ParallelUploader(client, path, workers=count).upload())
+            for count in worker_counts
+        ]
+        for name, upload in runs:
+            start = time.time()
+            await upload()
+            elapsed = time.time() - start
+            print(f"{name:<24} {elapsed:>8.1f} {humanbytes(int(size / elapsed)) + '/s':>12}")
+
+
+asyncio.run(main(sys.argv[1], [int(count) for count in sys.argv[2:]]))
+PYTHON
@@ -0,0 +1,35 @@
+# tests/test_encoders.py - Encoder backends of bot/helper_funcs/encoders.py
+
+from bot.helper_funcs.encoders import ENCODERS
+
+
+def test_finalize_merges_repeated_params():
+    backend = ENCODERS.backends["libx265"]
+    cmd = [
+        "ffmpeg", "-i", "in.mkv",
+        "-c:v", "libx265", "-x265-params", "pools=4",
+        "-x265-params", "pass=1:stats=job.log",
+        "out.mp4"
+    ]
+    assert backend.finalize(cmd) == [
+        "ffmpeg", "-i", "in.mkv",
+        "-c:v", "libx265", "-x265-params", "pools=4:pass=1:stats=job.log",
+        "out.mp4"
+    ]
+
+
+def test_finalize_skips_empty_values():
+    backend = ENCODERS.backends["libsvtav1"]
+    cmd = ["-svtav1-params", "lp=2", "-svtav1-params", "", "-svtav1-params", "film-grain=8"]
+    assert backend.finalize(cmd) == ["-svtav1-params", "lp=2:film-grain=8"]
+
+
+def test_finalize_leaves_single_or_absent_params_alone():
+    x265 = ENCODERS.backends["libx265"]
+    cmd = ["-c:v", "libx265", "-x265-params", "pools=4", "out.mp4"]
+    assert x265.finalize(cmd) == cmd
+
+    # libx264 has no private parameter option to merge
+    x264 = ENCODERS.backends["libx264"]
+    cmd = ["-c:v", "libx264", "-x265-params", "a=1", "-x265-params", "b=2"]
+    assert x264.finalize(cmd) == cmd
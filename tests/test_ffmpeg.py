@@ -0,0 +1,220 @@
+# tests/test_ffmpeg.py - Pure planning helpers of bot/helper_funcs/ffmpeg.py
+
+from fractions import Fraction
+
+import pytest
+
+from bot.helper_funcs.ffmpeg import (
+    agree_crop,
+    capped_frame_rate,
+    estimate_moov_size,
+    fit_resolution,
+    initial_segment_time,
+    plan_stream_mapping,
+    segment_format_options,
+    shorter_segment_time,
+    MOOV_CTTS_BYTES,
+    MOOV_MARGIN,
+    MOOV_STTS_BYTES,
+)
+
+GB = 1024 ** 3
+
+
+def video_stream(index=0, codec="h264", **extra):
+    stream = {'index': index, 'codec_type': 'video', 'codec_name': codec,
+              'r_frame_rate': "25/1", 'avg_frame_rate': "25/1"}
+    stream.update(extra)
+    return stream
+
+
+def audio_stream(index=1, codec="aac", **extra):
+    stream = {'index': index, 'codec_type': 'audio', 'codec_name': codec}
+    stream.update(extra)
+    return stream
+
+
+@pytest.mark.parametrize("source, resolution, expected", [
+    ((1920, 1080), "1280x720", (1280, 720)),
+    # The box turns with a portrait source instead of squashing it
+    ((1080, 1920), "1280x720", (720, 1280)),
+    # Letterboxed sources keep their aspect ratio and get even sides
+    ((1920, 800), "1280x720", (1280, 532)),
+    # Never upscaled
+    ((640, 360), "1280x720", None),
+    ((1920, 1080), "Original", None),
+])
+def test_fit_resolution(source, resolution, expected):
+    assert fit_resolution(source, resolution) == expected
+
+
+@pytest.mark.parametrize("source_fps, max_fps, expected", [
+    (Fraction(60), 30, "30/1"),
+    (Fraction(50), 30, "25/1"),
+    (Fraction(60000, 1001), 30, "30000/1001"),
+    # 30 / 2 would land far below a 25 cap, so the cap itself is used
+    (Fraction(30), 25, "25/1"),
+    (Fraction(24), 30, None),
+    (Fraction(30), 30, None),
+    (None, 30, None),
+    (Fraction(60), None, None),
+])
+def test_capped_frame_rate(source_fps, max_fps, expected):
+    assert capped_frame_rate(source_fps, max_fps) == expected
+
+
+def test_agree_crop_takes_the_union_of_the_windows():
+    rects = [(1920, 800, 0, 140), (1920, 816, 0, 132)]
+    assert agree_crop(rects, 1920, 1080) == "crop=1920:816:0:132"
+
+
+def test_agree_crop_rounds_to_even_sides():
+    assert agree_crop([(1919, 801, 1, 139)], 1920, 1080) == "crop=1918:800:1:139"
+
+
+def test_agree_crop_ignores_dark_windows():
+    rects = [(100, 60, 900, 500), (1920, 800, 0, 140)]
+    assert agree_crop(rects, 1920, 1080) == "crop=1920:800:0:140"
+    assert agree_crop([(100, 60, 900, 500)], 1920, 1080) is None
+
+
+def test_agree_crop_skips_crops_that_barely_save_anything():
+    assert agree_crop([(1920, 1072, 0, 4)], 1920, 1080) is None
+    assert agree_crop([], 1920, 1080) is None
+
+
+@pytest.mark.parametrize("extension, expected", [
+    (".mp4", ["-segment_format_options", "movflags=+faststart"]),
+    (".MP4", ["-segment_format_options", "movflags=+faststart"]),
+    (".mov", ["-segment_format_options", "movflags=+faststart"]),
+    # Other muxers reject movflags
+    (".webm", []),
+    (".mkv", []),
+])
+def test_segment_format_options(extension, expected):
+    assert segment_format_options(extension) == expected
+
+
+def moov_probe(has_b_frames=0, avg_frame_rate="25/1", audio=False):
+    streams = [video_stream(nb_frames="2500", has_b_frames=has_b_frames, avg_frame_rate=avg_frame_rate)]
+    if audio:
+        streams.append(audio_stream(sample_rate="48000"))
+    return {'format': {'duration': "100.0"}, 'streams': streams}
+
+
+def test_estimate_moov_size_scales_with_duration():
+    whole = estimate_moov_size(moov_probe())
+    half = estimate_moov_size(moov_probe(), duration=50)
+    assert whole > half > 0
+    # Longer than the source is clamped to the source
+    assert estimate_moov_size(moov_probe(), duration=500) == whole
+
+
+def test_estimate_moov_size_budgets_ctts_and_stts():
+    plain = estimate_moov_size(moov_probe())
+    ctts = 2500 * MOOV_CTTS_BYTES * MOOV_MARGIN
+    stts = 2500 * MOOV_STTS_BYTES * MOOV_MARGIN
+
+    assert estimate_moov_size(moov_probe(has_b_frames=2)) - plain == pytest.approx(ctts, abs=1)
+    assert estimate_moov_size(moov_probe(avg_frame_rate="24/1")) - plain == pytest.approx(stts, abs=1)
+    # The output's encoder settings override what the source probe says
+    assert estimate_moov_size(moov_probe(), b_frames=True, vfr=True) - plain == pytest.approx(ctts + stts, abs=1)
+    assert estimate_moov_size(moov_probe(has_b_frames=2), b_frames=False) == plain
+
+
+def test_estimate_moov_size_counts_audio_frames():
+    assert estimate_moov_size(moov_probe(audio=True)) > estimate_moov_size(moov_probe())
+
+
+def test_estimate_moov_size_without_enough_information():
+    assert estimate_moov_size(None) is None
+    assert estimate_moov_size({'format': {}, 'streams': [video_stream()]}) is None
+    # Far too many frames to reserve space for
+    huge = {'format': {'duration': "100.0"}, 'streams': [video_stream(nb_frames=str(10 ** 8))]}
+    assert estimate_moov_size(huge) is None
+
+
+def test_plan_stream_mapping_copies_low_bitrate_audio():
+    probe = {'streams': [video_stream(), audio_stream(bit_rate="96000")]}
+    plan = plan_stream_mapping(probe, audio_bitrate="128k")
+
+    assert plan['video_map'] == ["-map", "0:0"]
+    assert plan['args'] == ["-map", "0:1", "-c:a:0", "copy"]
+    assert plan['copied'] == ["audio aac 96k"]
+
+
+def test_plan_stream_mapping_transcodes_audio_mp4_cannot_carry():
+    probe = {'streams': [video_stream(), audio_stream(codec="opus")]}
+    plan = plan_stream_mapping(probe, audio_codec="copy")
+
+    assert plan['args'] == ["-map", "0:1", "-c:a:0", "aac", "-b:a:0", "128k"]
+    assert plan['transcoded'] == ["audio opus -> aac"]
+
+
+def test_plan_stream_mapping_uses_the_webm_audio_encoder():
+    probe = {'streams': [video_stream(), audio_stream(codec="aac", bit_rate="96000")]}
+    plan = plan_stream_mapping(probe, audio_codec="aac", container="webm")
+
+    assert plan['args'] == ["-map", "0:1", "-c:a:0", "libopus", "-b:a:0", "128k"]
+
+
+def test_plan_stream_mapping_keeps_the_default_audio_and_drops_the_rest():
+    probe = {'streams': [
+        video_stream(),
+        audio_stream(index=1, codec="ac3"),
+        audio_stream(index=2, codec="aac", bit_rate="96000", disposition={'default': 1}),
+    ]}
+    plan = plan_stream_mapping(probe)
+
+    assert plan['args'] == ["-map", "0:2", "-c:a:0", "copy"]
+    assert plan['dropped'] == ["audio ac3"]
+
+
+def test_plan_stream_mapping_subtitles_and_attachments_in_mp4():
+    probe = {'streams': [
+        video_stream(),
+        {'index': 1, 'codec_type': 'subtitle', 'codec_name': 'subrip'},
+        {'index': 2, 'codec_type': 'subtitle', 'codec_name': 'hdmv_pgs_subtitle'},
+        {'index': 3, 'codec_type': 'subtitle', 'codec_name': 'mov_text'},
+        {'index': 4, 'codec_type': 'attachment', 'codec_name': 'ttf'},
+    ]}
+    plan = plan_stream_mapping(probe)
+
+    assert plan['args'] == [
+        "-map", "0:1", "-c:s:0", "mov_text",
+        "-map", "0:3", "-c:s:1", "copy",
+    ]
+    assert plan['transcoded'] == ["subtitle subrip -> mov_text"]
+    assert plan['dropped'] == ["subtitle hdmv_pgs_subtitle", "attachment ttf"]
+
+
+def test_plan_stream_mapping_copies_everything_into_other_containers():
+    probe = {'streams': [
+        video_stream(),
+        {'index': 1, 'codec_type': 'subtitle', 'codec_name': 'hdmv_pgs_subtitle'},
+        {'index': 2, 'codec_type': 'attachment', 'codec_name': 'ttf'},
+    ]}
+    plan = plan_stream_mapping(probe, container="mkv")
+
+    assert plan['args'] == ["-map", "0:1", "-map", "0:2", "-c:s", "copy", "-c:t", "copy"]
+    assert plan['dropped'] == []
+
+
+def test_plan_stream_mapping_skips_cover_art():
+    probe = {'streams': [
+        video_stream(index=0, codec="mjpeg", disposition={'attached_pic': 1}),
+        video_stream(index=1),
+    ]}
+    assert plan_stream_mapping(probe)['video_map'] == ["-map", "0:1"]
+
+
+def test_split_segment_time_aims_below_the_part_size():
+    # Half the file per part, less the keyframe margin
+    assert initial_segment_time(600, 2 * GB, GB) == pytest.approx(270)
+
+
+def test_split_segment_time_shrinks_after_an_overflow():
+    segment_time = shorter_segment_time(270, int(1.2 * GB), GB)
+    assert segment_time == pytest.approx(270 * 0.95 / 1.2)
+    # A part of that length at the overflowing part's rate lands under the cap
+    assert int(1.2 * GB) * segment_time / 270 < GB
@@ -0,0 +1,28 @@
+# tests/test_utils.py - Input parsing of bot/helper_funcs/utils.py
+
+import pytest
+
+from bot.helper_funcs.utils import ValidationUtils
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("10 20", (10.0, 20.0)),
+    ("10-20", (10.0, 20.0)),
+    ("1:30 - 2:00", (90.0, 120.0)),
+    ("00:01:00.5 00:02:00", (60.5, 120.0)),
+])
+def test_parse_time_range(text, expected):
+    assert ValidationUtils.parse_time_range(text) == expected
+
+
+@pytest.mark.parametrize("text", [
+    "20 10",
+    "10 10",
+    "10",
+    "10 20 30",
+    "a b",
+    "1:2:3:4 5",
+    "",
+])
+def test_parse_time_range_rejects(text):
+    assert ValidationUtils.parse_time_range(text) is None